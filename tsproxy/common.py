@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
 import asyncio
+import bisect
 import concurrent.futures
 import logging
+import logging.handlers
+import math
 import os
 import queue
 import sys
@@ -10,6 +13,7 @@ import threading
 import time
 import traceback
 import errno
+from collections import OrderedDict, deque
 from io import StringIO
 from configparser import RawConfigParser
 from urllib.parse import urlparse
@@ -17,10 +21,12 @@ from urllib.parse import urlparse
 from async_timeout import timeout
 
 from tsproxy import lookup_conf_file, str_datetime, ts_print, __version__
+from tsproxy import metrics
 
 logger = logging.getLogger(__name__)
 
 KEY_FIRST_HTTP_REQUEST = 'FIRST_HTTP_REQUEST'
+KEY_HTTP_KEEPALIVE = 'HTTP_KEEPALIVE'
 HTTPS_METHOD_CONNECT = 'CONNECT'
 KEY_IP_CHANGED = 'KEY_ip_changed'
 
@@ -31,6 +37,16 @@ apnic_expired_days = 30
 
 # default timeout seconds for read and connect
 default_timeout = 10
+# seconds to wait before connecting to the next resolved ip in parallel(RFC 8305)
+connect_attempt_delay = 0.25
+# max pre-connected idle sockets per proxy, 0 to disable the pool
+proxy_pool_size = 4
+# close the pooled socket if it is idle more than proxy_pool_idle_timeout seconds
+proxy_pool_idle_timeout = 30
+# max idle keep-alive connections of the plain http per (route, proxy, host, port), 0 to disable the pool
+http_pool_size = 4
+# close the kept-alive connection if it is idle more than http_pool_idle_timeout seconds
+http_pool_idle_timeout = 15
 
 # real proxy proxy count per session
 hundred = 100
@@ -43,6 +59,18 @@ proxys_check_timeout = 120
 retry_interval_on_error = 120
 # close connection on idle 1/2 hour
 close_on_idle_timeout = 600
+# relay the data needs no transformation(https tunnel, ...) at the protocol level
+fast_relay = True
+# pause reading the source when the write buffer of its peer is over write_high_watermark bytes,
+# resume when it is below write_low_watermark bytes
+write_high_watermark = 262144
+write_low_watermark = 65536
+# coalesce the small writes(< write_coalesce_bytes) to the shadowsocks proxy into one encryption and send,
+# delayed write_coalesce_delay seconds at most(0 for the next loop iteration), write_coalesce_bytes = 0 to disable
+write_coalesce_bytes = 4096
+write_coalesce_delay = 0.001
+# hold the shadowsocks proxy head proxy_head_delay seconds at most to send it with the first payload
+proxy_head_delay = 0.02
 
 # max times for fail_rate
 max_times_fail_rate = 100
@@ -58,6 +86,36 @@ auto_pause_fail_rate_threshold = 0.3
 tp90_expired_time = 3600*3
 # use recent 100 response time on calc tp90
 tp90_calc_count = 100
+# new connections to proxy, 0: all to the head proxy, 1: power of two choices in the top balance_top_k proxies,
+# 2: weighted random in the top balance_top_k proxies
+balance_mode = 0
+balance_top_k = 3
+
+# format and write the log records in a background thread, async_logging_batch records per write at most
+async_logging = True
+async_logging_batch = 256
+
+# en/decrypt the shadowsocks data chunk of crypto_offload_threshold bytes or more in the crypto_offload_workers threads
+# instead of the event loop, 0 to disable
+crypto_offload_threshold = 16384
+crypto_offload_workers = 2
+
+# seconds between the broadcasts of the proxies state from the leader worker to the others(--workers N)
+worker_sync_interval = 1.0
+
+# max entries of the bounded caches(dns, cn address, processes, ...)
+cache_max_entries = 10000
+# seconds of the routing decision(router.yaml rule, cn ip) cached per destination, 0 to disable the cache
+route_cache_timeout = 300
+
+# dns record ttl is clamped into [dns_min_ttl, dns_max_ttl]
+dns_min_ttl = 60
+dns_max_ttl = 3600
+# seconds of an expired dns record still be answered while refreshing it in background
+dns_stale_ttl = 3600
+# refresh the hot dns record(hits >= dns_prefetch_hits) in dns_prefetch_time seconds before it expires
+dns_prefetch_time = 10
+dns_prefetch_hits = 2
 
 # speed test result lifetime
 speed_lifetime = 12 * 3600
@@ -83,6 +141,11 @@ network_errors = set(_network_errors)
 
 def load_tsproxy_conf(conf_file):
     global default_timeout
+    global connect_attempt_delay
+    global proxy_pool_size
+    global proxy_pool_idle_timeout
+    global http_pool_size
+    global http_pool_idle_timeout
     global hundred
     # proxy timeout config
     global proxy_idle_sec
@@ -92,6 +155,12 @@ def load_tsproxy_conf(conf_file):
     global retry_interval_on_error
     # close connection on idle 1/2 hour
     global close_on_idle_timeout
+    global fast_relay
+    global write_high_watermark
+    global write_low_watermark
+    global write_coalesce_bytes
+    global write_coalesce_delay
+    global proxy_head_delay
     # max times for fail_rate
     global max_times_fail_rate
     # tp90 increment percent Threshold
@@ -106,10 +175,29 @@ def load_tsproxy_conf(conf_file):
     global tp90_expired_time
     # use recent 100 response time on calc tp90
     global tp90_calc_count
+    global balance_mode
+    global balance_top_k
 
     global apnic_latest_url
     global apnic_expired_days
 
+    global async_logging
+    global async_logging_batch
+
+    global crypto_offload_threshold
+    global crypto_offload_workers
+
+    global worker_sync_interval
+
+    global cache_max_entries
+    global route_cache_timeout
+
+    global dns_min_ttl
+    global dns_max_ttl
+    global dns_stale_ttl
+    global dns_prefetch_time
+    global dns_prefetch_hits
+
     global _network_errors
     global network_errors
 
@@ -140,11 +228,22 @@ def load_tsproxy_conf(conf_file):
     if config.has_section('common'):
         logger.info('tsproxy.conf: [common] %s', config.items('common'))
     default_timeout = _common_conf_get(config.getint, "default_timeout", default_timeout)
+    connect_attempt_delay = _common_conf_get(config.getfloat, "connect_attempt_delay", connect_attempt_delay)
+    proxy_pool_size = _common_conf_get(config.getint, "proxy_pool_size", proxy_pool_size)
+    proxy_pool_idle_timeout = _common_conf_get(config.getint, "proxy_pool_idle_timeout", proxy_pool_idle_timeout)
+    http_pool_size = _common_conf_get(config.getint, "http_pool_size", http_pool_size)
+    http_pool_idle_timeout = _common_conf_get(config.getint, "http_pool_idle_timeout", http_pool_idle_timeout)
     hundred = _common_conf_get(config.getint, "hundred", hundred)
     proxy_idle_sec = _common_conf_get(config.getint, "proxy_idle_sec", proxy_idle_sec)
     proxys_check_timeout = _common_conf_get(config.getint, "proxys_check_timeout", proxys_check_timeout)
     retry_interval_on_error = _common_conf_get(config.getint, "retry_interval_on_error", retry_interval_on_error)
     close_on_idle_timeout = _common_conf_get(config.getint, "close_on_idle_timeout", close_on_idle_timeout)
+    fast_relay = _common_conf_get(config.getboolean, "fast_relay", fast_relay)
+    write_high_watermark = _common_conf_get(config.getint, "write_high_watermark", write_high_watermark)
+    write_low_watermark = _common_conf_get(config.getint, "write_low_watermark", write_low_watermark)
+    write_coalesce_bytes = _common_conf_get(config.getint, "write_coalesce_bytes", write_coalesce_bytes)
+    write_coalesce_delay = _common_conf_get(config.getfloat, "write_coalesce_delay", write_coalesce_delay)
+    proxy_head_delay = _common_conf_get(config.getfloat, "proxy_head_delay", proxy_head_delay)
     max_times_fail_rate = _common_conf_get(config.getint, "max_times_fail_rate", max_times_fail_rate)
     tp90_inc_threshold = _common_conf_get(config.getfloat, "tp90_inc_threshold", tp90_inc_threshold)
     global_tp90_threshold = _common_conf_get(config.getfloat, "global_tp90_threshold", global_tp90_threshold)
@@ -152,10 +251,26 @@ def load_tsproxy_conf(conf_file):
     auto_pause_fail_rate_threshold = _common_conf_get(config.getfloat, "auto_pause_fail_rate_threshold", auto_pause_fail_rate_threshold)
     tp90_expired_time = _common_conf_get(config.getint, "tp90_expired_time", tp90_expired_time)
     tp90_calc_count = _common_conf_get(config.getint, "tp90_calc_count", tp90_calc_count)
+    balance_mode = _common_conf_get(config.getint, "balance_mode", balance_mode)
+    balance_top_k = _common_conf_get(config.getint, "balance_top_k", balance_top_k)
 
     apnic_latest_url = _common_conf_get(config.get, "apnic_latest_url", apnic_latest_url)
     apnic_expired_days = _common_conf_get(config.getint, "apnic_expired_days", apnic_expired_days)
 
+    async_logging = _common_conf_get(config.getboolean, "async_logging", async_logging)
+    async_logging_batch = _common_conf_get(config.getint, "async_logging_batch", async_logging_batch)
+    crypto_offload_threshold = _common_conf_get(config.getint, "crypto_offload_threshold", crypto_offload_threshold)
+    crypto_offload_workers = _common_conf_get(config.getint, "crypto_offload_workers", crypto_offload_workers)
+    worker_sync_interval = _common_conf_get(config.getfloat, "worker_sync_interval", worker_sync_interval)
+    cache_max_entries = _common_conf_get(config.getint, "cache_max_entries", cache_max_entries)
+    route_cache_timeout = _common_conf_get(config.getint, "route_cache_timeout", route_cache_timeout)
+
+    dns_min_ttl = _common_conf_get(config.getint, "dns_min_ttl", dns_min_ttl)
+    dns_max_ttl = _common_conf_get(config.getint, "dns_max_ttl", dns_max_ttl)
+    dns_stale_ttl = _common_conf_get(config.getint, "dns_stale_ttl", dns_stale_ttl)
+    dns_prefetch_time = _common_conf_get(config.getint, "dns_prefetch_time", dns_prefetch_time)
+    dns_prefetch_hits = _common_conf_get(config.getint, "dns_prefetch_hits", dns_prefetch_hits)
+
     __network_errors = _common_conf_get(config.get, "network_errors", None)
     if __network_errors:
         network_errors.clear()
@@ -256,7 +371,9 @@ def is_speed_host(host=None):
     return False
 
 
-def forward_log(_logger, source_conn, dest_conn, data, loglevel=logging.NOTSET, max_len=80):
+def forward_log(_logger, source_conn, dest_conn, data, loglevel=5, max_len=80):
+    if not _logger.isEnabledFor(loglevel):
+        return
     if len(data) > max_len:
         _logger.log(loglevel, "forward %s to %s [%s ...%d]", source_conn, dest_conn, data[:max_len], len(data))
     else:
@@ -331,168 +448,248 @@ def hostname2short(hostname):
         return hostname
 
 
-class FIFOList(list):
-
-    @staticmethod
-    class TimedItem(dict):
-
-        def __init__(self, item=None, key=None, **kwargs):
-            self._key = key
-            if item:
-                super().__init__(_item_=item, _in_time_=time.time(), **kwargs)
-            else:
-                super().__init__(**kwargs)
-
-        @property
-        def _item(self):
-            if self._key:
-                return self._key(self['_item_'])
-            return self['_item_']
-
-        @property
-        def _in_time(self):
-            return self['_in_time_']
-
-        def __hash__(self):
-            return self._item.__hash__()
-
-        def __eq__(self, other):
-            return self._item.__eq__(other._item)
-
-        def __ge__(self, other):
-            return self._item.__ge__(other._item)
-
-        def __gt__(self, other):
-            return self._item.__gt__(other._item)
-
-        def __le__(self, other):
-            return self._item.__le__(other._item)
-
-        def __lt__(self, other):
-            return self._item.__lt__(other._item)
-
-        def __ne__(self, other):
-            return self._item.__ne__(other._item)
-
-        def __cmp__(self, other):
-            return self._item.__cmp__(other._item)
-
-        def __float__(self):
-            return float(self._item)
-
-        def __str__(self):
-            return self._item.__str__()
-
-        def __repr__(self):
-            return self._item.__repr__()
-
-        def __call__(self):
-            return self['_item_']
+class LogHistogram(object):
+    """
+    counts of the values in logarithmic buckets, add/remove are O(1) and the percentile walks the fixed buckets,
+    the percentile is the middle of its bucket, in the relative error of (growth - 1) / 2
+    """
 
-    def __init__(self, cache_timeout=3600, cache_count=100, item_key=None, *args):
-        list.__init__(self)
-        self._item_key = item_key
-        for item in args:
-            if item and isinstance(item, dict):
-                list.append(self, FIFOList.TimedItem(item=None, key=self._item_key, **item))
-        self._cache_timeout = cache_timeout
-        self._cache_count = cache_count
+    def __init__(self, min_value=0.001, max_value=3600, growth=1.02):
+        self._min_value = min_value
+        self._log_growth = math.log(growth)
+        # bucket 0: [0, min_value), bucket i: [min_value * growth^(i-1), min_value * growth^i)
+        self._counts = [0] * (self._index(max_value) + 1)
+        self._total = 0
+        self._percentiles = {}
 
-    def _check_timeout_(self):
-        try:
-            size = list.__len__(self)
-            while size > 0:
-                head = list.__getitem__(self, 0)
-                if (time.time() - head._in_time) > self._cache_timeout or (0 < self._cache_count < size):
-                    self.pop(0)
-                    size = list.__len__(self)
-                else:
+    def __len__(self):
+        return self._total
+
+    def _index(self, value):
+        if value < self._min_value:
+            return 0
+        return int(math.log(value / self._min_value) / self._log_growth) + 1
+
+    def add(self, value):
+        idx = min(self._index(value), len(self._counts) - 1)
+        self._counts[idx] += 1
+        self._total += 1
+        self._percentiles.clear()
+
+    def remove(self, value):
+        idx = min(self._index(value), len(self._counts) - 1)
+        if self._counts[idx] > 0:
+            self._counts[idx] -= 1
+            self._total -= 1
+            self._percentiles.clear()
+
+    def clear(self):
+        self._counts = [0] * len(self._counts)
+        self._total = 0
+        self._percentiles.clear()
+
+    def percentile(self, p):
+        """
+        :param p: percent, 90 for tp90
+        :return: the (int(count * (100-p) / 100) + 1)th largest value, 0.0 if empty
+        """
+        if p in self._percentiles:
+            return self._percentiles[p]
+        value = 0.0
+        if self._total > 0:
+            rank = int(self._total * (100 - p) / 100) + 1
+            count = 0
+            for idx in range(len(self._counts) - 1, -1, -1):
+                count += self._counts[idx]
+                if count >= rank:
+                    value = 0.0 if idx == 0 else self._min_value * math.exp(self._log_growth * (idx - 0.5))
                     break
-        except:
-            pass
-
-    def checkout(self, proxy_name):
-        try:
-            size = list.__len__(self)
-            idx = 0
-            while size > idx:
-                t = list.__getitem__(self, idx)
-                if not hasattr(t, '__call__'):
-                    continue
-                _t, _f, _n = t()
-                if _n.startswith(proxy_name):
-                    self.pop(idx)
-                    size = list.__len__(self)
-                else:
-                    idx += 1
-        except:
-            pass
+        self._percentiles[p] = value
+        return value
 
-    def append(self, item):
-        self._check_timeout_()
-        if item:
-            return list.append(self, FIFOList.TimedItem(item, key=self._item_key))
 
-    def insert(self, index, item):
-        self._check_timeout_()
-        if item:
-            return list.insert(self, index, FIFOList.TimedItem(item, key=self._item_key))
+class RankedList(object):
+    """
+    the items ordered by key(item) ascending, kept sorted by bisect on add/update/remove
+    instead of re-sorting all of the items, the key of an item is only recalculated on its update
+    """
 
-    def __iter__(self):
-        self._check_timeout_()
-        return list.__iter__(self)
+    def __init__(self, key):
+        self._key = key
+        self._entries = []
+        # id(item) -> (key, seq, item)
+        self._entry_of = {}
+        self._seq = 0
 
     def __len__(self):
-        self._check_timeout_()
-        return list.__len__(self)
+        return len(self._entries)
 
-    def __getitem__(self, index):
-        item = list.__getitem__(self, index)
-        return item._item
+    def __iter__(self):
+        return (entry[2] for entry in self._entries)
 
-    def __setitem__(self, index, item):
-        self._check_timeout_()
-        return list.__setitem__(self, index, FIFOList.TimedItem(item, key=self._item_key))
+    def __contains__(self, item):
+        return id(item) in self._entry_of
 
+    def first(self):
+        return self._entries[0][2] if self._entries else None
 
-class FIFOCache(dict):
+    def _insert(self, item, key):
+        # seq breaks the ties of the key, so the items are never compared
+        self._seq += 1
+        entry = (key, self._seq, item)
+        bisect.insort(self._entries, entry)
+        self._entry_of[id(item)] = entry
 
-    def __init__(self, cache_timeout=1800, lru=False, **kwargs):
-        dict.__init__(self, **kwargs)
-        self.keys_in_time = {}
-        self._lru = lru
+    def remove(self, item):
+        entry = self._entry_of.pop(id(item), None)
+        if entry is None:
+            return False
+        del self._entries[bisect.bisect_left(self._entries, entry)]
+        return True
+
+    def update(self, item):
+        """ re-rank the item(add it if not in), call it after the key of the item changed """
+        key = self._key(item)
+        entry = self._entry_of.get(id(item))
+        if entry is not None:
+            if entry[0] == key:
+                return
+            self.remove(item)
+        self._insert(item, key)
+
+    add = update
+
+    def rebuild(self):
+        """ recalculate the keys of all items """
+        items = [entry[2] for entry in self._entries]
+        self._entries = []
+        self._entry_of = {}
+        for item in items:
+            self._insert(item, self._key(item))
+
+
+class LRUCache(object):
+    """ bounded LRU cache with per-item timeout, get/set/evict are all O(1) """
+
+    def __init__(self, cache_timeout=1800, max_entries=None, refresh_on_get=False, name=None):
+        """
+        :param cache_timeout: seconds of item lifetime, None for never timeout
+        :param max_entries: max item count, None for common.cache_max_entries
+        :param refresh_on_get: reset the item lifetime on get
+        """
+        self._items = OrderedDict()  # key -> [value, expire_time, stale_time, hits]
         self.cache_timeout = cache_timeout
+        self._max_entries = max_entries
+        self._refresh_on_get = refresh_on_get
+        self.name = name
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_entries(self):
+        return self._max_entries if self._max_entries is not None else cache_max_entries
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.stale_hits + self.misses
+        return (self.hits + self.stale_hits) / total if total > 0 else 0.0
+
+    def stat_info(self):
+        return '%s: size=%d/%d hits=%d stale_hits=%d misses=%d(%.1f%%) evictions=%d' \
+               % (self.name, len(self._items), self.max_entries, self.hits, self.stale_hits, self.misses,
+                  self.hit_rate * 100, self.evictions)
+
+    def _get_item(self, key, stale=False):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= time.time():
+            if item[2] <= time.time():
+                del self._items[key]
+                return None
+            if not stale:
+                # expired but still in stale time, keep it for get_stale
+                return None
+        self._items.move_to_end(key)
+        if self._refresh_on_get and self.cache_timeout is not None:
+            item[1] = item[2] = time.time() + self.cache_timeout
+        item[3] += 1
+        return item
 
-    def _check_timeout(self, key):
-        if key in self.keys_in_time:
-            in_time = self.keys_in_time[key]
-            if (time.time() - in_time) >= self.cache_timeout:
-                del self[key]
-                return True
-        return False
+    def __len__(self):
+        return len(self._items)
 
     def __contains__(self, key):
-        c = dict.__contains__(self, key)
-        if c:
-            return not self._check_timeout(key)
-        return c
-
-    def __delitem__(self, key):
-        dict.__delitem__(self, key)
-        if key in self.keys_in_time:
-            del self.keys_in_time[key]
+        item = self._items.get(key)
+        if item is None:
+            return False
+        if item[1] is not None and item[1] <= time.time():
+            if item[2] <= time.time():
+                del self._items[key]
+            return False
+        return True
 
     def __getitem__(self, key):
-        value = dict.__getitem__(self, key)
-        if self._lru:
-            self.keys_in_time[key] = time.time()
+        item = self._get_item(key)
+        if item is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        return item[0]
+
+    def get(self, key, default=None):
+        item = self._get_item(key)
+        if item is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return item[0]
+
+    def get_stale(self, key):
+        """
+        get the item even if it is expired but still in the stale time
+        :return: (value, expire_in, hits) or None, expire_in <= 0 means the value is stale
+        """
+        item = self._get_item(key, stale=True)
+        if item is None:
+            self.misses += 1
+            return None
+        expire_in = item[1] - time.time() if item[1] is not None else None
+        if expire_in is not None and expire_in <= 0:
+            self.stale_hits += 1
         else:
-            self._check_timeout(key)
-        return value
+            self.hits += 1
+        return item[0], expire_in, item[3]
 
     def __setitem__(self, key, value):
-        dict.__setitem__(self, key, value)
-        self.keys_in_time[key] = time.time()
+        self.set(key, value)
+
+    def set(self, key, value, timeout=None, stale_timeout=0):
+        """
+        :param timeout: seconds of the item lifetime, None for cache_timeout
+        :param stale_timeout: seconds of the expired item can still be got by get_stale
+        """
+        if timeout is None:
+            timeout = self.cache_timeout
+        expire_time = time.time() + timeout if timeout is not None else None
+        self._items[key] = [value, expire_time, expire_time + stale_timeout if expire_time is not None else None, 0]
+        self._items.move_to_end(key)
+        max_entries = self.max_entries
+        while len(self._items) > max_entries > 0:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def __delitem__(self, key):
+        del self._items[key]
+
+    def pop(self, key, default=None):
+        item = self._items.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        self._items.clear()
 
 
 class MyThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
@@ -592,42 +789,300 @@ class MyThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
                 logger.info('%s WORK DONE with %s: %s', threading.current_thread().name, clazz_fullname(ex), ex)
 
 
-def forward_forever(connection, peer_conn, is_responsed=False, stop_func=None, on_data_recv=None, on_idle=None) -> (bytes, float):
+class IdleSweeper(object):
+    """ one timer per loop checks the idle of all the forwarding connections, instead of a read timeout per connection """
+
+    def __init__(self, interval=1, loop=None):
+        self._interval = interval
+        self._loop = loop if loop else asyncio.get_event_loop()
+        self._watches = {}
+        self._timer = None
+
+    def __len__(self):
+        return len(self._watches)
+
+    def add(self, reader, check):
+        """ :param check: check() returns True if the reader should be woken up by asyncio.TimeoutError """
+        self._watches[reader] = check
+        if self._timer is None:
+            self._timer = self._loop.call_later(self._interval, self._sweep)
+
+    def remove(self, reader):
+        self._watches.pop(reader, None)
+        if not self._watches and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _sweep(self):
+        self._timer = None
+        for reader, check in list(self._watches.items()):
+            try:
+                if check():
+                    reader.wakeup(asyncio.TimeoutError())
+            except Exception as ex:
+                logger.exception("sweep %s %s: %s", reader, clazz_fullname(ex), ex)
+        if self._watches:
+            self._timer = self._loop.call_later(self._interval, self._sweep)
+
+
+_idle_sweepers = {}
+
+
+def get_idle_sweeper(loop=None) -> IdleSweeper:
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    sweeper = _idle_sweepers.get(loop)
+    if sweeper is None:
+        sweeper = IdleSweeper(loop=loop)
+        _idle_sweepers[loop] = sweeper
+    return sweeper
+
+
+_crypto_executor = None
+
+
+def get_crypto_executor() -> MyThreadPoolExecutor:
+    """ the threads of the offloaded en/decryption, the openssl/libsodium ciphers release the GIL """
+    global _crypto_executor
+    if _crypto_executor is None:
+        _crypto_executor = MyThreadPoolExecutor(max_workers=max(1, crypto_offload_workers), pool_name='crypto')
+    return _crypto_executor
+
+
+class AsyncLogWriter(object):
+    """
+    formats and writes the records of AsyncLogHandler in a background thread, batched per handler,
+    the thread wakes up every interval seconds, or once batch_size records are waiting
+    """
+
+    def __init__(self, batch_size=256, interval=0.1):
+        self.batch_size = batch_size
+        self.interval = interval
+        # deque.append is thread safe and cheaper than queue.Queue.put for the event loop
+        self._records = deque()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, handlers, record):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='async-logging', daemon=True)
+                    self._thread.start()
+        elif not self._thread.is_alive():
+            # the writer is gone, the records would pile up in the deque
+            for handler in handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            return
+        self._records.append((handlers, record))
+        if len(self._records) >= self.batch_size:
+            self._wakeup.set()
+
+    def flush(self, timeout=5):
+        """ wait the records put before are written """
+        if self._thread is None or threading.current_thread() is self._thread:
+            return
+        done = threading.Event()
+        self._records.append((None, done))
+        self._wakeup.set()
+        done.wait(timeout)
+
+    def _run(self):
+        records = self._records
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            while records:
+                batch = []
+                try:
+                    while len(batch) < self.batch_size:
+                        batch.append(records.popleft())
+                except IndexError:
+                    pass
+                try:
+                    self._write(batch)
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+
+    def _write(self, batch):
+        # handler -> records, in the order of the handlers first seen
+        records_of = OrderedDict()
+        flush_events = []
+        for handlers, record in batch:
+            if handlers is None:
+                flush_events.append(record)
+                continue
+            for handler in handlers:
+                if handler in records_of:
+                    records_of[handler].append(record)
+                else:
+                    records_of[handler] = [record]
+        try:
+            for handler, records in records_of.items():
+                self._write_records(handler, records)
+        finally:
+            for done in flush_events:
+                done.set()
+
+    @staticmethod
+    def _write_records(handler, records):
+        records = [r for r in records if r.levelno >= handler.level and handler.filter(r)]
+        if not records:
+            return
+        if not isinstance(handler, logging.StreamHandler):
+            for record in records:
+                try:
+                    handler.handle(record)
+                except Exception:
+                    handler.handleError(record)
+            return
+        # a record fails to format(bad args) is reported alone, the others are still written
+        formatted = []
+        for record in records:
+            try:
+                formatted.append((record, handler.format(record) + handler.terminator))
+            except Exception:
+                handler.handleError(record)
+        if not formatted:
+            return
+        handler.acquire()
+        try:
+            if isinstance(handler, logging.handlers.BaseRotatingHandler) and handler.shouldRollover(formatted[0][0]):
+                handler.doRollover()
+            if handler.stream is None:
+                # FileHandler(delay=True)
+                handler.stream = handler._open()
+            handler.stream.write(''.join([line for _, line in formatted]))
+            handler.flush()
+        except Exception:
+            handler.handleError(formatted[0][0])
+        finally:
+            handler.release()
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    puts the records to the AsyncLogWriter for the handlers it replaced,
+    the message is formatted in the writer thread, so the args should not be changed after logged
+    """
+
+    def __init__(self, handlers, writer):
+        super().__init__(min(h.level for h in handlers))
+        self.handlers = tuple(handlers)
+        self.writer = writer
+
+    def handle(self, record):
+        # emit is thread safe, needs no lock of the handler
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        if record.exc_info:
+            # the traceback can't wait for the writer
+            if not record.exc_text:
+                record.exc_text = _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        self.writer.put(self.handlers, record)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.flush()
+        super().close()
+
+
+_exc_formatter = logging.Formatter()
+_async_log_writer = None
+
+
+def start_async_logging():
+    """ replace the handlers of the configured loggers with AsyncLogHandler, call it after logging.config.fileConfig """
+    global _async_log_writer
+    if _async_log_writer is None:
+        _async_log_writer = AsyncLogWriter(async_logging_batch)
+    _async_log_writer.batch_size = async_logging_batch
+    loggers = [logging.getLogger()] + [_logger for _logger in logging.Logger.manager.loggerDict.values()
+                                       if isinstance(_logger, logging.Logger)]
+    for _logger in loggers:
+        if not _logger.handlers or any(isinstance(h, AsyncLogHandler) for h in _logger.handlers):
+            continue
+        handlers = list(_logger.handlers)
+        for h in handlers:
+            _logger.removeHandler(h)
+        _logger.addHandler(AsyncLogHandler(handlers, _async_log_writer))
+
+
+def forward_forever(connection, peer_conn, is_responsed=False, stop_func=None, on_data_recv=None, on_idle=None, stop_after=None, keep_peer=None) -> (bytes, float):
+    """
+    :param stop_func: stop_func(data) returns True to stop before forwarding the data
+    :param stop_after: stop_after(data) returns True to stop after forwarding the data, it is asked with None when the read woken up
+    :param keep_peer: keep_peer(connection) returns True not to close peer_conn when no response, it's handled by the peer
+    """
     idle_count = 0
-    # idle_start = time.time()
+    # the idle periods(default_timeout seconds per period) checked
+    idle_checked = [0]
     first_response_time = None
+    relaying = False
+
+    def _check_idle():
+        idle_time = connection.idle_time
+        idle_periods = int(idle_time // default_timeout)
+        if idle_periods < idle_checked[0]:
+            # active again since the last check
+            idle_checked[0] = idle_periods
+        return idle_time > close_on_idle_timeout or peer_conn.is_closing or idle_periods > idle_checked[0]
+
+    # read without timeout, the sweeper wakes up the read if the idle needs checking
+    sweeper = get_idle_sweeper(connection.reader._loop)
+    sweeper.add(connection.reader, _check_idle)
     while True:
         data = None  # type: bytes
         try:
-            data = yield from connection.reader.read(read_timeout=1)
+            data = yield from connection.reader.read(read_timeout=None)
             if data and not peer_conn.is_closing and (stop_func is None or not stop_func(data)):
                 if on_data_recv:
                     on_data_recv(data)
                 if first_response_time is None:
                     first_response_time = time.time()
                 is_responsed = True
-                peer_conn.writer.write(data)
-                yield from peer_conn.writer.drain()
+                peer_conn.writer.forward_write(data, connection.reader)
                 forward_log(logger, connection, peer_conn, data)
-                # idle_start = time.time()
                 idle_count = 0
+                idle_checked[0] = 0
+                if stop_after is not None:
+                    if stop_after(data):
+                        break
+                elif not relaying and stop_func is None:
+                    # the rest is relayed by the protocol if it needs no transformation,
+                    # this loop is only for the idle checking and eof
+                    relaying = connection.relay_to(peer_conn, on_data=on_data_recv)
             else:
                 break
         except asyncio.TimeoutError:
-            idle_time = connection.idle_time  # time.time() - idle_start
+            if stop_after is not None and stop_after(None):
+                break
+            idle_time = connection.idle_time
             if idle_time > close_on_idle_timeout:
                 logger.debug("%s going to close for idle#%d timeout %.0f seconds", connection, idle_count, idle_time)
+                metrics.forward_closes.inc('idle_timeout')
                 break
             if peer_conn.is_closing:
                 logger.debug("%s going to close for peer %s is closing", connection, peer_conn)
                 break
-            _idle_count = int(idle_time) % default_timeout
-            if _idle_count != 0 or idle_time < 1:  # idle_time 接近1但<1时，int()直接截成0，使 _idle_count == 0，故增加条件 idle_time < 1
-                # logger.log(5, "%s idle#%d.%d for %.1f second", connection, idle_count, _idle_count, idle_time)
+            idle_periods = int(idle_time // default_timeout)
+            if idle_periods <= idle_checked[0]:
+                # checked already in this idle period
                 continue
+            idle_checked[0] = idle_periods
             if not is_responsed:
-                logger.info("%s response timeout %f seconds [#%d]", connection, idle_time, _idle_count)
+                logger.info("%s response timeout %f seconds [#%d]", connection, idle_time, idle_periods)
                 connection.response_timeout = True
+                metrics.forward_closes.inc('response_timeout')
                 break
             else:
                 if on_idle is None or on_idle(connection, peer_conn, is_responsed):
@@ -648,7 +1103,10 @@ def forward_forever(connection, peer_conn, is_responsed=False, stop_func=None, o
         except BaseException as ex:
             logger.exception("forward_forever(%s) %s: %s", connection, clazz_fullname(ex), ex)
             break
-    if not is_responsed:
+    sweeper.remove(connection.reader)
+    if relaying:
+        connection.reader.stop_relay()
+    if not is_responsed and (keep_peer is None or not keep_peer(connection)):
         peer_conn.close()
     return data, first_response_time
 
@@ -1,5 +1,8 @@
 import asyncio
+import collections
 import errno
+import functools
+import itertools
 import logging
 import os
 import socket
@@ -8,11 +11,19 @@ import time
 import yaml
 
 import tsproxy.proxy
-from tsproxy import common, streams, topendns
+from tsproxy import common, metrics, streams, topendns
+from tsproxy import httphelper2 as httphelper
 
 
 logger = logging.getLogger(__name__)
 
+# the routing decisions per destination, keyed with the generation of what decided them(router.yaml, the paused
+# rules, the cn ip list), so a decision is never hit after its generation changed and ages out of the LRU
+route_cache = metrics.register_cache(common.LRUCache(name='route_cache'))
+
+# [proxy(None for the direct), counted] of a connection counted in Proxy.conn_count and the active_connections
+ACTIVE_COUNTER = 'connector.ACTIVE_COUNTER'
+
 
 class Connector(object):
 
@@ -34,9 +45,38 @@ class Connector(object):
         peer.proxy_info = '%s->(%d-%s%s#%d)' % (client, conn.lport, proxyto, host, conn.fileno)
         conn.target_host = peer.target_host = addr
 
+    @staticmethod
+    def _http_keepalive_key(request, route, proxy_hostname, target_host, target_port):
+        """ the key of the http pool if the connection is for the plain http request, else None """
+        if common.http_pool_size <= 0 or request is None or request.method == common.HTTPS_METHOD_CONNECT:
+            return None
+        return route, proxy_hostname, target_host, target_port
+
+    @staticmethod
+    def _count_active(connection, proxy=None):
+        """ count the connection as an active one of proxy(None for the direct) until it's closed """
+        connection.set_attr(ACTIVE_COUNTER, [proxy, False])
+        set_active(connection, True)
+        connection.add_close_callback(functools.partial(set_active, connection, False))
+
+    def _reuse(self, keepalive_key, peer, target_host, target_port, proxy=None) -> streams.StreamConnection:
+        """ :return: a kept-alive connection of keepalive_key in the http pool, None if not found """
+        if keepalive_key is None:
+            return None
+        connection = get_http_pool(self._loop).acquire(keepalive_key, peer)
+        if connection is not None:
+            # the response time is counted from the reuse
+            connection.create_time = time.time()
+            connection.set_attr(tsproxy.proxy.PEER_CONNECTION, peer)
+            if proxy is not None:
+                peer.set_attr(tsproxy.proxy.PROXY_NAME, proxy.short_hostname)
+            self._set_proxy_info(connection, target_host, target_port, peer, proxy)
+            logger.debug('%s reused from the http pool', connection)
+        return connection
+
     @asyncio.coroutine
     def _connect(self, handler, peer, ip, port, host=None, loop=None,
-                 encoder=None, decoder=None, init_coro=None, connect_timeout=common.default_timeout, **kwargs) -> streams.StreamConnection:
+                 encoder=None, decoder=None, init_coro=None, connect_timeout=common.default_timeout, keepalive_key=None, **kwargs) -> streams.StreamConnection:
 
         init_done = asyncio.Event()
         init_ex = None
@@ -44,21 +84,30 @@ class Connector(object):
         @asyncio.coroutine
         def _handler_wrapper(_conn):
             yield from init_done.wait()
-            if init_ex is None:
-                yield from handler(_conn, peer)
+            _peer = peer if init_ex is None else None
+            while _peer is not None:
+                yield from handler(_conn, _peer)
+                # the kept-alive connection waits in the http pool for the next peer
+                _peer = yield from get_http_pool(self._loop).park(_conn)
 
         # kwargs.setdefault('local_dns', False)
+        connection = None
         try:
             with common.Timeout(connect_timeout):
                 connection = yield from streams.start_connection(_handler_wrapper, ip, port, host=host, loop=loop,
                                                                  encoder=encoder, decoder=decoder, connect_timeout=connect_timeout, **kwargs)
                 connection.set_attr(tsproxy.proxy.PEER_CONNECTION, peer)
+                if keepalive_key is not None:
+                    get_http_pool(self._loop).track(connection, keepalive_key)
                 if init_coro:
                     res = init_coro(connection)
                     if asyncio.coroutines.iscoroutine(res):
                         yield from res
-        except Exception as _init_ex:
+        except BaseException as _init_ex:
             init_ex = _init_ex
+            if connection is not None:
+                # init fail or cancelled(lose the race of _staggered_connect)
+                connection.close()
             if isinstance(init_ex, socket.gaierror):
                 raise socket.gaierror(common.errno_from_exception(init_ex), 'Dns query(%s) fail' % host) from init_ex
             else:
@@ -67,6 +116,60 @@ class Connector(object):
             init_done.set()
         return connection
 
+    @asyncio.coroutine
+    def _staggered_connect(self, connect_ip, ips, on_fail=None, loop=None):
+        """
+        connect to ips in the style of RFC 8305(happy eyeballs): start the next attempt if the previous one
+        does not finish in common.connect_attempt_delay or fails, the first connected wins and the others are cancelled
+        :param connect_ip: coroutine function(ip) -> connection
+        :param ips: the failed ip is moved to the tail of it
+        :param on_fail: function(ip, ex, used, is_last) called on every failed attempt
+        """
+        if loop is None:
+            loop = self._loop
+        attempt_ips = list(ips)
+        attempts = {}  # task -> (ip, start_time)
+        next_index = 0
+        winner = None
+        last_ex = None
+
+        def _close_late_winner(_task):
+            if not _task.cancelled() and _task.exception() is None:
+                _task.result().close()
+
+        try:
+            while winner is None:
+                if next_index < len(attempt_ips):
+                    ip = attempt_ips[next_index]
+                    next_index += 1
+                    attempts[asyncio.ensure_future(connect_ip(ip), loop=loop)] = (ip, time.time())
+                if not attempts:
+                    break
+                done, _ = yield from asyncio.wait(list(attempts.keys()), loop=loop, return_when=asyncio.FIRST_COMPLETED,
+                                                  timeout=common.connect_attempt_delay if next_index < len(attempt_ips) else None)
+                for task in done:
+                    ip, start_time = attempts.pop(task)
+                    ex = task.exception()
+                    if ex is None:
+                        if winner is None:
+                            winner = task.result()
+                        else:
+                            _close_late_winner(task)
+                        continue
+                    last_ex = ex
+                    if ip in ips:
+                        ips.remove(ip)
+                        ips.append(ip)
+                    if on_fail:
+                        on_fail(ip, ex, time.time() - start_time, not attempts and next_index >= len(attempt_ips))
+        finally:
+            for task in attempts:
+                task.cancel()
+                task.add_done_callback(_close_late_winner)
+        if winner is None:
+            raise last_ex if last_ex else ConnectionError('no address to connect')
+        return winner
+
 
 class DirectConnector(Connector):
 
@@ -76,14 +179,32 @@ class DirectConnector(Connector):
 
     @asyncio.coroutine
     def connect(self, peer, target_host, target_port, proxy_name=None, loop=None, **kwargs) -> streams.StreamConnection:
+        keepalive_key = self._http_keepalive_key(kwargs.get('request'), proxy_name, self._proxy.short_hostname, target_host, target_port)
+        connection = self._reuse(keepalive_key, peer, target_host, target_port) if kwargs.pop('reuse', True) else None
+        if connection is not None:
+            return connection
         dns_start_time = time.time()
-        target_ip = yield from topendns.async_dns_query(target_host, raise_on_fail=True, local_dns=True, loop=loop)
+        target_ips = yield from topendns.async_dns_query(target_host, raise_on_fail=True, local_dns=True, ex_func=True, loop=loop)
         dns_used = time.time() - dns_start_time
         connect_timeout = kwargs.pop('connect_timeout', common.default_timeout)
         if dns_used > connect_timeout:
             raise asyncio.TimeoutError('DirectConnector.connect() timeout, async_dns_query used %.3f seconds' % dns_used)
 
-        connection = yield from super()._connect(self._proxy, peer, target_ip, target_port, host=target_host, loop=loop, connect_timeout=(connect_timeout-dns_used), **kwargs)
+        def _connect_ip(target_ip):
+            return self._connect(self._proxy, peer, target_ip, target_port, host=target_host, loop=loop, connect_timeout=(connect_timeout-dns_used),
+                                 keepalive_key=keepalive_key, **kwargs)
+
+        def _on_fail(target_ip, ex, used, is_last):
+            if not is_last:
+                logger.info('connect to %s/%s failed(%.1fs): %s', target_host, target_ip, used, ex)
+
+        try:
+            connection = yield from self._staggered_connect(_connect_ip, target_ips, on_fail=_on_fail, loop=loop)
+        except Exception:
+            metrics.connect_failures.inc('D')
+            raise
+        metrics.connect_time.observe(time.time() - dns_start_time - dns_used, 'D')
+        self._count_active(connection)
         self._set_proxy_info(connection, target_host, target_port, peer)
         return connection
 
@@ -95,7 +216,7 @@ class ProxyConnector(Connector):
         self.proxy_holder = proxy_holder
 
     @asyncio.coroutine
-    def _connect_proxy(self, proxy, peer, target_host, target_port, connect_timeout, loop=None, speed_test_ip=None, speedup_ip=None, **kwargs):
+    def _connect_proxy(self, proxy, peer, target_host, target_port, connect_timeout, loop=None, speed_test_ip=None, speedup_ip=None, keepalive_key=None, **kwargs):
 
         @asyncio.coroutine
         def _init_core(_conn):
@@ -130,38 +251,52 @@ class ProxyConnector(Connector):
         if left_time <= 0:
             raise asyncio.TimeoutError('ProxyConnector._connect_proxy() timeout, async_dns_query used %.3f seconds' % dns_used)
 
-        left_time = left_time / len(proxy_ips)
-        for i in range(0, len(proxy_ips)):
-            proxy_ip = proxy_ips[0]
-            _start = time.time()
+        def _connect_ip(proxy_ip):
             logger.debug('connecting to proxy(%s/%s:%d) for (%s->%s:%d)', proxy_host, proxy_ip, proxy_port, peer, target_host, target_port)
-            try:
-                proxy_conn = yield from super()._connect(proxy, peer, proxy_ip, proxy_port, host=proxy_host, loop=loop,
-                                                         encoder=None if not hasattr(proxy, 'encoder') else proxy.encoder,
-                                                         decoder=None if not hasattr(proxy, 'decoder') else proxy.decoder,
-                                                         init_coro=_init_core, connect_timeout=left_time, **kwargs)
-                self._set_proxy_info(proxy_conn, target_host, target_port, peer, proxy)
-                return proxy_conn
-            except BaseException as ex:
-                err_no = common.errno_from_exception(ex)
-                if err_no not in common.network_errors \
-                        and i + 1 < len(proxy_ips) > 1 and left_time > 0:
-                    proxy.update_proxy_stat(None, time.time() - _start, target_host=target_host, proxy_ip=proxy_ip,
-                                            loginfo='_connect failed(%s)' % ('timeout[%.1fs]' % left_time if isinstance(ex, asyncio.TimeoutError) or isinstance(ex, TimeoutError) else ex), proxy_fail=True, **kwargs)
-                    _ip = proxy_ips.pop(0)
-                    proxy_ips.append(_ip)
-                    logger.info('connect to %s/%s failed: %s, try next ip(%s/%s) try again...', proxy_host, proxy_ip, ex, proxy_host, proxy_ips[0])
-                    continue
-                else:
-                    ex.__dict__['__proxy_ip__'] = proxy_ip
-                    raise ex
-            finally:
-                if ip_changed:
-                    self.proxy_holder.check(proxy, common.KEY_IP_CHANGED)
+            return self._connect(proxy, peer, proxy_ip, proxy_port, host=proxy_host, loop=loop,
+                                 encoder=None if not hasattr(proxy, 'encoder') else proxy.encoder,
+                                 decoder=None if not hasattr(proxy, 'decoder') else proxy.decoder,
+                                 init_coro=_init_core, connect_timeout=left_time, keepalive_key=keepalive_key, **kwargs)
+
+        def _on_fail(proxy_ip, ex, used, is_last):
+            if is_last:
+                # the caller updates the proxy stat with it
+                ex.__dict__['__proxy_ip__'] = proxy_ip
+            elif common.errno_from_exception(ex) not in common.network_errors:
+                proxy.update_proxy_stat(None, used, target_host=target_host, proxy_ip=proxy_ip,
+                                        loginfo='_connect failed(%s)' % ('timeout[%.1fs]' % left_time if isinstance(ex, asyncio.TimeoutError) or isinstance(ex, TimeoutError) else ex), proxy_fail=True, **kwargs)
+                logger.info('connect to %s/%s failed: %s, other ips of %s are trying ...', proxy_host, proxy_ip, ex, proxy_host)
+
+        try:
+            proxy_conn = None
+            if speed_test_ip is None:
+                pooled_sock, pooled_ip = proxy.sock_pool.acquire(proxy_ips)
+                proxy.sock_pool.refill(proxy_ips, loop=loop)
+                if pooled_sock is not None:
+                    try:
+                        proxy_conn = yield from self._connect(proxy, peer, pooled_ip, proxy_port, host=proxy_host, loop=loop,
+                                                              encoder=None if not hasattr(proxy, 'encoder') else proxy.encoder,
+                                                              decoder=None if not hasattr(proxy, 'decoder') else proxy.decoder,
+                                                              init_coro=_init_core, connect_timeout=left_time, sock=pooled_sock,
+                                                              keepalive_key=keepalive_key, **kwargs)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as ex:
+                        # the pooled socket may be closed by the proxy server silently, connect a new one
+                        logger.debug('init pooled connection to %s/%s fail: %s(%s)', proxy_host, pooled_ip, common.clazz_fullname(ex), ex)
+            if proxy_conn is None:
+                proxy_conn = yield from self._staggered_connect(_connect_ip, proxy_ips, on_fail=_on_fail, loop=loop)
+            metrics.connect_time.observe(time.time() - start_time - dns_used, proxy.short_hostname)
+            self._set_proxy_info(proxy_conn, target_host, target_port, peer, proxy)
+            return proxy_conn
+        finally:
+            if ip_changed:
+                self.proxy_holder.check(proxy, common.KEY_IP_CHANGED)
 
     @asyncio.coroutine
     def connect(self, peer, target_host, target_port, proxy_name=None, loop=None, **kwargs) -> streams.StreamConnection:
         speed_test_ip = kwargs.pop('speed_test_ip', None)
+        reuse = kwargs.pop('reuse', True)
         timeout = time.time() + kwargs.pop('connect_timeout', common.default_timeout)
         proxy_count = self.proxy_holder.psize
         if proxy_count <= 0:
@@ -170,6 +305,7 @@ class ProxyConnector(Connector):
         for i in range(0, proxy_count):
             proxy = None  # type: tsproxy.proxy.Proxy
             speedup_ip = None
+            balanced = False
             left_time = timeout - time.time()
             if proxy_name is not None:
                 if i > 0:
@@ -182,6 +318,9 @@ class ProxyConnector(Connector):
                     proxy, speedup_ip = self.proxy_holder.try_speedup_proxy(target_host)
                 if proxy is None:
                     proxy = self.proxy_holder.head_proxy
+                    if i == 0 and speed_test_ip is None:
+                        proxy = self.proxy_holder.balance_proxy()
+                        balanced = proxy is not self.proxy_holder.head_proxy
                 if (proxy_count - i) > 1:
                     # 每次的超时时间留一半给下一个proxy进行尝试
                     left_time /= 2
@@ -189,20 +328,30 @@ class ProxyConnector(Connector):
                 break
             elif left_time < 1:
                 left_time = 1
+            keepalive_key = None
+            if speed_test_ip is None and isinstance(proxy, tsproxy.proxy.HttpProxy):
+                keepalive_key = self._http_keepalive_key(kwargs.get('request'), proxy_name, proxy.short_hostname, target_host, target_port)
+                proxy_conn = self._reuse(keepalive_key, peer, target_host, target_port, proxy) if reuse else None
+                if proxy_conn is not None:
+                    proxy_conn.set_attr('Proxy-Name', proxy_name)
+                    return proxy_conn
             try:
-                proxy_conn = yield from self._connect_proxy(proxy, peer, target_host, target_port, left_time, loop=loop, speed_test_ip=speed_test_ip, speedup_ip=speedup_ip, proxy_name=proxy_name, **kwargs)
+                proxy_conn = yield from self._connect_proxy(proxy, peer, target_host, target_port, left_time, loop=loop, speed_test_ip=speed_test_ip, speedup_ip=speedup_ip,
+                                                            keepalive_key=keepalive_key, proxy_name=proxy_name, **kwargs)
                 proxy_conn.set_attr('Proxy-Name', proxy_name)
                 proxy.error_count = 0
+                self._count_active(proxy_conn, proxy)
                 return proxy_conn
             except BaseException as ex1:
                 connect_ex = ex1
+                metrics.connect_failures.inc(proxy.short_hostname)
                 logger.debug("connect to proxy(%s:%d) for (%s, %s, %s) %s: %s",
                              proxy.hostname, proxy.port, peer, target_host, target_port, common.clazz_fullname(ex1), ex1)
                 # move the head to tail
                 used = time.time()-timeout+common.default_timeout
                 err_no = common.errno_from_exception(ex1)
                 if err_no not in common.network_errors:
-                    if proxy_name is not None or speedup_ip is not None \
+                    if proxy_name is not None or speedup_ip is not None or balanced \
                             or self.proxy_holder.move_head_to_tail(proxy, logging.WARNING, 'connect %s: %s', common.clazz_fullname(ex1), ex1):
                         proxy.error_time = time.time()
                         proxy.error_count += 1
@@ -259,16 +408,293 @@ class SmartConnector(Connector):
             #     elif topendns.is_cn_domain(target_host):
             #         connector = self.direct_connector
             # if connector is None:
-            if atype == 0x03:
-                ip = yield from topendns.async_dns_query(target_host, loop=self._loop)
-            else:
-                ip = target_host
-            if ip is not None and topendns.is_cn_ip(0x01 if topendns.is_ipv4(ip) else 0x04, ip):
+            if (yield from self._is_cn(target_host, atype)):
                 connector = self.direct_connector
             else:
                 connector = self.proxy_connector
         return (yield from connector.connect(peer, target_host, target_port, proxy_name, loop, **kwargs))
 
+    @asyncio.coroutine
+    def _is_cn(self, target_host, atype):
+        """ whether the ip of target_host is in china, cached until the cn ip list reloaded """
+        topendns.load_cn_list()
+        key = ('cn', topendns.cn_ip_file_mod, target_host)
+        is_cn = route_cache.get(key) if common.route_cache_timeout > 0 else None
+        if is_cn is not None:
+            return is_cn
+        if atype == 0x03:
+            ip = yield from topendns.async_dns_query(target_host, loop=self._loop)
+        else:
+            ip = target_host
+        if ip is None:
+            return False
+        is_cn = topendns.is_cn_ip(0x01 if topendns.is_ipv4(ip) else 0x04, ip)
+        if common.route_cache_timeout > 0:
+            route_cache.set(key, is_cn, timeout=common.route_cache_timeout)
+        return is_cn
+
+
+_route_generations = itertools.count(1)
+
+RouteFacts = collections.namedtuple('RouteFacts', ['url', 'scheme', 'hostname', 'port', 'path', 'method', 'connect'])
+
+
+def _route_facts(request):
+    """ the lowered request fields matched by the router rules """
+    url = request.url
+    return RouteFacts(url.full_url.lower(), (url.scheme or '').lower(), (url.hostname or '').lower(), url.port,
+                      (url.path or '').lower(), request.method.lower(), request.method == common.HTTPS_METHOD_CONNECT)
+
+
+def _match_url(k, v, request, connection, facts):
+    return facts.url.startswith(v)
+
+
+def _match_protocol(k, v, request, connection, facts):
+    if v == 'HTTPS':
+        return facts.connect
+    elif v == 'HTTP':
+        return facts.scheme == 'http'
+    return False
+
+
+def _match_host(k, v, request, connection, facts):
+    c, v = v
+    if c == 's':
+        return facts.hostname.endswith(v)
+    elif c == 'p':
+        return facts.hostname.startswith(v)
+    return v in facts.hostname
+
+
+def _match_port(k, v, request, connection, facts):
+    return facts.port == v
+
+
+def _match_path(k, v, request, connection, facts):
+    return facts.path.startswith(v)
+
+
+def _match_method(k, v, request, connection, facts):
+    return facts.method == v
+
+
+def _match_app(k, v, request, connection, facts):
+    return 'process_name' in connection and connection['process_name'] == v
+
+
+def _match_header(k, v, request, connection, facts):
+    return k in request.headers and v in request.headers[k].lower()
+
+
+_ROUTE_MATCHERS = {
+    'url': _match_url,
+    'protocol': _match_protocol,
+    'host': _match_host,
+    'port': _match_port,
+    'path': _match_path,
+    'method': _match_method,
+    'app': _match_app,
+}
+
+
+def _compile_route_value(k, v):
+    """ the value of the condition k in the form its matcher compares """
+    if k == 'port':
+        return v if isinstance(v, int) else int(v)
+    elif k == 'protocol':
+        return str(v).upper()
+    elif k == 'host':
+        c = 's'  # p,k,s,r分别表示 prefix (前缀)，keyword(关键词),suffix(后缀),regex(正则表达式/暂不支持)
+        v = str(v).lower()
+        if ',' in v:
+            c, v = v.split(',', 1)
+        return c, v
+    elif k == 'app':
+        return v
+    return str(v).lower()
+
+
+class RouterRule(object):
+    """ a router entry compiled with the conditions of its match_con """
+
+    __slots__ = ('index', 'name', 'to', 'conditions', 'with_in', 'with_out')
+
+    def __init__(self, index, name, to, con):
+        self.index = index
+        self.name = name
+        self.with_in = self.with_out = None
+        # to support with_in/with_out verb 2019.4.16
+        if isinstance(to, dict):
+            if 'with_in' in to:
+                self.with_in = self._ipmask_list(to['with_in'])
+            elif 'with_out' in to:
+                self.with_out = self._ipmask_list(to['with_out'])
+            to = to['to']
+        self.to = to
+        # [(key, matcher, [(negative, value), ...]), ...]
+        self.conditions = []
+        for k in con:
+            values = con[k] if isinstance(con[k], list) else [con[k]]
+            compiled = []
+            for v in values:
+                negative = isinstance(v, str) and v[:1] == '!'
+                compiled.append((negative, _compile_route_value(k, v[1:] if negative else v)))
+            self.conditions.append((k, _ROUTE_MATCHERS.get(k, _match_header), compiled))
+
+    @staticmethod
+    def _ipmask_list(_with):
+        return [ipmask for ipmask in (_with if isinstance(_with, list) else [_with]) if ipmask[1] is not None]
+
+    def positive_values(self, k):
+        """ :return: the values of the condition k if it matches any of them(no negative value), else None """
+        for key, _, values in self.conditions:
+            if key == k:
+                if not values or any(negative for negative, _ in values):
+                    return None
+                return [v for _, v in values]
+        return None
+
+    def match(self, request, connection, facts):
+        for k, matcher, values in self.conditions:
+            _m = False
+            for negative, v in values:
+                _m = matcher(k, v, request, connection, facts) != negative
+                # the first positive value matched or negative value unmatched decides
+                if _m != negative:
+                    break
+            if not _m:
+                return False
+        return True
+
+
+class RouterTable(object):
+    """
+    the router.yaml compiled for the lookup: every rule is indexed by one of its positive conditions,
+    the host suffixes in a reversed-label trie, the url/path prefixes in a table per prefix length,
+    the ports/methods/protocols in the sets, so a request is matched against the candidate rules only
+    """
+
+    # the order to choose the condition a rule is indexed by
+    INDEX_KEYS = ('host', 'url', 'path', 'port', 'method', 'protocol')
+    # the conditions decided by the destination(host, port, app) and the protocol only
+    DESTINATION_KEYS = ('host', 'port', 'app', 'protocol')
+
+    def __init__(self, conf):
+        self.default = conf.get('default')
+        self.rules = []
+        self.pauses = {}
+        # changed with the paused rules, the decisions of the older generation are stale
+        self.generation = next(_route_generations)
+        # _by_destination[i]: the rules[0..i] are all decided by the destination
+        self._by_destination = []
+        # the trie node: ({label: child node}, {the partial leftmost label: [rule index]}),
+        # a partial label matches the labels ending with it(host 'baidu.com' matches 'www.xbaidu.com')
+        self._host_trie = ({}, {})
+        self._url_prefixes = {}  # prefix length -> {prefix: [rule index]}
+        self._path_prefixes = {}
+        self._ports = {}
+        self._methods = {}
+        self._protocols = {}
+        self._unindexed = []
+        self._local_ip = None
+        self._excluded = frozenset()
+        for _r in conf.get('router') or []:
+            for _con_name in _r:
+                if _con_name not in conf:
+                    continue
+                self._add(RouterRule(len(self.rules), _con_name, _r[_con_name], conf[_con_name] or {}))
+
+    def _add(self, rule):
+        self.rules.append(rule)
+        self._by_destination.append((not self._by_destination or self._by_destination[-1])
+                                    and all(k in self.DESTINATION_KEYS for k, _, _ in rule.conditions))
+        for k in self.INDEX_KEYS:
+            values = rule.positive_values(k)
+            if values is None or (k == 'host' and any(c != 's' for c, _ in values)) \
+                    or (k == 'protocol' and any(v not in ('HTTP', 'HTTPS') for v in values)):
+                continue
+            for v in values:
+                if k == 'host':
+                    labels = v[1].split('.')
+                    node = self._host_trie
+                    for label in reversed(labels[1:]):
+                        node = node[0].setdefault(label, ({}, {}))
+                    node[1].setdefault(labels[0], []).append(rule.index)
+                elif k in ('url', 'path'):
+                    prefixes = self._url_prefixes if k == 'url' else self._path_prefixes
+                    prefixes.setdefault(len(v), {}).setdefault(v, []).append(rule.index)
+                else:
+                    table = self._ports if k == 'port' else self._methods if k == 'method' else self._protocols
+                    table.setdefault(v, []).append(rule.index)
+            return
+        self._unindexed.append(rule.index)
+
+    def _set_local_ip(self, local_ip):
+        """ precompute the rules out of the with_in/with_out of local_ip """
+        excluded = set()
+        if local_ip:
+            for rule in self.rules:
+                if rule.with_in is not None and not topendns.is_subnet(local_ip, rule.with_in):
+                    excluded.add(rule.index)
+                elif rule.with_out is not None and topendns.is_subnet(local_ip, rule.with_out):
+                    excluded.add(rule.index)
+        self._excluded = frozenset(excluded)
+        self._local_ip = local_ip
+
+    def candidates(self, facts):
+        """ :return: the indexes of the rules may match facts, in the router order """
+        found = set(self._unindexed)
+        labels = facts.hostname.split('.')
+        node = self._host_trie
+        for label in reversed(labels):
+            if node[1]:
+                for i in range(len(label) + 1):
+                    found.update(node[1].get(label[i:], ()))
+            node = node[0].get(label)
+            if node is None:
+                break
+        for s, prefixes in ((facts.url, self._url_prefixes), (facts.path, self._path_prefixes)):
+            for length, table in prefixes.items():
+                found.update(table.get(s[:length], ()))
+        found.update(self._ports.get(facts.port, ()))
+        found.update(self._methods.get(facts.method, ()))
+        if facts.connect:
+            found.update(self._protocols.get('HTTPS', ()))
+        if facts.scheme == 'http':
+            found.update(self._protocols.get('HTTP', ()))
+        return sorted(found)
+
+    def pause(self, name):
+        self.pauses[name] = time.time()
+        self.generation = next(_route_generations)
+
+    def route(self, request, connection, local_ip=None):
+        """
+        :return: (proxy name, the matched condition name, cacheable), (default, None, cacheable) if no rule matched,
+                 cacheable if the same destination(host, port, app, protocol) always routes the same
+        """
+        if local_ip != self._local_ip:
+            self._set_local_ip(local_ip)
+        facts = _route_facts(request)
+        # a decision skipped a paused rule changes when the pause expires
+        paused = False
+        for index in self.candidates(facts):
+            if index in self._excluded:
+                continue
+            rule = self.rules[index]
+            if rule.name in self.pauses:
+                if (time.time() - self.pauses[rule.name]) <= 5*60:
+                    paused = True
+                    continue
+                else:
+                    logger.info('resume pause router: %s', rule.name)
+                    del self.pauses[rule.name]
+            if rule.match(request, connection, facts):
+                logger.debug('match router: %s', rule.name)
+                return rule.to, rule.name, not paused and self._by_destination[index]
+        return self.default, None, not paused and (not self.rules or self._by_destination[-1])
+
 
 class RouterableConnector(SmartConnector):
     """
@@ -306,6 +732,7 @@ class RouterableConnector(SmartConnector):
         self.conf_update_time = 0
         self.yaml_conf_mod = 0
         self.yaml_conf = {'router': []}
+        self.router_table = RouterTable(self.yaml_conf)
         self.load_yaml_conf()
 
     def connect(self, peer, target_host, target_port, proxy_name=None, loop=None, **kwargs) -> streams.StreamConnection:
@@ -326,7 +753,7 @@ class RouterableConnector(SmartConnector):
                         return (yield from super().connect(peer, target_host, target_port, proxy_name=proxy_name, loop=loop, connect_timeout=3, **kwargs))
                     except (TimeoutError, asyncio.TimeoutError, socket.gaierror, ConnectionError) as ex:
                         logger.info('pause router: %s casue %s', condition, ex)
-                        self.yaml_conf[condition + '.pause'] = time.time()
+                        self.router_table.pause(condition)
                         return (yield from self.proxy_connector.connect(peer, target_host, target_port, loop=loop, **kwargs))
             elif topendns.is_local(target_host):
                 return (yield from self.direct_connector.connect(peer, target_host, target_port, loop=loop, **kwargs))
@@ -349,6 +776,7 @@ class RouterableConnector(SmartConnector):
                 if not self.check_yaml_conf(_conf):
                     logger.error('%s load FAIL!', self.yaml_conf_file)
                     return
+                self.router_table = RouterTable(_conf)
                 self.yaml_conf = _conf
                 logger.info('%s reloaded', self.yaml_conf_file)
         except BaseException as ex:
@@ -427,101 +855,20 @@ class RouterableConnector(SmartConnector):
 
     def get_proxy_name(self, request, connection):
         self.load_yaml_conf()
-        for _r in self.yaml_conf['router']:
-            for _con_name in _r:
-                _to = _r[_con_name]
-                if _con_name not in self.yaml_conf:
-                    continue
-                # to support with_in/with_out verb 2019.4.16
-                if isinstance(_to, dict):
-                    if 'with_in' in _to and self.proxy_holder.local_ip:
-                        _with = _to['with_in']
-                        if isinstance(_with, list):
-                            is_in = topendns.is_subnet(self.proxy_holder.local_ip, _with)
-                        else:
-                            is_in = topendns.is_subnet(self.proxy_holder.local_ip, [_with])
-                        if not is_in:
-                            continue
-                    elif 'with_out' in _to and self.proxy_holder.local_ip:
-                        _with = _to['with_out']
-                        if isinstance(_with, list):
-                            is_in = topendns.is_subnet(self.proxy_holder.local_ip, _with)
-                        else:
-                            is_in = topendns.is_subnet(self.proxy_holder.local_ip, [_with])
-                        if is_in:
-                            continue
-                    _to = _to['to']
-                pause_key = _con_name + '.pause'
-                if pause_key in self.yaml_conf:
-                    if (time.time() - self.yaml_conf[pause_key]) <= 5*60:
-                        continue
-                    else:
-                        logger.info('resume pause router: %s', _con_name)
-                        del self.yaml_conf[pause_key]
-                _con = self.yaml_conf[_con_name]
-                _con_match = True
-                for k in _con:
-                    v = _con[k]
-                    if isinstance(v, list):
-                        _m = False
-                        for _v in v:
-                            _m = self._match(k, _v, request, connection)
-                            if (_m and _v[0] != '!') \
-                                    or (not _m and _v[0] == '!'):
-                                break
-                    else:
-                        _m = self._match(k, v, request, connection)
-                    if not _m:
-                        _con_match = False
-                        break
-                if _con_match:
-                    logger.debug('match router: %s', _con_name)
-                    return _to, _con_name
-        return (self.yaml_conf['default'] if 'default' in self.yaml_conf else None), None
-
-    def _match(self, k: str, v: str, request, connection):
-        if v[0] == '!':
-            return self.__match(k, v[1:], request, connection, True)
-        else:
-            return self.__match(k, v, request, connection)
-
-    def __match(self, k: str, v: str, request, connection, rev=False):
-        _m = False
-        if k == 'url':
-            _m = request.url.full_url.lower().startswith(v.lower())
-        elif k == 'protocol':
-            if v.upper() == 'HTTPS':
-                _m = request.method == common.HTTPS_METHOD_CONNECT
-            elif v.upper() == 'HTTP':
-                _m = request.url.scheme.lower() == v.lower()
-        elif k == 'host':
-            c = 's'  # p,k,s,r分别表示 prefix (前缀)，keyword(关键词),suffix(后缀),regex(正则表达式/暂不支持)
-            v = v.lower()
-            if ',' in v:
-                c, v = v.split(',', 1)
-            if c == 's':
-                _m = request.url.hostname.lower().endswith(v)
-            elif c == 'p':
-                _m = request.url.hostname.lower().startswith(v)
-            else:
-                _m = v in request.url.hostname.lower()
-        elif k == 'port':
-            v = v if isinstance(v, int) else int(v)
-            _m = request.url.port == v
-        elif k == 'path':
-            _m = request.url.path.lower().startswith(v.lower())
-        elif k == 'method':
-            _m = request.method.lower() == v.lower()
-        elif k == 'app':
-            if 'process_name' in connection:
-                _m = connection['process_name'] == v
-        else:
-            _exists = k in request.headers
-            if not _exists:
-                _m = False
-            else:
-                _m = v.lower() in request.headers[k].lower()
-        return _m if not rev else not _m
+        router_table = self.router_table
+        local_ip = self.proxy_holder.local_ip
+        if common.route_cache_timeout <= 0:
+            return router_table.route(request, connection, local_ip)[:2]
+        url = request.url
+        key = (router_table.generation, local_ip, url.hostname, url.port, connection.get('process_name'),
+               request.method == common.HTTPS_METHOD_CONNECT, url.scheme)
+        decision = route_cache.get(key)
+        if decision is None:
+            proxy_name, condition, cacheable = router_table.route(request, connection, local_ip)
+            decision = proxy_name, condition
+            if cacheable:
+                route_cache.set(key, decision, timeout=common.route_cache_timeout)
+        return decision
 
 
 class CheckConnector(ProxyConnector):
@@ -536,3 +883,274 @@ class CheckConnector(ProxyConnector):
         logger.debug("speed_testing_proxy=%s", speeding_proxy)
         proxy_name, proxy_ip = speeding_proxy.split('/') if '/' in speeding_proxy else (speeding_proxy, None)
         return (yield from super().connect(peer, target_host, target_port, proxy_name=proxy_name, loop=loop, speed_test_ip=proxy_ip, **kwargs))
+
+
+def set_active(connection, active):
+    """ count or uncount the connection in Proxy.conn_count and the active_connections, the parked one is not active """
+    counter = connection.get_attr(ACTIVE_COUNTER)
+    if counter is None or counter[1] == active:
+        return
+    counter[1] = active
+    proxy = counter[0]
+    if proxy is None:
+        label = 'D'
+    else:
+        label = proxy.short_hostname
+        proxy.conn_count += 1 if active else -1
+    if active:
+        metrics.active_connections.inc(label)
+    else:
+        metrics.active_connections.dec(label)
+
+
+class HttpKeepAlive(object):
+    """ the keep-alive state of a plain http connection to the server(direct or a http proxy) """
+
+    # resent on a new connection if the reused one is closed by the server before responding
+    RETRYABLE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.framer = httphelper.ResponseFramer()
+        # released by the client, parked once the responses all received
+        self.released = False
+        # reused from the pool and nothing responded yet
+        self.reusing = False
+        # the future of the reuse: True once responding, False if closed before
+        self.responding = None
+        # the requests sent since the reuse
+        self.reused_requests = 0
+        # the first request on the reused connection, if it can be resent
+        self.retry_request = None
+
+    def on_reuse(self, loop):
+        self.reusing = True
+        self.responding = loop.create_future()
+        self.reused_requests = 0
+        self.retry_request = None
+
+    def on_request(self, request):
+        self.framer.on_request(request)
+        if self.reusing:
+            self.reused_requests += 1
+            # a pipelined request is not resent, the one before it may be handled by the server
+            if self.reused_requests == 1 and request.method in self.RETRYABLE_METHODS and not request.body:
+                self.retry_request = request
+
+    def on_close(self):
+        if self.responding is not None and not self.responding.done():
+            self.responding.set_result(False)
+
+    def keep_peer(self, connection):
+        """ the peer is kept for the retry if the reused connection is closed before responding """
+        return self.retry_request is not None and self.reusing and not connection.response_timeout
+
+    @asyncio.coroutine
+    def wait_responding(self, request):
+        """ :return: False if request should be resent on a new connection, the reused one is closed before responding """
+        if self.retry_request is not request:
+            return True
+        return (yield from self.responding)
+
+    def stop_after(self, data):
+        """ the stop_after of the response forwarding: stop once released and between the responses """
+        if data:
+            if self.reusing:
+                self.reusing = False
+                if not self.responding.done():
+                    self.responding.set_result(True)
+            self.framer.feed(data)
+        return self.released and self.framer.idle
+
+    def release(self, connection):
+        """ :return: False if the connection can't be kept alive """
+        if not self.framer.reusable or connection.is_closing:
+            return False
+        self.released = True
+        if self.framer.idle:
+            # wake up the forwarding waiting for the next response
+            connection.reader.wakeup(asyncio.TimeoutError())
+        return True
+
+
+class HttpConnectionPool(object):
+    """
+    the idle keep-alive connections of the plain http, keyed by (route, proxy, host, port),
+    the forwarding coroutine of a parked connection waits in park() until it is taken by the next peer
+    """
+
+    def __init__(self, loop=None):
+        self._loop = loop if loop else asyncio.get_event_loop()
+        self._idle = {}  # key -> [[connection, waiter, timer], ...]
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._idle.values())
+
+    def track(self, connection, key):
+        keepalive = connection.set_attr(common.KEY_HTTP_KEEPALIVE, HttpKeepAlive(self, key))
+        connection.add_close_callback(functools.partial(self._discard, connection))
+        return keepalive
+
+    @staticmethod
+    def _is_reusable(connection):
+        reader = connection.reader
+        # nothing should be received on an idle connection, b'' means closed by the server
+        return not connection.is_closing and not reader.at_eof() and len(reader) == 0 and reader.exception() is None
+
+    def acquire(self, key, peer):
+        """ :return: an idle connection of key handed over to peer, None if not found """
+        entries = self._idle.get(key)
+        while entries:
+            connection, waiter, timer = entries.pop()
+            timer.cancel()
+            if waiter.done():
+                continue
+            if not self._is_reusable(connection):
+                waiter.set_result(None)
+                continue
+            waiter.set_result(peer)
+            connection.get_attr(common.KEY_HTTP_KEEPALIVE).on_reuse(self._loop)
+            set_active(connection, True)
+            self.hits += 1
+            metrics.http_pool_requests.inc(key[1], 'hit')
+            return connection
+        if entries is not None:
+            del self._idle[key]
+        self.misses += 1
+        metrics.http_pool_requests.inc(key[1], 'miss')
+        return None
+
+    @asyncio.coroutine
+    def park(self, connection):
+        """ :return: the next peer of the connection, None to close it """
+        keepalive = connection.get_attr(common.KEY_HTTP_KEEPALIVE)
+        if keepalive is None or not keepalive.released or not keepalive.framer.idle or not self._is_reusable(connection):
+            return None
+        idle_timeout = common.http_pool_idle_timeout
+        if keepalive.framer.keepalive_timeout is not None:
+            # leave a second before the server closes it
+            idle_timeout = min(idle_timeout, keepalive.framer.keepalive_timeout - 1)
+        entries = self._idle.setdefault(keepalive.key, [])
+        if idle_timeout <= 0 or len(entries) >= common.http_pool_size:
+            if not entries:
+                del self._idle[keepalive.key]
+            return None
+        keepalive.released = False
+        connection.set_attr(tsproxy.proxy.PEER_CONNECTION, None)
+        set_active(connection, False)
+        waiter = self._loop.create_future()
+        entry = [connection, waiter, None]
+        entry[2] = self._loop.call_later(idle_timeout, self._evict, keepalive.key, entry)
+        entries.append(entry)
+        logger.debug('%s parked in the http pool', connection)
+        return (yield from waiter)
+
+    def _evict(self, key, entry):
+        entries = self._idle.get(key)
+        if entries and entry in entries:
+            entries.remove(entry)
+            if not entries:
+                del self._idle[key]
+        entry[2].cancel()
+        if not entry[1].done():
+            entry[1].set_result(None)
+
+    def _discard(self, connection):
+        keepalive = connection.get_attr(common.KEY_HTTP_KEEPALIVE)
+        keepalive.on_close()
+        for entry in list(self._idle.get(keepalive.key, ())):
+            if entry[0] is connection:
+                self._evict(keepalive.key, entry)
+
+    def stat_info(self):
+        return 'http_pool=%d hit=%d/%d' % (len(self), self.hits, self.hits + self.misses)
+
+
+_http_pools = {}
+
+
+def get_http_pool(loop=None) -> HttpConnectionPool:
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    pool = _http_pools.get(loop)
+    if pool is None:
+        pool = HttpConnectionPool(loop=loop)
+        _http_pools[loop] = pool
+    return pool
+
+
+def benchmark_router(rule_count=1200, count=20000):
+    """ the us per request of RouterTable.route against scanning all the rules, with rule_count rules """
+    conf = {'default': 'P', 'router': []}
+    for i in range(rule_count):
+        if i % 50 == 49:
+            con = {'User-Agent': 'agent%d' % i}
+        elif i % 10 == 9:
+            con = {'url': ['http://www.site%d.com/api' % i, 'http://m.site%d.com/' % i], 'method': 'GET'}
+        else:
+            con = {'host': ['site%d.com' % i, '.cdn%d.net' % i, 'img.site%d.org' % i]}
+            if i % 7 == 0:
+                con['port'] = ['!8080']
+        conf['con%d' % i] = con
+        conf['router'].append({'con%d' % i: 'D' if i % 2 else 'P'})
+    table = RouterTable(conf)
+    request_class = collections.namedtuple('Request', ['method', 'url', 'headers'])
+    requests = []
+    for method, path in (('GET', 'http://www.site%d.com/index.html' % (rule_count - 2)),
+                         ('GET', 'http://a.b.cdn%d.net/x.js' % (rule_count // 2)),
+                         ('GET', 'http://www.site%d.com/api/v1' % (rule_count - 1)),
+                         ('GET', 'http://www.example.com/'),
+                         ('CONNECT', 'img.site%d.org:443' % (rule_count // 3))):
+        requests.append(request_class(method, httphelper.HttpRequestParser.parse_path(path, method),
+                                      {'User-Agent': 'Mozilla/5.0'}))
+
+    def scan(request, connection):
+        facts = _route_facts(request)
+        for rule in table.rules:
+            if rule.match(request, connection, facts):
+                return rule.to, rule.name
+        return table.default, None
+
+    for name, route in (('indexed', table.route), ('scan', scan)):
+        start = time.perf_counter()
+        for i in range(count):
+            route(requests[i % len(requests)], {})
+        print('%-8s %8.2f us/request' % (name, (time.perf_counter() - start) * 1e6 / count))
+
+
+def test_route_cache():
+    """ the cached cn decision changes with the reloaded apnic list """
+    import shutil
+    import tempfile
+
+    loop = asyncio.get_event_loop()
+    connector = SmartConnector(loop=loop)
+    apnic_dir = tempfile.mkdtemp()
+    saved = topendns.apnic_file, topendns.cn_ip_file_mod, topendns.cn_ip_update
+    try:
+        topendns.apnic_file = os.path.join(apnic_dir, topendns.APNIC_LATEST)
+        for mtime, cn_range, expected in ((1000, '1.2.4.0|256', True), (2000, '1.2.5.0|256', False), (3000, '1.2.4.0|512', True)):
+            with open(topendns.apnic_file, 'w') as f:
+                f.write('apnic|CN|ipv4|%s|20100101|allocated\n' % cn_range)
+            os.utime(topendns.apnic_file, (mtime, mtime))
+            # skip the throttle of the reload checks
+            topendns.cn_ip_update = 0
+            for _ in range(2):
+                is_cn = loop.run_until_complete(connector._is_cn('1.2.4.8', 0x01))
+                assert is_cn is expected, '%s: is_cn=%s' % (cn_range, is_cn)
+        assert route_cache.hits > 0
+    finally:
+        topendns.apnic_file, topendns.cn_ip_file_mod, topendns.cn_ip_update = saved
+        shutil.rmtree(apnic_dir)
+    print('test_route_cache ok')
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'test':
+        test_route_cache()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark_router()
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import struct
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+from dns.resolver import NXDOMAIN, NoAnswer
+
+from tsproxy import common
+
+logger = logging.getLogger(__name__)
+
+
+class _UdpQueryProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, query, waiter, retry_interval=None, loop=None):
+        self._query = query
+        self._wire = query.to_wire()
+        self._waiter = waiter
+        self._retry_interval = retry_interval
+        self._retry_handle = None
+        self._transport = None
+        self._loop = loop
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._send()
+
+    def _send(self):
+        self._transport.sendto(self._wire)
+        if self._retry_interval:
+            # udp may be lost, resend it if no answer in retry_interval
+            self._retry_handle = self._loop.call_later(self._retry_interval, self._send)
+
+    def datagram_received(self, data, addr):
+        if self._waiter.done():
+            return
+        try:
+            response = dns.message.from_wire(data)
+        except dns.exception.DNSException as ex:
+            logger.debug('bad dns response from %s: %s(%s)', addr, common.clazz_fullname(ex), ex)
+            return
+        if not self._query.is_response(response):
+            # not the answer of our query, ignore it and wait the right one
+            return
+        self._waiter.set_result(response)
+
+    def error_received(self, exc):
+        if not self._waiter.done():
+            self._waiter.set_exception(exc)
+
+    def connection_lost(self, exc):
+        if self._retry_handle:
+            self._retry_handle.cancel()
+        if not self._waiter.done():
+            self._waiter.set_exception(exc if exc else ConnectionError('dns udp endpoint closed'))
+
+
+class DnsClient(object):
+    """ dns client running on the event loop, query by udp and retry by tcp if the answer is truncated """
+
+    def __init__(self, nameservers, port=53, timeout=2, retry_interval=0.5, loop=None):
+        self.nameservers = nameservers
+        self.port = port
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self._loop = loop
+
+    @asyncio.coroutine
+    def query(self, qname, rdtype=dns.rdatatype.A, loop=None):
+        """
+        :return: ([address, ...], ttl)
+        :raise: NXDOMAIN, NoAnswer, asyncio.TimeoutError, OSError
+        """
+        if loop is None:
+            loop = self._loop if self._loop else asyncio.get_event_loop()
+        deadline = loop.time() + self.timeout
+        query = dns.message.make_query(qname, rdtype)
+        last_ex = None
+        nameservers = list(self.nameservers)
+        for i in range(0, len(nameservers)):
+            left_time = deadline - loop.time()
+            if left_time <= 0:
+                break
+            # share the left time to the left nameservers
+            ns_timeout = left_time / (len(nameservers) - i)
+            try:
+                with common.Timeout(ns_timeout, loop=loop):
+                    response = yield from self._udp_query(query, nameservers[i], loop)
+                    if response.flags & dns.flags.TC:
+                        response = yield from self._tcp_query(query, nameservers[i], loop)
+            except (asyncio.TimeoutError, OSError, EOFError, dns.exception.DNSException) as ex:
+                logger.debug('dns query %s@%s:%d fail: %s(%s)', qname, nameservers[i], self.port, common.clazz_fullname(ex), ex)
+                last_ex = ex
+                continue
+            return self._parse_response(response, rdtype)
+        if last_ex is None or isinstance(last_ex, asyncio.TimeoutError):
+            raise asyncio.TimeoutError('dns query %s timeout(%.1f)' % (qname, self.timeout))
+        raise last_ex
+
+    @asyncio.coroutine
+    def _udp_query(self, query, nameserver, loop):
+        waiter = loop.create_future()
+        transport, _ = yield from loop.create_datagram_endpoint(
+            lambda: _UdpQueryProtocol(query, waiter, self.retry_interval, loop), remote_addr=(nameserver, self.port))
+        try:
+            return (yield from waiter)
+        finally:
+            transport.close()
+
+    @asyncio.coroutine
+    def _tcp_query(self, query, nameserver, loop):
+        reader, writer = yield from asyncio.open_connection(nameserver, self.port, loop=loop)
+        try:
+            wire = query.to_wire()
+            writer.write(struct.pack('!H', len(wire)) + wire)
+            res_len, = struct.unpack('!H', (yield from reader.readexactly(2)))
+            response = dns.message.from_wire((yield from reader.readexactly(res_len)))
+            if not query.is_response(response):
+                raise dns.exception.FormError('not the response of query#%d' % query.id)
+            return response
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_response(response, rdtype):
+        rcode = response.rcode()
+        if rcode == dns.rcode.NXDOMAIN:
+            raise NXDOMAIN()
+        if rcode != dns.rcode.NOERROR:
+            raise dns.exception.DNSException('dns response rcode: %s' % dns.rcode.to_text(rcode))
+        addresses = []
+        ttl = None
+        for rrset in response.answer:
+            # the ttl of CNAME chain is counted too
+            ttl = rrset.ttl if ttl is None else min(ttl, rrset.ttl)
+            if rrset.rdtype == rdtype:
+                for rdata in rrset:
+                    addresses.append(rdata.to_text())
+        if not addresses:
+            raise NoAnswer()
+        return addresses, ttl
+
+
+def benchmark_dns(concurrency=1000, names=100):
+    """ concurrent lookups against a local stub dns server, with and without the in-flight coalescing """
+    import time
+    import dns.rrset
+    from tsproxy import topendns
+
+    loop = asyncio.get_event_loop()
+    received = [0]
+
+    class StubDnsServer(asyncio.DatagramProtocol):
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            received[0] += 1
+            query = dns.message.from_wire(data)
+            response = dns.message.make_response(query)
+            qname = query.question[0].name
+            response.answer.append(dns.rrset.from_text(qname, 300, 'IN', 'A', '127.0.0.%d' % (received[0] % 250 + 1)))
+            # answer on next loop iteration like a real server
+            loop.call_soon(self.transport.sendto, response.to_wire(), addr)
+
+    transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(StubDnsServer, local_addr=('127.0.0.1', 0)))
+    port = transport.get_extra_info('sockname')[1]
+    client = DnsClient(['127.0.0.1'], port=port, timeout=5, loop=loop)
+
+    @asyncio.coroutine
+    def run(lookup):
+        start = time.time()
+        futures = [asyncio.ensure_future(lookup('host%d.bench.test' % (i % names)), loop=loop) for i in range(0, concurrency)]
+        done, _ = yield from asyncio.wait(futures, loop=loop)
+        failed = sum(1 for f in done if f.exception() is not None or not f.result())
+        return time.time() - start, failed
+
+    received[0] = 0
+    used, failed = loop.run_until_complete(run(client.query))
+    print('DnsClient.query: %d lookups used %.3f sec, %d failed, %d queries to server' % (concurrency, used, failed, received[0]))
+
+    topendns.dns_client = client
+    topendns.dns_cache.clear()
+    received[0] = 0
+    used, failed = loop.run_until_complete(run(lambda n: topendns.async_dns_query(n, ex_func=True, loop=loop)))
+    print('topendns.async_dns_query: %d lookups used %.3f sec, %d failed, %d queries to server' % (concurrency, used, failed, received[0]))
+    transport.close()
+
+
+if __name__ == '__main__':
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        # python -m tsproxy.dnsclient bench [concurrency]
+        benchmark_dns(*[int(arg) for arg in sys.argv[2:3]])
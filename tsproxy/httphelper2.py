@@ -1,15 +1,15 @@
 import asyncio
 import collections
 import logging
+import re
 import time
 from http.client import responses
-from urllib.parse import urlparse
-from urllib.parse import urlunparse
 
 import aiohttp
 from aiohttp import hdrs
 from aiohttp import http_exceptions as errors
 from aiohttp import http_parser
+from multidict import CIMultiDict
 
 from tsproxy import common
 
@@ -18,10 +18,38 @@ NOT_MODIFIED = 304
 
 logger = logging.getLogger(__name__)
 
-RequestMessage = collections.namedtuple(
-    'RequestMessage',
-    ['method', 'path', 'version', 'headers', 'raw_headers',
-     'should_close', 'compression', 'request_line', 'url', 'body', 'error', 'request_time'])
+METHRE = re.compile('[A-Z0-9$-_.]+')
+HDRRE = re.compile(rb'[\x00-\x1F\x7F()<>@,;:\[\]={} \t\\\\\"]')
+KEEPALIVE_TIMEOUT_RE = re.compile(r'timeout\s*=\s*(\d+)', re.I)
+SCHEME_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789+-.'
+
+
+class RequestMessage(collections.namedtuple(
+        'RequestMessage',
+        ['method', 'path', 'version', 'headers', 'raw_headers',
+         'should_close', 'compression', 'request_line', 'url', 'body', 'error', 'request_time'])):
+    """ raw_headers, should_close and compression of the parsed request come from its lazy headers """
+
+    __slots__ = ()
+
+    @property
+    def raw_headers(self):
+        if isinstance(self.headers, RequestHeaders):
+            return self.headers.raw_headers
+        return tuple.__getitem__(self, 4)
+
+    @property
+    def should_close(self):
+        if isinstance(self.headers, RequestHeaders):
+            return self.headers.should_close(tuple.__getitem__(self, 5))
+        return tuple.__getitem__(self, 5)
+
+    @property
+    def compression(self):
+        if isinstance(self.headers, RequestHeaders):
+            return self.headers.compression
+        return tuple.__getitem__(self, 6)
+
 
 RequestURL = collections.namedtuple(
     'RequestURL',
@@ -34,6 +62,25 @@ ResponseMessage = collections.namedtuple(
      'head_length', 'body', 'raw_data', 'error', 'response_time'])
 
 
+def parse_version(version):
+    """ :return: close the connection by default or not """
+    if version == 'HTTP/1.1':
+        return False
+    try:
+        if version.startswith('HTTP/'):
+            n1, n2 = version[5:].split('.', 1)
+            obj_version = aiohttp.HttpVersion(int(n1), int(n2))
+        else:
+            raise errors.BadStatusLine(version)
+    except:
+        raise errors.BadStatusLine(version)
+    if obj_version <= aiohttp.HttpVersion10:  # HTTP 1.0 must asks to not close
+        close = True
+    else:  # HTTP 1.1 must ask to close.
+        close = False
+    return close
+
+
 class HttpParser(http_parser.HttpParser):
 
     def __init__(self, max_line_size=10240, max_headers=32768,
@@ -41,19 +88,7 @@ class HttpParser(http_parser.HttpParser):
         super().__init__(max_line_size=max_line_size, max_headers=max_headers, max_field_size=max_field_size, **kwargs)
 
     def _parse_version(self, version):
-        try:
-            if version.startswith('HTTP/'):
-                n1, n2 = version[5:].split('.', 1)
-                obj_version = aiohttp.HttpVersion(int(n1), int(n2))
-            else:
-                raise errors.BadStatusLine(version)
-        except:
-            raise errors.BadStatusLine(version)
-        if obj_version <= aiohttp.HttpVersion10:  # HTTP 1.0 must asks to not close
-            close = True
-        else:  # HTTP 1.1 must ask to close.
-            close = False
-        return close
+        return parse_version(version)
 
     def parse_headers(self, lines, status=200, request_method='GET', default_close=True):
         headers, raw_headers, close, compression, _, chunked = super().parse_headers(lines)
@@ -110,33 +145,36 @@ def bad_response(error, response_line=None, raw_data=b'', timeout=None):
         len(raw_data), None, raw_data, error, time.time())
 
 
-class HttpRequestParser(HttpParser):
+class HttpRequestParser(object):
+    """
+    parses the request head in one scan of the data read: the request line at once,
+    the headers on their first access(RequestHeaders)
+    """
 
     def parse_request(self, reader, raw_data=b'', read_timeout=common.default_timeout):
         # read HTTP message (request line + headers)
         request_time = time.time()
         request_line = method = version = url = close = None
         try:
-            with common.Timeout(read_timeout):
-                if raw_data and raw_data.find(b'\r\n') > 0:
-                    pass
-                else:
-                    raw_data += yield from reader.readuntil(b'\r\n')
-
-                request_line, _ = raw_data.split(b'\r\n', 1)
-                request_line = request_line.decode('utf-8', 'surrogateescape')
+            line_end = raw_data.find(b'\r\n')
+            if line_end >= 0:
+                # assigned before parsed, logged with the bad request
+                request_line = raw_data[:line_end].decode('utf-8', 'surrogateescape')
                 method, version, url, close = self._parse_requestline(request_line)
-
-                while True:
-                    end_index = raw_data.find(b'\r\n\r\n')
-                    if raw_data and end_index > 0:
-                        header_lines = raw_data[:end_index+4]
-                        body = raw_data[end_index+4:]
-                        break
-                    else:
-                        raw_data += yield from reader.readuntil(b'\r\n')
-
-                _request = self._parse_request(header_lines, request_line, method, version, url, close, request_time)
+                # the end of head is after the end of request line
+                head_end = raw_data.find(b'\r\n\r\n', line_end)
+            else:
+                head_end = -1
+            if head_end < 0:
+                # the rest of head is still coming, put the data back and wait the end of head over the reader buffer
+                reader.unread(raw_data)
+                with common.Timeout(read_timeout):
+                    raw_data = yield from reader.readuntil(b'\r\n\r\n')
+                head_end = len(raw_data) - 4
+                if request_line is None:
+                    line_end = raw_data.find(b'\r\n')
+                    request_line = raw_data[:line_end].decode('utf-8', 'surrogateescape')
+                    method, version, url, close = self._parse_requestline(request_line)
         except EOFError:
             return None
         except errors.HttpProcessingError as bad_req:
@@ -144,19 +182,18 @@ class HttpRequestParser(HttpParser):
         except (TimeoutError, asyncio.TimeoutError):
             return bad_request(errors.BadHttpMessage('read request timeout(%d)' % read_timeout), request_line, method, version, url, close, request_time=request_time)
         except asyncio.LimitOverrunError as exc:
-            return bad_request(errors.LineTooLong('%s' % raw_data, exc.consumed), request_line, method, version, url, close, request_time=request_time)
+            return bad_request(errors.LineTooLong('request head', exc.consumed), request_line, method, version, url, close, request_time=request_time)
 
+        body = raw_data[head_end+4:]
         chunk_len = len(reader)
         if chunk_len > 0:
             body += yield from reader.read_bytes(size=chunk_len)
-        if len(body) > 0:
-            _request = _request._replace(body=body)
 
-        return _request
+        return RequestMessage(
+            method, url.full_path, version, RequestHeaders(raw_data[line_end+2:head_end]), None,
+            close, None, request_line, url, body, None, request_time)
 
     def _parse_requestline(self, line):
-        # request line
-        # line = request_line.decode('utf-8', 'surrogateescape')
         try:
             method, path, version = line.split(None, 2)
         except ValueError:
@@ -164,48 +201,201 @@ class HttpRequestParser(HttpParser):
 
         # method
         method = method.upper()
-        if not http_parser.METHRE.match(method):
+        if not METHRE.match(method):
             raise errors.BadStatusLine(method)
 
         # version
-        close = self._parse_version(version)
+        close = parse_version(version)
 
         # path
         url = self.parse_path(path, method)
 
         return method, version, url, close
 
-    def _parse_request(self, raw_data, line, method, version, url, default_close=True, request_time=None):
-        lines = raw_data.split(b'\r\n')
-
-        # read headers
-        headers, raw_headers, close, compression, _, _ = self.parse_headers(lines, default_close=default_close)
-        if close is None:  # then the headers weren't set in the request
-            close = default_close
-
-        return RequestMessage(
-            method, url.full_path, version, headers, raw_headers,
-            close, compression, line, url, b'', None, request_time if request_time else time.time())
-
     @staticmethod
     def parse_path(path, method):
         """ ['full_url', 'full_path', 'scheme', 'netloc', 'hostname', 'port', 'path', 'query'])  """
-        url = urlparse(path)
-        result = {'scheme': url.scheme if url.scheme else 'http' if url.netloc else '',
-                  'netloc': url.netloc,
-                  'path': url.path,
-                  'query': url.query}
-        result['full_url'] = urlunparse((result['scheme'], result['netloc'], url.path, url.params, url.query, url.fragment))
-        result['full_path'] = urlunparse(('', '', url.path, url.params, url.query, url.fragment))
         if method == 'CONNECT':
-            hostname, port = url.path.split(':')
-            result['hostname'] = hostname
-            result['port'] = int(port) if port else 443
+            # authority-form: host:port
+            hostname, sep, port = path.rpartition(':')
+            if not sep:
+                hostname, port = path, ''
+            try:
+                port = int(port) if port else 443
+            except ValueError:
+                raise errors.InvalidURLError(path) from None
+            return RequestURL(path, path, '', '', hostname.strip('[]'), port, path, '')
+
+        # [scheme:][//netloc]path[?query][#fragment], as urlparse does
+        scheme = netloc = query = fragment = ''
+        rest = path
+        if path[:1] != '/':
+            colon = path.find(':')
+            if colon > 0 and not path[:colon].strip(SCHEME_CHARS):
+                scheme, rest = path[:colon].lower(), path[colon+1:]
+        if rest[:2] == '//':
+            netloc_end = len(rest)
+            for c in '/?#':
+                i = rest.find(c, 2)
+                if 0 <= i < netloc_end:
+                    netloc_end = i
+            netloc, rest = rest[2:netloc_end], rest[netloc_end:]
+        if '#' in rest:
+            rest, _, fragment = rest.partition('#')
+        if '?' in rest:
+            rest, _, query = rest.partition('?')
+        url_path = rest
+        if ';' in url_path:
+            # the params of the last path segment
+            i = url_path.find(';', url_path.rfind('/'))
+            if i >= 0:
+                url_path = url_path[:i]
+
+        full_path = rest
+        if query:
+            full_path += '?' + query
+        if fragment:
+            full_path += '#' + fragment
+        if not scheme and netloc:
+            scheme = 'http'
+        if netloc:
+            full_url = '%s://%s%s' % (scheme, netloc, full_path)
+        elif scheme:
+            full_url = '%s:%s' % (scheme, full_path)
         else:
-            result['hostname'] = url.hostname if url.hostname else None
-            result['port'] = int(url.port) if url.port else 80
-
-        return RequestURL(**result)
+            full_url = full_path
+
+        hostname = None
+        port = 80
+        if netloc:
+            host = netloc.rpartition('@')[2]
+            if host[:1] == '[':
+                hostname, _, port_str = host[1:].partition(']')
+                port_str = port_str[1:]
+            else:
+                hostname, _, port_str = host.partition(':')
+            hostname = hostname.lower() if hostname else None
+            if port_str:
+                try:
+                    port = int(port_str)
+                except ValueError:
+                    raise errors.InvalidURLError(path) from None
+                if not 0 <= port <= 65535:
+                    raise errors.InvalidURLError(path)
+                if port == 0:
+                    port = 80
+
+        return RequestURL(full_url, full_path, scheme, netloc, hostname, port, url_path, query)
+
+
+class RequestHeaders(object):
+    """
+    the headers of request, the head block is parsed into a CIMultiDict on the first access,
+    the lookup of a header not in the block needn't parse it
+    """
+
+    __slots__ = ('_block', '_lower_block', '_headers', '_raw_headers')
+
+    def __init__(self, block):
+        self._block = block
+        self._lower_block = None
+        self._headers = None
+        self._raw_headers = None
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._parse()
+        return self._headers
+
+    @property
+    def raw_headers(self):
+        if self._headers is None:
+            self._parse()
+        return self._raw_headers
+
+    def _parse(self):
+        items = []
+        if self._block:
+            for line in self._block.split(b'\r\n'):
+                if line[:1] in (b' ', b'\t'):
+                    # the continuation of previous header
+                    if items:
+                        items[-1][1] += line
+                    continue
+                name, sep, value = line.partition(b':')
+                name = name.strip(b' \t')
+                if not sep or not name or HDRRE.search(name):
+                    logger.debug('skip the invalid header: %s', line)
+                    continue
+                items.append([name, value])
+        headers = CIMultiDict()
+        raw_headers = []
+        for name, value in items:
+            value = value.strip()
+            headers.add(name.decode('utf-8', 'surrogateescape'), value.decode('utf-8', 'surrogateescape'))
+            raw_headers.append((name, value))
+        self._headers = headers
+        self._raw_headers = tuple(raw_headers)
+
+    def _absent(self, key):
+        """ True if the header is surely not in the head block, without parsing it """
+        if self._headers is not None:
+            return False
+        if self._lower_block is None:
+            self._lower_block = self._block.lower()
+        return key.lower().encode('utf-8', 'surrogateescape') not in self._lower_block
+
+    def should_close(self, default_close):
+        conn = self.get(hdrs.CONNECTION)
+        if conn:
+            v = conn.lower()
+            if v == 'close':
+                return True
+            elif v == 'keep-alive':
+                return False
+        return default_close
+
+    @property
+    def compression(self):
+        enc = self.get(hdrs.CONTENT_ENCODING)
+        if enc:
+            enc = enc.lower()
+            if enc in ('gzip', 'deflate', 'br'):
+                return enc
+        return None
+
+    def __contains__(self, key):
+        if self._absent(key):
+            return False
+        return key in self.headers
+
+    def __getitem__(self, key):
+        return self.headers[key]
+
+    def get(self, key, default=None):
+        if self._absent(key):
+            return default
+        return self.headers.get(key, default)
+
+    def __setitem__(self, key, value):
+        self.headers[key] = value
+
+    def __delitem__(self, key):
+        del self.headers[key]
+
+    def __iter__(self):
+        return iter(self.headers)
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __getattr__(self, name):
+        # getall/getone/items/keys/values/add ... of the CIMultiDict
+        return getattr(self.headers, name)
+
+    def __repr__(self):
+        return '<RequestHeaders(%s)>' % ('...' if self._headers is None else self._headers)
 
 
 class HttpResponseParser(HttpParser):
@@ -286,6 +476,178 @@ class HttpResponseParser(HttpParser):
         return version, status, reason, close
 
 
+class ResponseHeadScanner(object):
+    """
+    accumulates the response head across the chunks and parses it once its end(\\r\\n\\r\\n) found,
+    every byte is scanned once, and the body in the chunk is a memoryview of it
+    """
+
+    def __init__(self, parser, request_method='GET', max_head_size=65536):
+        self._parser = parser
+        self._request_method = request_method
+        self._max_head_size = max_head_size
+        self._head = bytearray()
+
+    def feed(self, data):
+        """
+        :return: the ResponseMessage once the head completed, else None,
+                 the raw_data of an error response is the head of the previous chunks, so it can be forwarded as it is
+        """
+        head = self._head
+        held = len(head)
+        end = -1
+        if head:
+            # the end of head may span the chunks
+            joint_start = max(0, len(head) - 3)
+            pos = (bytes(head[joint_start:]) + bytes(data[:3])).find(b'\r\n\r\n')
+            if pos >= 0:
+                end = joint_start + pos + 4 - len(head)
+        if end < 0:
+            pos = data.find(b'\r\n\r\n')
+            if pos < 0:
+                head += data
+                if len(head) > self._max_head_size:
+                    self._head = bytearray()
+                    return bad_response(errors.LineTooLong('response head', self._max_head_size), raw_data=bytes(head[:held]))
+                return None
+            end = pos + 4
+        head += data[:end]
+        self._head = bytearray()
+        response, _ = self._parser.parse_response(bytes(head), self._request_method)
+        if response is not None and response.error is None:
+            body = memoryview(data)[end:]
+            if response.content_length is not None and len(body) > response.content_length:
+                body = body[:response.content_length]
+            response = response._replace(body=body)
+        elif response is not None:
+            response = response._replace(raw_data=bytes(head[:held]))
+        return response
+
+
+class ResponseFramer(object):
+    """
+    follows the framing(Content-Length/chunked) of the responses on a connection to the server,
+    to know whether it is between the responses(idle) and can be kept alive for the next request
+    """
+
+    _HEAD, _BODY, _CHUNK_SIZE, _CHUNK_DATA, _TRAILER = range(5)
+
+    def __init__(self, parser=None, max_head_size=65536):
+        self._parser = parser if parser else HttpResponseParser()
+        self._max_head_size = max_head_size
+        self._methods = collections.deque()
+        self._state = self._HEAD
+        self._remaining = 0
+        self._buf = bytearray()
+        # False once a response can't be framed or asks to close, the connection is useless after it
+        self.reusable = True
+        # seconds the server keeps the idle connection(Keep-Alive: timeout=N), None if not told
+        self.keepalive_timeout = None
+
+    @property
+    def idle(self):
+        """ all the responses of the requests sent are received """
+        return self.reusable and not self._methods and self._state == self._HEAD and not self._buf
+
+    def on_request(self, request):
+        content_length = request.headers.get(hdrs.CONTENT_LENGTH, '0')
+        if request.should_close or hdrs.TRANSFER_ENCODING in request.headers \
+                or not content_length.isdigit() or int(content_length) != len(request.body):
+            # it asks to close, or the request body is not sent as a whole with its head
+            self.reusable = False
+        self._methods.append(request.method)
+
+    def feed(self, data):
+        pos = 0
+        while pos < len(data) and self.reusable:
+            state = self._state
+            if state == self._BODY or state == self._CHUNK_DATA:
+                n = min(self._remaining, len(data) - pos)
+                pos += n
+                self._remaining -= n
+                if self._remaining == 0:
+                    self._state = self._HEAD if state == self._BODY else self._CHUNK_SIZE
+                continue
+            line, pos = self._take_line(data, pos, b'\r\n\r\n' if state == self._HEAD else b'\r\n')
+            if line is None:
+                break
+            if state == self._HEAD:
+                self._on_head(line)
+            elif state == self._CHUNK_SIZE:
+                try:
+                    size = int(line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    self.reusable = False
+                    break
+                if size > 0:
+                    # the chunk data and its \r\n
+                    self._remaining = size + 2
+                    self._state = self._CHUNK_DATA
+                else:
+                    self._state = self._TRAILER
+            elif line == b'\r\n':
+                # the end of trailer
+                self._state = self._HEAD
+
+    def _take_line(self, data, pos, sep):
+        """ :return: (the line ends with sep, the position after it), (None, len(data)) if sep not found yet """
+        buf = self._buf
+        end = -1
+        if buf:
+            # sep may span the chunks
+            joint_start = max(0, len(buf) - len(sep) + 1)
+            i = (bytes(buf[joint_start:]) + bytes(data[pos:pos + len(sep) - 1])).find(sep)
+            if i >= 0:
+                end = pos + joint_start + i + len(sep) - len(buf)
+        if end < 0:
+            i = data.find(sep, pos)
+            if i < 0:
+                buf += data[pos:]
+                if len(buf) > self._max_head_size:
+                    self.reusable = False
+                return None, len(data)
+            end = i + len(sep)
+        if buf:
+            line = bytes(buf + data[pos:end])
+            self._buf = bytearray()
+        else:
+            line = bytes(data[pos:end])
+        return line, end
+
+    def _on_head(self, head):
+        if not self._methods:
+            # a response not requested
+            self.reusable = False
+            return
+        method = self._methods[0]
+        response, _ = self._parser.parse_response(head, method)
+        if response is None or response.error is not None or response.code == 101:
+            self.reusable = False
+            return
+        if 100 <= response.code < 200:
+            # the interim response, the final one follows
+            return
+        self._methods.popleft()
+        keep_alive = response.headers.get('Keep-Alive')
+        if keep_alive:
+            m = KEEPALIVE_TIMEOUT_RE.search(keep_alive)
+            if m:
+                self.keepalive_timeout = int(m.group(1))
+        if response.should_close:
+            self.reusable = False
+        elif method == 'HEAD' or response.code == NO_CONTENT or response.code == NOT_MODIFIED:
+            pass
+        elif response.chunked:
+            self._state = self._CHUNK_SIZE
+        elif response.content_length is not None:
+            if response.content_length > 0:
+                self._remaining = response.content_length
+                self._state = self._BODY
+        else:
+            # the body ends on close
+            self.reusable = False
+
+
 # ['version', 'code', 'reason', 'headers', 'raw_headers',
 #  'should_close', 'compression', 'chunked', 'content_length', 'response_line',
 #  'head_length', 'var', 'body', 'raw_data', 'error'])
@@ -354,7 +716,7 @@ def test():
     )
     parser = HttpRequestParser()
     # res = parser.request_parse(request_text, hostname='www.google.com', port=80)
-    res = parser._parse_request(request_text, None, None, None, None)
+    res = asyncio.get_event_loop().run_until_complete(_parse_chunks(parser, [request_text]))
     test_parse(res)
 
 
@@ -410,5 +772,78 @@ def test_unparse(res, parser):
     # print(request.headers['host'])  # "cm.bell-labs.com"
 
 
+@asyncio.coroutine
+def _parse_chunks(parser, chunks, loop=None):
+    """ parse the request arriving in chunks from a reader """
+    from tsproxy import streams
+    loop = loop if loop else asyncio.get_event_loop()
+    reader = streams.StreamReader(loop=loop)
+    reader.feed_data(chunks[0])
+    for chunk in chunks[1:]:
+        loop.call_soon(reader.feed_data, chunk)
+    raw_data = yield from reader.read_bytes()
+    request = yield from parser.parse_request(reader, raw_data)
+    return request
+
+
+BROWSER_HEADERS = (
+    b'Proxy-Connection: keep-alive\r\n'
+    b'Upgrade-Insecure-Requests: 1\r\n'
+    b'User-Agent: Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_1) AppleWebKit/537.36 (KHTML, like Gecko) '
+    b'Chrome/70.0.3538.102 Safari/537.36\r\n'
+    b'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8\r\n'
+    b'Accept-Encoding: gzip, deflate\r\n'
+    b'Accept-Language: zh-CN,zh;q=0.9,en;q=0.8\r\n'
+    b'Cookie: _ga=GA1.2.1234567890.1541234567; _gid=GA1.2.987654321.1542345678; session=abcdef0123456789\r\n'
+)
+
+REQUEST_CORPUS = {
+    'browser': [
+        [b'GET http://www.example.com/index.html?from=home&lang=zh HTTP/1.1\r\nHost: www.example.com\r\n' + BROWSER_HEADERS + b'\r\n'],
+        [b'GET http://static.example.com:8080/js/app.min.js;v=3 HTTP/1.1\r\nHost: static.example.com:8080\r\n' + BROWSER_HEADERS + b'\r\n'],
+        [b'POST http://api.example.com/v1/items HTTP/1.1\r\nHost: api.example.com\r\nContent-Type: application/json\r\n'
+         b'Content-Length: 27\r\n' + BROWSER_HEADERS + b'\r\n{"name":"item","count":100}'],
+    ],
+    'connect': [
+        [b'CONNECT www.google.com:443 HTTP/1.1\r\nHost: www.google.com:443\r\nProxy-Connection: keep-alive\r\n'
+         b'User-Agent: Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_1) AppleWebKit/537.36\r\n\r\n'],
+        [b'CONNECT [2001:db8::1]:8443 HTTP/1.1\r\nHost: [2001:db8::1]:8443\r\n\r\n'],
+    ],
+    'split': [
+        [b'GET http://www.example.com/a/b/c.html HTTP/1.1\r\nHost: www.exam', b'ple.com\r\n' + BROWSER_HEADERS + b'\r', b'\n'],
+        [b'GET http://www.exam', b'ple.com/ HTTP/1.1\r\nHost: www.example.com\r\n' + BROWSER_HEADERS + b'\r\n'],
+    ],
+    'malformed': [
+        [b'GARBAGE\r\n\r\n'],
+        [b'GET http://www.example.com/ HTTX/1.1\r\nHost: www.example.com\r\n\r\n'],
+        [b'GET http://www.example.com:80a/ HTTP/1.1\r\nHost: www.example.com\r\n\r\n'],
+        [b'G{T / HTTP/1.1\r\nHost: www.example.com\r\n\r\n'],
+        [b'GET http://www.example.com/ HTTP/1.1\r\nHost www.example.com\r\nBad Name: x\r\n' + BROWSER_HEADERS + b'\r\n'],
+    ],
+}
+
+
+def benchmark_request_parser(count=20000):
+    """ the us per request of parse_request(and the lookup of Proxy-Name) over REQUEST_CORPUS """
+    loop = asyncio.get_event_loop()
+    parser = HttpRequestParser()
+
+    @asyncio.coroutine
+    def run(requests):
+        for i in range(count):
+            request = yield from _parse_chunks(parser, requests[i % len(requests)], loop=loop)
+            if request.error is None:
+                'Proxy-Name' in request.headers
+
+    for name in sorted(REQUEST_CORPUS):
+        start = time.perf_counter()
+        loop.run_until_complete(run(REQUEST_CORPUS[name]))
+        print('%-10s %6.2f us/request' % (name, (time.perf_counter() - start) * 1e6 / count))
+
+
 if __name__ == '__main__':
-    test()
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark_request_parser()
+    else:
+        test()
@@ -10,15 +10,16 @@ import platform
 from io import BytesIO
 from io import StringIO
 
+import tsproxy.connector
 import tsproxy.proxy
 from tsproxy import httphelper2 as httphelper
-from tsproxy import common, proxy, streams, topendns, str_datetime, __version__
+from tsproxy import common, metrics, proxy, streams, topendns, str_datetime, __version__
 
 
 HTTP_REQUEST = 'listener.HTTP_REQUEST'
 
 HTTP_RESPONSE = 'listener.HTTP_RESPONSE'
-HTTP_RESPONSE_RAW_DATA = 'listener.HTTP_RESPONSE_RAW_DATA'
+HTTP_RESPONSE_HEAD_SCANNER = 'listener.HTTP_RESPONSE_HEAD_SCANNER'
 
 HTTP_REQUEST_LENGTH = 'listener.HTTP_REQUEST_LENGTH'
 HTTP_RESPONSE_LENGTH = 'listener.HTTP_RESPONSE_LENGTH'
@@ -75,7 +76,7 @@ class HttpListener(Listener):
                          decoder=HttpRequestDecoder(), encoder=HttpResponseEncoder(), **kwargs)
         self.connector = connector
         self.connections = {}
-        self._processes = common.FIFOCache(cache_timeout=60, lru=True)
+        self._processes = metrics.register_cache(common.LRUCache(cache_timeout=60, refresh_on_get=True, name='processes'))
         self._pid = psutil.Process().pid
         self._root_access_deny = 0
         self._root_access_deny_time = 0
@@ -122,9 +123,8 @@ class HttpListener(Listener):
             pid = int(tmp[1])
             pids.append(pid)
         for pid in sorted(pids, key=lambda _pid: 0 if _pid == self._pid else _pid, reverse=True):
-            if pid in self._processes:
-                proc = self._processes[pid]
-            else:
+            proc = self._processes.get(pid)
+            if proc is None:
                 proc = psutil.Process(pid)
                 self._processes[pid] = proc
             connection['process_pid'] = proc.pid
@@ -147,9 +147,8 @@ class HttpListener(Listener):
                     ip1 = int.from_bytes(socket.inet_pton(c.family, c.laddr[0]), byteorder='big')
                     ip2 = int.from_bytes(socket.inet_pton(connection.family, connection.laddr), byteorder='big')
                     if ip1 == ip2:
-                        if c.pid in self._processes:
-                            proc = self._processes[c.pid]
-                        else:
+                        proc = self._processes.get(c.pid)
+                        if proc is None:
                             proc = psutil.Process(c.pid)
                             self._processes[c.pid] = proc
                         connection['process_pid'] = proc.pid
@@ -183,9 +182,10 @@ class HttpListener(Listener):
         elif head_request.error:
             return False
 
-        logger.info('%s handling "%s"' % (connection, head_request.request_line))
-        for k in head_request.headers:
-            logger.log(5, '%s "%s: %s"', connection, k, head_request.headers[k])
+        logger.info('%s handling "%s"', connection, head_request.request_line)
+        if logger.isEnabledFor(5):
+            for k in head_request.headers:
+                logger.log(5, '%s "%s: %s"', connection, k, head_request.headers[k])
 
         host = head_request.url.hostname
         port = head_request.url.port
@@ -196,29 +196,10 @@ class HttpListener(Listener):
 
         proxy_name = self.get_proxy_name(head_request)
 
-        try:
-            peer_conn = yield from self.connector.connect(peer=connection, target_host=host, target_port=port, proxy_name=proxy_name, loop=self.loop, request=head_request)
-        except concurrent.futures.CancelledError:
-            connection.set_attr(HTTP_RESPONSE, httphelper.http_response(head_request.version, 500, 'Proxy is close(TSP)'))
-            return False
-        except (TimeoutError, asyncio.TimeoutError):
-            connection.set_attr(HTTP_RESPONSE, httphelper.http_response(head_request.version, 503, 'Connect proxy timeout(TSP)'))
-            return False
-        except socket.gaierror as ex:
-            logger.debug("%s connector.connect to %s:%d fail: %s(%s)", connection, host, port, common.clazz_fullname(ex), ex)
-            connection.set_attr(HTTP_RESPONSE, httphelper.http_response(head_request.version, 503, 'Dns(%s) fail(TSP)' % host))
-            return False
-        except ConnectionError as ex:
-            logger.info("%s connector.connect to %s:%d fail: %s(%s)", connection, host, port, common.clazz_fullname(ex), ex)
-            connection.set_attr(HTTP_RESPONSE, httphelper.http_response(head_request.version, 503, '%s(TSP)' % ex.strerror))
-            return False
-        except BaseException as ex:
-            logger.exception("%s connector.connect to %s:%d fail: %s(%s)", connection, host, port, common.clazz_fullname(ex), ex)
-            connection.set_attr(HTTP_RESPONSE, httphelper.http_response(head_request.version, 503))
+        peer_conn = yield from self.connect_peer(connection, head_request, host, port, proxy_name)
+        if peer_conn is None:
             return False
 
-        connection.set_attr(proxy.PEER_CONNECTION, peer_conn)
-
         if head_request.method == common.HTTPS_METHOD_CONNECT:
             logger.info("https-proxy(%s) HANDLING '%s'", connection, head_request.request_line)
             yield from self.do_https_forward(head_request, connection, peer_conn)
@@ -229,6 +210,12 @@ class HttpListener(Listener):
         while True:
             logger.info("http-proxy(%s) HANDLING '%s'", connection, head_request.request_line)
             # handle http forward
+            if not (yield from self.send_http_request(head_request, connection, peer_conn)):
+                logger.info("http-proxy(%s) %s closed before responding, retry on a new connection", connection, peer_conn)
+                peer_conn = yield from self.connect_peer(connection, head_request, host, port, proxy_name, reuse=False)
+                if peer_conn is None:
+                    return False
+                yield from self.send_http_request(head_request, connection, peer_conn)
             next_request = yield from self.do_http_forward(head_request, connection, peer_conn)
             if next_request:
                 if HTTP_RESPONSE in connection:
@@ -244,13 +231,46 @@ class HttpListener(Listener):
                     continue
                 else:
                     logger.info("http-proxy(%s) DONE", connection)
-                    peer_conn.close()
+                    self.release_peer(peer_conn)
                     return True
             else:
                 logger.info("http-proxy(%s) DONE", connection)
-                peer_conn.close()
+                self.release_peer(peer_conn)
                 return False
 
+    def connect_peer(self, connection, head_request, host, port, proxy_name, **kwargs):
+        """ :return: the connection to the server, None if failed and the error response is set """
+        try:
+            peer_conn = yield from self.connector.connect(peer=connection, target_host=host, target_port=port, proxy_name=proxy_name, loop=self.loop, request=head_request, **kwargs)
+        except concurrent.futures.CancelledError:
+            connection.set_attr(HTTP_RESPONSE, httphelper.http_response(head_request.version, 500, 'Proxy is close(TSP)'))
+            return None
+        except (TimeoutError, asyncio.TimeoutError):
+            connection.set_attr(HTTP_RESPONSE, httphelper.http_response(head_request.version, 503, 'Connect proxy timeout(TSP)'))
+            return None
+        except socket.gaierror as ex:
+            logger.debug("%s connector.connect to %s:%d fail: %s(%s)", connection, host, port, common.clazz_fullname(ex), ex)
+            connection.set_attr(HTTP_RESPONSE, httphelper.http_response(head_request.version, 503, 'Dns(%s) fail(TSP)' % host))
+            return None
+        except ConnectionError as ex:
+            logger.info("%s connector.connect to %s:%d fail: %s(%s)", connection, host, port, common.clazz_fullname(ex), ex)
+            connection.set_attr(HTTP_RESPONSE, httphelper.http_response(head_request.version, 503, '%s(TSP)' % ex.strerror))
+            return None
+        except BaseException as ex:
+            logger.exception("%s connector.connect to %s:%d fail: %s(%s)", connection, host, port, common.clazz_fullname(ex), ex)
+            connection.set_attr(HTTP_RESPONSE, httphelper.http_response(head_request.version, 503))
+            return None
+
+        connection.set_attr(proxy.PEER_CONNECTION, peer_conn)
+        return peer_conn
+
+    @staticmethod
+    def release_peer(peer_conn):
+        """ keep the connection alive for the next client if its responses are framed, else close it """
+        keepalive = peer_conn.get_attr(common.KEY_HTTP_KEEPALIVE)
+        if keepalive is None or not keepalive.release(peer_conn):
+            peer_conn.close()
+
     def do_https_forward(self, request, connection, peer_conn):
         connection.writer.write(httphelper.https_proxy_response(request.version))
         yield from common.forward_forever(connection, peer_conn, is_responsed=True)
@@ -259,13 +279,25 @@ class HttpListener(Listener):
     def stop_on_httprequest(data):
         return isinstance(data, httphelper.RequestMessage)
 
-    def do_http_forward(self, request, connection, peer_conn):
+    def send_http_request(self, request, connection, peer_conn):
+        """ :return: False if the kept-alive peer_conn is closed before responding and the request can be resent """
         peer_conn[common.KEY_FIRST_HTTP_REQUEST] = request
+        keepalive = peer_conn.get_attr(common.KEY_HTTP_KEEPALIVE)
+        if keepalive is not None:
+            keepalive.on_request(request)
         data = self.rewrite_request(request)
-        peer_conn.writer.write(data)
-        yield from peer_conn.writer.drain()
+        try:
+            peer_conn.writer.write(data)
+            yield from peer_conn.writer.drain()
+        except ConnectionError:
+            if keepalive is None or keepalive.retry_request is not request:
+                raise
         common.forward_log(logger, connection, peer_conn, data)
+        if keepalive is None or (yield from keepalive.wait_responding(request)):
+            return True
+        return peer_conn.response_timeout or connection.is_closing
 
+    def do_http_forward(self, request, connection, peer_conn):
         data, _ = yield from common.forward_forever(connection, peer_conn, is_responsed=True, stop_func=self.stop_on_httprequest)
         return data
 
@@ -337,6 +369,9 @@ class ManageableHttpListener(HttpListener):
             elif request.url.path == '/favicon.ico':
                 res_cont = ''
                 code = 404
+            elif request.url.path == '/metrics':
+                res_cont = metrics.exposition()
+                code = 200
             else:
                 if request.url.path == '/' or request.url.path == '/list':
                     cmd_line = '--list'
@@ -368,9 +403,12 @@ class ManageableHttpListener(HttpListener):
         except BaseException as e:
             logger.exception(e)
 
-    def do_command(self, cmd_line, out, cmd_conneciton, user_agent=None):
+    def do_command(self, cmd_line, out, cmd_conneciton, user_agent=None, fanout=True):
+        """ :param fanout: send the mutating command to the other workers too(--workers N) """
         cookie = 200
         cmd = self.cmd_parser.parse_args(cmd_line.split())
+        if fanout and self.proxy_holder.worker_bus is not None and self._is_mutating(cmd):
+            self.proxy_holder.worker_bus.send_command(cmd_line)
         if cmd.help:
             self.print_help(out)
         if cmd.conn:
@@ -417,6 +455,11 @@ class ManageableHttpListener(HttpListener):
             self.do_list(out, cmd.fspeed if user_agent is not None and 'curl' in user_agent else None)
         return cookie
 
+    @staticmethod
+    def _is_mutating(cmd):
+        return bool(cmd.acl_add_ips or cmd.acl_del_ips or cmd.inss or cmd.adds or cmd.dels or cmd.pauses or
+                    cmd.head or cmd.top or cmd.untop or cmd.tail or cmd.speed is not None or cmd.fspeed is not None)
+
     def print_help(self, out):
         self.cmd_parser.print_help(out)
 
@@ -483,6 +526,9 @@ class ManageableHttpListener(HttpListener):
         return self._do_add(out, adds)
 
     def do_speed(self, out, hosts, foreground=False):
+        if self.proxy_holder.is_follower:
+            out.write('speed test started on the leader worker... %s \r\n' % hosts)
+            return 200
         out.write('speed test started... %s \r\n' % hosts)
         if len(hosts) == 0 or (hosts[0] == '*' or hosts[0] == 'all'):
             _hosts = None
@@ -523,6 +569,12 @@ class ManageableHttpListener(HttpListener):
         out.write('global tp90: %.1fs/%d/%d\r\n' % (tsproxy.proxy.ProxyStat.calc_tp90(),
                                                     tsproxy.proxy.ProxyStat.global_tp90_len,
                                                     tsproxy.proxy.ProxyStat.global_resp_count))
+        http_pool = tsproxy.connector.get_http_pool(self.loop)
+        if http_pool.hits + http_pool.misses > 0:
+            out.write('%s\r\n' % http_pool.stat_info())
+        route_cache = tsproxy.connector.route_cache
+        if route_cache.hits + route_cache.misses > 0:
+            out.write('%s\r\n' % route_cache.stat_info())
         _max_total_count = sorted(self.proxy_holder.proxy_list, key=lambda p: p.total_count, reverse=True)[0].total_count
         _max_sess_count = sorted(self.proxy_holder.proxy_list, key=lambda p: p.proxy_count, reverse=True)[0].proxy_count
         for i in range(0, self.proxy_holder.psize):
@@ -590,18 +642,24 @@ class HttpRequestDecoder(streams.Decoder):
                 # http已经有过响应的话，是一个新的request，需要解析
                 return request
             # parse bytes to request object
-            left_time = start_time + read_timeout - time.time()
-            request = yield from self._http_parser.parse_request(connection.reader, request, read_timeout=left_time if left_time >= 1 else 1)
+            if read_timeout is None:
+                # waiting the request without timeout, but the rest of it should come soon
+                parse_timeout = common.default_timeout
+            else:
+                left_time = start_time + read_timeout - time.time()
+                parse_timeout = left_time if left_time >= 1 else 1
+            request = yield from self._http_parser.parse_request(connection.reader, request, read_timeout=parse_timeout)
         except (TimeoutError, asyncio.TimeoutError):
             if HTTP_REQUEST in connection:
                 raise
             else:
-                request = httphelper.bad_request(timeout=read_timeout, request_time=start_time)
+                request = httphelper.bad_request(timeout=read_timeout if read_timeout else common.default_timeout, request_time=start_time)
         except OSError as ex:
             logger.info("%s parse_request fail: %s(%s)", connection, common.clazz_fullname(ex), ex)
             return None
         except Exception as ex:
             logger.exception("%s parse_request fail: %s(%s)", connection, common.clazz_fullname(ex), ex)
+            metrics.parser_errors.inc(type(ex).__name__)
             return None
         if request:
             # if HTTP_RESPONSE in connection:
@@ -610,6 +668,11 @@ class HttpRequestDecoder(streams.Decoder):
             connection.set_attr(HTTP_REQUEST, request)
         return request
 
+    def is_transparent(self, connection):
+        # the https tunnel is forwarded as it is
+        request = connection.get_attr(HTTP_REQUEST)
+        return isinstance(request, httphelper.RequestMessage) and request.method == common.HTTPS_METHOD_CONNECT
+
 
 class HttpResponseEncoder(streams.Encoder):
 
@@ -629,22 +692,29 @@ class HttpResponseEncoder(streams.Encoder):
                         connection.set_attr(HTTP_RESPONSE, data)
                         connection.set_attr(HTTP_RESPONSE_CONTENT_LENGTH, data.content_length)
                     else:
-                        # real parse response from bytes
-                        raw_data = connection.get_attr(HTTP_RESPONSE_RAW_DATA, b'') + data
-                        response, consumed = self._http_parser.parse_response(raw_data, head_request.method)
-                        connection.set_attr(HTTP_RESPONSE_RAW_DATA, raw_data[consumed:])
-                        if response:
+                        # real parse response from bytes, once its head completed
+                        scanner = connection.get_attr(HTTP_RESPONSE_HEAD_SCANNER)
+                        if scanner is None:
+                            scanner = connection.set_attr(HTTP_RESPONSE_HEAD_SCANNER,
+                                                          httphelper.ResponseHeadScanner(self._http_parser, head_request.method))
+                        response = scanner.feed(data)
+                        if response is None and 'Proxy-Name' in head_request.headers:
+                            # hold the head until rewritten
+                            data = b''
+                        elif response:
+                            if response.error is not None and 'Proxy-Name' in head_request.headers:
+                                # forward the held head as it is
+                                data = response.raw_data + data
                             connection.set_attr(HTTP_RESPONSE, response)
-                            connection.set_attr(HTTP_RESPONSE_CONTENT_LENGTH, len(response.body))
-                            if 'Proxy-Name' in head_request.headers:
+                            connection.set_attr(HTTP_RESPONSE_CONTENT_LENGTH, len(response.body) if response.body is not None else 0)
+                            if 'Proxy-Name' in head_request.headers and response.error is None:
                                 peer_conn = connection.get_attr(proxy.PEER_CONNECTION)
-                                if peer_conn:
-                                    rewrite_data = self.rewrite_response(response, {
-                                        'Proxy-Server': peer_conn.raddr,
-                                        'Proxy-LocalIP': peer_conn.laddr
-                                    })
-                                    logger.debug('rewrite_response: "%s" -> "%s"', data[:100], rewrite_data[:100])
-                                    data = rewrite_data
+                                rewrite_data = self.rewrite_response(response, {
+                                    'Proxy-Server': peer_conn.raddr,
+                                    'Proxy-LocalIP': peer_conn.laddr
+                                } if peer_conn else {})
+                                logger.debug('rewrite_response: "%s" -> "%s"', data[:100], rewrite_data[:100])
+                                data = rewrite_data
                 elif not isinstance(data, httphelper.ResponseMessage):
                     # 累计已接收的content-length
                     recv_length = connection.get_attr(HTTP_RESPONSE_CONTENT_LENGTH) + len(data)
@@ -660,6 +730,12 @@ class HttpResponseEncoder(streams.Encoder):
 
         return data.raw_data if isinstance(data, httphelper.ResponseMessage) else data
 
+    def is_transparent(self, connection):
+        # the https tunnel is forwarded as it is, after the first response marked
+        request = connection.get_attr(HTTP_REQUEST)
+        return isinstance(request, httphelper.RequestMessage) and request.method == common.HTTPS_METHOD_CONNECT \
+            and HTTP_RESPONSE in connection
+
     def rewrite_response(self, response, headers):
         buf = BytesIO()
         buf.write(('%s %d %s\r\n' % (response.version, response.code, response.reason)).encode())
@@ -695,7 +771,8 @@ def http_common_log(connection, request=None, response=None, mark='..', proxy_pr
     peer_conn = connection.get_attr(proxy.PEER_CONNECTION)
     if _request is not None and _request == LOGGED:  # it's logged
         return
-    if _request and response:
+    responsed = bool(_request and response)
+    if responsed:
         status = response.code
         reason = response.reason
         # common_logger.info("%s %d(%s) request=%s, response=%s", mark, response.code, response.reason, _request, response)
@@ -705,6 +782,7 @@ def http_common_log(connection, request=None, response=None, mark='..', proxy_pr
         # common_logger.info("%s no request", mark)
     else:  # no response
         if _request.error:
+            metrics.parser_errors.inc(type(_request.error).__name__)
             status = _request.error.code
             reason = _request.error.message
             # common_logger.info("%s %d(%s) %s request=%s", mark, _request.error.code, _request.error.message, _request.request_line, _request)
@@ -728,6 +806,12 @@ def http_common_log(connection, request=None, response=None, mark='..', proxy_pr
     first_time = (response.response_time - _request.request_time) if _request else 0
     all_time = time.time() - (_request.request_time if _request else connection.create_time)
 
+    metrics.requests.inc(proxy_name, str(response.code))
+    metrics.transferred_bytes.inc(proxy_name, 'up', value=upload_bytes)
+    metrics.transferred_bytes.inc(proxy_name, 'down', value=down_bytes)
+    if responsed:
+        metrics.first_byte_time.observe(first_time, proxy_name)
+
     common_logger.info('%s%s - %s/%s/"%s" - %s/%s%s/%.2fs/%.1fs - %s %s%s%s',
                        connection.laddr, ('/%d' % connection['process_pid']) if 'process_pid' in connection else '',
                        proxy_protocol, proxy_name, _request.request_line if _request else '',
@@ -740,10 +824,114 @@ def http_common_log(connection, request=None, response=None, mark='..', proxy_pr
     if not request:
         connection.set_attr(HTTP_REQUEST, LOGGED)  # mark it's logged
     connection.set_attr(HTTP_RESPONSE, None)
-    connection.set_attr(HTTP_RESPONSE_RAW_DATA, None)
+    connection.set_attr(HTTP_RESPONSE_HEAD_SCANNER, None)
     connection.set_attr(HTTP_RESPONSE_CONTENT_LENGTH, None)
     if peer_conn:
         peer_conn.set_attr(HTTP_REQUEST_LENGTH, upload_bytes)
         peer_conn.set_attr(HTTP_RESPONSE_LENGTH, down_bytes)
 
 
+def benchmark_requests(requests=3000, concurrency=20):
+    """ requests/sec of proxying to a local http server with INFO logging to files, without and with async_logging """
+    import shutil
+    import sys
+    import tempfile
+    from tsproxy.connector import DirectConnector
+
+    loop = asyncio.get_event_loop()
+    body = b'x' * 1024
+    response = b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s' % (len(body), body)
+
+    @asyncio.coroutine
+    def origin(reader, writer):
+        yield from reader.readuntil(b'\r\n\r\n')
+        writer.write(response)
+        yield from writer.drain()
+        writer.close()
+
+    origin_server = loop.run_until_complete(asyncio.start_server(origin, '127.0.0.1', 0, loop=loop))
+    origin_port = origin_server.sockets[0].getsockname()[1]
+    request = b'GET http://127.0.0.1:%d/ HTTP/1.1\r\nHost: 127.0.0.1:%d\r\nConnection: close\r\n\r\n' % (origin_port, origin_port)
+
+    class BenchListener(HttpListener):
+        def get_connection_process(self, connection):
+            # scanning the connections of the system by psutil costs more than the logging
+            pass
+
+    listener = BenchListener(('127.0.0.1', 0), DirectConnector(loop), loop=loop)
+    proxy_server = loop.run_until_complete(listener.start())
+    proxy_port = proxy_server.sockets[0].getsockname()[1]
+
+    @asyncio.coroutine
+    def client(count):
+        for _ in range(0, count):
+            reader, writer = yield from asyncio.open_connection('127.0.0.1', proxy_port, loop=loop)
+            writer.write(request)
+            # close after the response, not waiting the proxy to close
+            yield from reader.readexactly(len(response))
+            writer.close()
+
+    log_dir = tempfile.mkdtemp()
+    root_logger = logging.getLogger()
+    try:
+        for async_logging in (False, True):
+            for _logger in (root_logger, common_logger):
+                for h in list(_logger.handlers):
+                    _logger.removeHandler(h)
+                    h.close()
+            formatter = logging.Formatter('%(asctime)s %(levelname)-5s [%(threadName)-14s] %(name)-16s - %(message)s')
+            file_handler = logging.FileHandler('%s/tsproxy-%s.log' % (log_dir, async_logging))
+            file_handler.setFormatter(formatter)
+            root_logger.addHandler(file_handler)
+            root_logger.setLevel(logging.INFO)
+            http_log_handler = logging.FileHandler('%s/http-proxy-%s.log' % (log_dir, async_logging))
+            http_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+            common_logger.addHandler(http_log_handler)
+            common_logger.propagate = False
+            if async_logging:
+                common.start_async_logging()
+
+            start = time.time()
+            loop.run_until_complete(asyncio.gather(*[client(requests // concurrency) for _ in range(0, concurrency)], loop=loop))
+            used = time.time() - start
+            for _logger in (root_logger, common_logger):
+                for h in _logger.handlers:
+                    h.flush()
+            with open('%s/tsproxy-%s.log' % (log_dir, async_logging)) as f:
+                lines = len(f.readlines())
+            print('async_logging=%s: %d requests in %.2f sec, %.0f requests/sec, %d log lines' %
+                  (async_logging, requests, used, requests / used, lines), file=sys.stderr)
+    finally:
+        proxy_server.close()
+        origin_server.close()
+        shutil.rmtree(log_dir)
+
+
+def test_response_encoder():
+    """ a bad response head held for the Proxy-Name rewriting is forwarded as it is """
+    loop = asyncio.get_event_loop()
+    request = loop.run_until_complete(httphelper._parse_chunks(httphelper.HttpRequestParser(), [
+        b'GET http://example.com/ HTTP/1.1\r\nHost: example.com\r\nProxy-Name: jp.a\r\n\r\n']))
+    bad_heads = (
+        b'HTTP/1.1 abc OK\r\nServer: test\r\nContent-Length: 2\r\n\r\nok',
+        b'HTTP/1.1 200 OK\r\nX-Long: ' + b'x' * 70000 + b'\r\nContent-Length: 2\r\n\r\nok',
+    )
+    for head in bad_heads:
+        for chunk_size in (7, 1000, 16384):
+            encoder = HttpResponseEncoder()
+            connection = streams.StreamConnection.__new__(streams.StreamConnection)
+            connection.set_attr(HTTP_REQUEST, request)
+            forwarded = b''.join(bytes(encoder(head[i:i+chunk_size], connection)) for i in range(0, len(head), chunk_size))
+            assert connection.get_attr(HTTP_RESPONSE).error is not None
+            assert forwarded == head, 'chunk_size=%d: forwarded %d of %d bytes' % (chunk_size, len(forwarded), len(head))
+    print('test_response_encoder ok')
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'test':
+        test_response_encoder()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        # python -m tsproxy.listener bench [requests]
+        benchmark_requests(*[int(arg) for arg in sys.argv[2:3]])
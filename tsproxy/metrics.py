@@ -0,0 +1,143 @@
+import bisect
+import logging
+
+logger = logging.getLogger(__name__)
+
+# the seconds buckets of connect/dns/first byte time
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_metrics = []
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _fmt_labels(names, values, extra=''):
+    labels = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{%s}' % ','.join(labels) if labels else ''
+
+
+def _fmt_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        """
+        :param collect: function returns [(label values tuple, value)], the values are collected on exposition
+                        instead of updated by inc/dec/observe
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._collect = collect
+        self._values = {}
+        _metrics.append(self)
+
+    def samples(self):
+        return list(self._collect()) if self._collect is not None else sorted(self._values.items())
+
+    def exposition(self, out):
+        out.append('# HELP %s %s' % (self.name, self.documentation))
+        out.append('# TYPE %s %s' % (self.name, self.kind))
+        for labels, value in self.samples():
+            out.append('%s%s %s' % (self.name, _fmt_labels(self.labelnames, labels), _fmt_value(value)))
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, value=1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, *labels, value=1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def dec(self, *labels, value=1):
+        self._values[labels] = self._values.get(labels, 0) - value
+
+    def set(self, *labels, value=0):
+        self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        # [count of each bucket..., count of +Inf, sum]
+        counts = self._values.get(labels)
+        if counts is None:
+            counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def exposition(self, out):
+        out.append('# HELP %s %s' % (self.name, self.documentation))
+        out.append('# TYPE %s %s' % (self.name, self.kind))
+        for labels, counts in self.samples():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = 'le="%s"' % (bound if isinstance(bound, str) else _fmt_value(float(bound)))
+                out.append('%s_bucket%s %d' % (self.name, _fmt_labels(self.labelnames, labels, le), cumulative))
+            out.append('%s_sum%s %s' % (self.name, _fmt_labels(self.labelnames, labels), _fmt_value(float(counts[-1]))))
+            out.append('%s_count%s %d' % (self.name, _fmt_labels(self.labelnames, labels), cumulative))
+
+
+_caches = []
+
+
+def register_cache(cache):
+    """ export the hits/misses of the common.LRUCache """
+    _caches.append(cache)
+    return cache
+
+
+def _collect_caches(func):
+    return lambda: [((cache.name,), func(cache)) for cache in _caches]
+
+
+connect_time = Histogram('tsproxy_connect_seconds', 'seconds of connecting to the proxy(D for direct)', ('proxy',))
+connect_failures = Counter('tsproxy_connect_failures_total', 'failed connects to the proxy(D for direct)', ('proxy',))
+active_connections = Gauge('tsproxy_active_connections', 'the connections to the proxy(D for direct)', ('proxy',))
+dns_time = Histogram('tsproxy_dns_seconds', 'seconds of the dns lookups not answered by the cache', ('resolver',))
+dns_failures = Counter('tsproxy_dns_failures_total', 'failed dns lookups', ('resolver',))
+first_byte_time = Histogram('tsproxy_first_byte_seconds', 'seconds from the request to its response', ('proxy',))
+requests = Counter('tsproxy_requests_total', 'the http requests logged', ('proxy', 'code'))
+transferred_bytes = Counter('tsproxy_bytes_total', 'bytes of the requests(up) and responses(down)', ('proxy', 'direction'))
+parser_errors = Counter('tsproxy_parser_errors_total', 'errors of the http request parsing', ('error',))
+http_pool_requests = Counter('tsproxy_http_pool_requests_total', 'connects of the plain http hit or miss the keep-alive pool(D for direct)', ('proxy', 'result'))
+forward_closes = Counter('tsproxy_forward_closes_total', 'connections closed by the forwarding for idle or response timeout', ('reason',))
+cache_hits = Counter('tsproxy_cache_hits_total', 'hits(include the stale hits) of the cache', ('cache',),
+                     collect=_collect_caches(lambda c: c.hits + c.stale_hits))
+cache_misses = Counter('tsproxy_cache_misses_total', 'misses of the cache', ('cache',),
+                       collect=_collect_caches(lambda c: c.misses))
+cache_hit_ratio = Gauge('tsproxy_cache_hit_ratio', 'hits / (hits + misses) of the cache', ('cache',),
+                        collect=_collect_caches(lambda c: c.hit_rate))
+cache_entries = Gauge('tsproxy_cache_entries', 'entries in the cache', ('cache',),
+                      collect=_collect_caches(len))
+
+
+def exposition():
+    """ the metrics in the prometheus text exposition format """
+    out = []
+    for metric in _metrics:
+        try:
+            metric.exposition(out)
+        except Exception as ex:
+            logger.warning('exposition of %s fail: %s(%s)', metric.name, type(ex).__name__, ex)
+    out.append('')
+    return '\n'.join(out)
@@ -1,6 +1,10 @@
+import array
 import asyncio
+import collections
+import ctypes
 import json
 import logging
+import math
 import os
 import socket
 import time
@@ -17,46 +21,323 @@ from tsproxy import common, streams, topendns, str_datetime
 
 logger = logging.getLogger(__name__)
 
+
+def _own_cipher_buffers():
+    """
+    the openssl/sodium ciphers of shadowsocks write into an output buffer global to the module,
+    give every cipher its own one, so the ciphers of the connections run in the crypto executor at the same time
+    """
+    try:
+        from shadowsocks.crypto import openssl, sodium
+    except ImportError:
+        return
+
+    def _out_buf(cipher, size):
+        buf = cipher.__dict__.get('_out_buf')
+        if buf is None or len(buf) < size:
+            buf = cipher._out_buf = ctypes.create_string_buffer(max(size * 2, 2048))
+        return buf
+
+    def _openssl_update(self, data):
+        data_len = len(data)
+        buf = _out_buf(self, data_len)
+        out_len = ctypes.c_long(0)
+        openssl.libcrypto.EVP_CipherUpdate(self._ctx, ctypes.byref(buf), ctypes.byref(out_len), ctypes.c_char_p(data), data_len)
+        return ctypes.string_at(buf, out_len.value)
+
+    def _sodium_update(self, data):
+        data_len = len(data)
+        # the padding aligns the en/decryption to the blocks
+        padding = self.counter % sodium.BLOCK_SIZE
+        buf = _out_buf(self, padding + data_len)
+        if padding:
+            data = (b'\0' * padding) + data
+        self.cipher(ctypes.byref(buf), ctypes.c_char_p(data), padding + data_len,
+                    self.iv_ptr, int(self.counter / sodium.BLOCK_SIZE), self.key_ptr)
+        self.counter += data_len
+        return ctypes.string_at(ctypes.addressof(buf) + padding, data_len)
+
+    openssl_crypto = getattr(openssl, 'OpenSSLCrypto', None) or getattr(openssl, 'OpenSSLCryptoBase', None)
+    if openssl_crypto is not None:
+        openssl_crypto.update = _openssl_update
+    sodium.SodiumCrypto.update = _sodium_update
+
+
+_own_cipher_buffers()
+
 PEER_CONNECTION = 'proxy.PEER_CONNECTION'
 PROXY_NAME = 'proxy.PROXY_NAME'
 
 
+class LatencyStat(object):
+    """ the response times of a proxy(or all the proxies) in ProxyStat.global_resp_time """
+
+    def __init__(self):
+        self.histogram = common.LogHistogram()
+        self.count = 0
+        self.fail_count = 0
+
+    def add(self, resp_time, failed):
+        self.count += 1
+        if failed:
+            self.fail_count += 1
+        if resp_time >= 0:
+            self.histogram.add(resp_time)
+
+    def remove(self, resp_time, failed):
+        self.count -= 1
+        if failed:
+            self.fail_count -= 1
+        if resp_time >= 0:
+            self.histogram.remove(resp_time)
+
+
+_no_latency = LatencyStat()
+
+
+class ResponseTimeRing(object):
+    """ the latest response times of a proxy ip in fixed capacity arrays, dropped by advancing the head """
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._in_times = array.array('d', bytes(8 * capacity))
+        self._resp_times = array.array('d', bytes(8 * capacity))
+        # bitset of failed or timeout
+        self._fails = bytearray((capacity + 7) // 8)
+        self._head = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _failed(self, idx):
+        return (self._fails[idx >> 3] >> (idx & 7)) & 1 == 1
+
+    def append(self, in_time, resp_time, failed, stats):
+        """ drop the oldest if full, and keep the LatencyStat of stats in step """
+        if self._size == self._capacity:
+            self._pop(stats)
+        idx = (self._head + self._size) % self._capacity
+        self._in_times[idx] = in_time
+        self._resp_times[idx] = resp_time
+        if failed:
+            self._fails[idx >> 3] |= 1 << (idx & 7)
+        else:
+            self._fails[idx >> 3] &= ~(1 << (idx & 7))
+        self._size += 1
+        for stat in stats:
+            stat.add(resp_time, failed)
+
+    def _pop(self, stats):
+        idx = self._head
+        for stat in stats:
+            stat.remove(self._resp_times[idx], self._failed(idx))
+        self._head = (idx + 1) % self._capacity
+        self._size -= 1
+
+    def expire(self, before_time, stats):
+        """ :return: in time of the oldest left, 0 if empty """
+        while self._size > 0 and self._in_times[self._head] < before_time:
+            self._pop(stats)
+        return self._in_times[self._head] if self._size > 0 else 0
+
+    def clear(self, stats):
+        while self._size > 0:
+            self._pop(stats)
+
+    def __iter__(self):
+        """ (in_time, resp_time, failed) from the oldest """
+        for i in range(0, self._size):
+            idx = (self._head + i) % self._capacity
+            yield self._in_times[idx], self._resp_times[idx], self._failed(idx)
+
+
+class ResponseTimes(object):
+    """
+    the response times of the proxies in a ResponseTimeRing per proxy ip, expired after cache_timeout seconds,
+    dumped to json as a list of {'_item_': [resp_time(-1 if failed), failed or timeout, 'proxy_name/proxy_ip'], '_in_time_': in_time}
+    """
+
+    def __init__(self, cache_timeout=3600, capacity=100, items=()):
+        self.cache_timeout = cache_timeout
+        self.capacity = capacity
+        self.latency = LatencyStat()
+        # proxy_name -> ((LatencyStat of the proxy, self.latency), {proxy_ip: ResponseTimeRing})
+        self._proxies = {}
+        # in time of the oldest response time, nothing to expire before it
+        self._oldest_time = 0
+        for item in sorted((i for i in items if isinstance(i, dict) and '_item_' in i), key=lambda i: i.get('_in_time_', 0)):
+            self.append(item['_item_'], in_time=item.get('_in_time_'))
+        self.expire()
+
+    def __len__(self):
+        self.expire()
+        return self.latency.count
+
+    def append(self, item, in_time=None):
+        """ :param item: [resp_time(-1 if failed), failed or timeout, 'proxy_name/proxy_ip'] """
+        _t, _f, _n = item
+        name, ip = _n.rsplit('/', 1)
+        if name not in self._proxies:
+            self._proxies[name] = ((LatencyStat(), self.latency), {})
+        stats, rings = self._proxies[name]
+        ring = rings.get(ip)
+        if ring is None:
+            ring = rings[ip] = ResponseTimeRing(self.capacity)
+        if in_time is None:
+            in_time = time.time()
+        ring.append(in_time, _t, _f, stats)
+        if self._oldest_time == 0 or in_time < self._oldest_time:
+            self._oldest_time = in_time
+
+    def expire(self):
+        before_time = time.time() - self.cache_timeout
+        if self._oldest_time == 0 or self._oldest_time >= before_time:
+            return
+        oldest_time = 0
+        for stats, rings in self._proxies.values():
+            for ring in rings.values():
+                t = ring.expire(before_time, stats)
+                if t and (oldest_time == 0 or t < oldest_time):
+                    oldest_time = t
+        self._oldest_time = oldest_time
+
+    def latency_of(self, proxy_name) -> LatencyStat:
+        self.expire()
+        proxy = self._proxies.get(proxy_name)
+        return _no_latency if proxy is None else proxy[0][0]
+
+    def checkout(self, proxy_name, proxy_ip=None):
+        """ drop the response times of the proxy(or just of its proxy_ip) """
+        if proxy_name not in self._proxies:
+            return
+        stats, rings = self._proxies[proxy_name]
+        for ip in ([proxy_ip] if proxy_ip is not None else list(rings)):
+            ring = rings.pop(ip, None)
+            if ring is not None:
+                ring.clear(stats)
+        if not rings:
+            del self._proxies[proxy_name]
+
+    def items_of(self, proxy_name):
+        """ (in_time, resp_time, failed, proxy_ip) of the proxy """
+        self.expire()
+        if proxy_name in self._proxies:
+            for ip, ring in self._proxies[proxy_name][1].items():
+                for in_time, resp_time, failed in ring:
+                    yield in_time, resp_time, failed, ip
+
+    def to_json(self):
+        self.expire()
+        items = []
+        for name in self._proxies:
+            for in_time, resp_time, failed, ip in self.items_of(name):
+                items.append({'_item_': [resp_time, failed, '%s/%s' % (name, ip)], '_in_time_': in_time})
+        items.sort(key=lambda i: i['_in_time_'])
+        return items
+
+
+class StatRecord(object):
+    """ the runtime stat of a proxy, the slots are the keys of the proxy in proxies.json """
+    __slots__ = ('down_speed', 'down_speed_settime', 'realtime_speed', 'realtime_speed_time', 'pause', 'sess_count',
+                 'total_count', 'total_fail', 'error_count', '_error_time', 'head_time',
+                 'sort_key_onhead', 'last_tp90')
+
+    def __init__(self):
+        self.down_speed = 0
+        self.down_speed_settime = 0
+        self.realtime_speed = 0
+        self.realtime_speed_time = 0
+        self.pause = False
+        self.sess_count = 0
+        self.total_count = {}
+        self.total_fail = {}
+        self.error_count = 0
+        self._error_time = 0
+        self.head_time = 0
+        self.sort_key_onhead = None
+        self.last_tp90 = 0
+
+    def to_json(self):
+        j = {}
+        for k in StatRecord.__slots__:
+            v = getattr(self, k)
+            if v is not None:
+                j[k] = v
+        return j
+
+    @staticmethod
+    def from_json(j, default_ip='0.0.0.0'):
+        """ pop the stat keys from the proxy json j, the int total_count/total_fail of old json convert to {ip: count} """
+        stat = StatRecord()
+        for k in StatRecord.__slots__:
+            if k in j:
+                setattr(stat, k, j.pop(k))
+        if isinstance(stat.total_count, int):
+            stat.total_count = {default_ip: stat.total_count}
+        if isinstance(stat.total_fail, int):
+            stat.total_fail = {default_ip: stat.total_fail}
+        return stat
+
+
 class ProxyStat(dict):
-    global_resp_time = None
+    global_resp_time = ResponseTimes()
     global_tp90_len = 0
     global_resp_count = 0
     global_tp90_cache = 0
-    global_tp90_cache_time = 0
 
     global_tp90_inc = 0.0
     global_last_tp90 = 0.0
-    global_tp90_inc_time = 0
 
     def __init__(self, proxy_monitor=None, **kwargs):
         if 'resp_time' in kwargs:
             del kwargs['resp_time']
         if 'proxy_count' in kwargs:
             del kwargs['proxy_count']
+        self._stat = StatRecord.from_json(kwargs, ProxyStat._default_ip(kwargs))
         super().__init__(**kwargs)
         self.proxy_monitor = proxy_monitor
         self._tp90_len = 0
-        self._tp90_cache = 0
-        self._tp90_cached_time = 0
+        self._tp90 = 0
         self.connected_used = 100
-        self._resp_time = []
-        self._resp_cache_time = 0
-        self._pc_cache = []
-        self._pc_cache_time = 0
-        self._proxy_fail_stat = common.FIFOCache(cache_timeout=300)
-        self._proxy_timeout_stat = common.FIFOCache(cache_timeout=300)
+        # in-flight connections to the proxy, weights the balance of new connections
+        self.conn_count = 0
+        self._proxy_fail_stat = common.LRUCache(cache_timeout=300, name='proxy_fail_stat')
+        self._proxy_timeout_stat = common.LRUCache(cache_timeout=300, name='proxy_timeout_stat')
+
+    @staticmethod
+    def _default_ip(j):
+        if 'resolved_addr' not in j:
+            return '0.0.0.0'
+        addr = j['resolved_addr'][0]
+        return addr[0] if isinstance(addr, list) else addr
 
     def _name(self):
         raise NotImplementedError()
 
+    def to_json(self):
+        return dict(self, **self._stat.to_json())
+
+    def stat_json(self):
+        return self._stat.to_json()
+
+    def load_stat(self, j):
+        """ replace the stat by the one from the leader worker, the sort_key_onhead of this worker excluded """
+        stat = self._stat
+        for k in StatRecord.__slots__:
+            if k in j and not k.startswith('sort_key'):
+                setattr(stat, k, j[k])
+        self._stat_changed()
+
+    def _stat_changed(self):
+        """ notify the proxy_monitor to re-rank the proxy """
+        if self.proxy_monitor is not None:
+            self.proxy_monitor.on_proxy_stat_changed(self)
+
     def _id_str_(self):
         return '%d/%d/%d/%d/%d/%d/%f/%f/%s' \
                % (self.proxy_count, self.total_count, self.fail_count, self.total_fail,
-                  self.last_tp90, self.error_count, self._error_time, self.head_time, self.resp_time)
+                  self.last_tp90, self.error_count, self._error_time, self.head_time, self.tp90)
 
     def __eq__(self, other):
         if not isinstance(other, ProxyStat):
@@ -70,192 +351,125 @@ class ProxyStat(dict):
 
     @property
     def down_speed(self):
-        if 'down_speed' not in self or 'down_speed_settime' not in self or (time.time() - self['down_speed_settime']) > common.speed_lifetime:
-            self['down_speed'] = 0
-        return self['down_speed']
+        stat = self._stat
+        if (time.time() - stat.down_speed_settime) > common.speed_lifetime:
+            stat.down_speed = 0
+        return stat.down_speed
 
     @property
     def down_speed_settime(self):
-        return self['down_speed_settime'] if 'down_speed_settime' in self else 0
+        return self._stat.down_speed_settime
 
     @property
     def realtime_speed(self):
-        if 'realtime_speed' not in self:
-            self['realtime_speed'] = 0
-        #     self['realtime_speed_time'] = time.time()
-        # if (time.time() - self['realtime_speed_time']) > common.speed_lifetime:
-        #     return 0
-        return self['realtime_speed']
+        return self._stat.realtime_speed
 
     @realtime_speed.setter
     def realtime_speed(self, r_speed):
+        stat = self._stat
         _now = int(time.time())
-        _s = 0 if 'realtime_speed' not in self else self['realtime_speed']
-        if 'realtime_speed_time' in self and self['realtime_speed_time'] == _now:
-            self['realtime_speed'] = _s + r_speed
+        if stat.realtime_speed_time == _now:
+            stat.realtime_speed += r_speed
         else:
-            self['realtime_speed'] = r_speed
-        self['realtime_speed_time'] = _now
+            stat.realtime_speed = r_speed
+        stat.realtime_speed_time = _now
 
     def set_realtime_speed(self, r_speed):
-        self['realtime_speed'] = r_speed
-        self['realtime_speed_time'] = int(time.time())
+        self._stat.realtime_speed = r_speed
+        self._stat.realtime_speed_time = int(time.time())
 
     @down_speed.setter
     def down_speed(self, d_speed):
+        stat = self._stat
         # 10 分钟内的速度取平均值
-        if d_speed < 0 or 'down_speed_settime' not in self or (time.time() - self['down_speed_settime']) > 600:
-            self['down_speed'] = d_speed
+        if d_speed < 0 or stat.down_speed_settime == 0 or (time.time() - stat.down_speed_settime) > 600:
+            stat.down_speed = d_speed
         else:
-            self['down_speed'] = (self.down_speed + d_speed)/2
-        self['down_speed_settime'] = time.time()
+            stat.down_speed = (self.down_speed + d_speed)/2
+        stat.down_speed_settime = time.time()
+        self._stat_changed()
 
     @property
     def pause(self):
-        if 'pause' not in self:
-            self['pause'] = False
-        return self['pause']
+        return self._stat.pause
 
     @pause.setter
     def pause(self, c):
-        self['pause'] = c
+        self._stat.pause = c
         logger.info("%s %s", self, 'paused' if c else 'resumed')
+        self._stat_changed()
 
     @property
     def sess_count(self):
-        if 'sess_count' not in self:
-            self['sess_count'] = 0
-        return self['sess_count']
+        return self._stat.sess_count
 
     @sess_count.setter
     def sess_count(self, c):
-        self['sess_count'] = c
-
-    def _proxy_count_cache(self):
-        if time.time() - self._pc_cache_time > 1:
-            self._pc_cache = []
-            for t in ProxyStat.global_resp_time:
-                if not hasattr(t, '__call__'):
-                    continue
-                _t, _f, _n = t()
-                if _n.startswith(self._name()):
-                    self._pc_cache.append(_f)
-            self._pc_cache_time = time.time()
+        self._stat.sess_count = c
+
+    def _latency_stat(self) -> LatencyStat:
+        return ProxyStat.global_resp_time.latency_of(self._name())
 
     @property
     def proxy_count(self):
-        self._proxy_count_cache()
-        return len(self._pc_cache)
+        return self._latency_stat().count
 
     @property
     def total_count(self):
-        if 'total_count' not in self:
-            self['total_count'] = {}
-        if isinstance(self['total_count'], int):
-            if 'resolved_addr' in self:
-                addr = self['resolved_addr'][0]
-                if isinstance(addr, list):
-                    self['total_count'] = {self['resolved_addr'][0][0]: self['total_count']}
-                else:
-                    self['total_count'] = {self['resolved_addr'][0]: self['total_count']}
-            else:
-                return self['total_count']
-        c = 0
-        for k in self['total_count']:
-            c += self['total_count'][k]
-        return c
-
-    # @total_count.setter
-    # def total_count(self, c):
-    #     if 'total_count' not in self:
-    #         self.sess_count = c
-    #     else:
-    #         _sc = c - self['total_count']
-    #         self.sess_count += _sc
-    #     self['total_count'] = c
+        return sum(self._stat.total_count.values())
 
     @property
     def fail_count(self):
-        self._proxy_count_cache()
-        _fail_c = 0
-        for f in self._pc_cache:
-            if f:
-                _fail_c += 1
-        return _fail_c
+        return self._latency_stat().fail_count
 
     @property
     def total_fail(self):
-        if 'total_fail' not in self:
-            self['total_fail'] = {}
-        if isinstance(self['total_fail'], int):
-            if 'resolved_addr' in self:
-                addr = self['resolved_addr'][0]
-                if isinstance(addr, list):
-                    self['total_fail'] = {self['resolved_addr'][0][0]: self['total_fail']}
-                else:
-                    self['total_fail'] = {self['resolved_addr'][0]: self['total_fail']}
-            else:
-                return self['total_fail']
-        c = 0
-        for k in self['total_fail']:
-            c += self['total_fail'][k]
-        return c
-
-    # @total_fail.setter
-    # def total_fail(self, c):
-    #     self['total_fail'] = c
+        return sum(self._stat.total_fail.values())
 
     @property
     def error_count(self):
-        if 'error_count' not in self:
-            self['error_count'] = 0
-        return self['error_count']
+        return self._stat.error_count
 
     @error_count.setter
     def error_count(self, c):
-        self['error_count'] = c
+        self._stat.error_count = c
 
     @property
     def _error_time(self):
-        if '_error_time' not in self:
-            self['_error_time'] = 0
-        return self['_error_time']
+        return self._stat._error_time
 
     @_error_time.setter
     def _error_time(self, c):
-        self['_error_time'] = c
+        self._stat._error_time = c
 
     @property
     def head_time(self):
-        if 'head_time' not in self:
-            self['head_time'] = 0
-        return self['head_time']
+        return self._stat.head_time
 
     @head_time.setter
     def head_time(self, c):
-        self['head_time'] = c
-        self['sort_key_onhead'] = self.sort_key
+        self._stat.head_time = c
+        self._stat.sort_key_onhead = self.sort_key
 
     @property
     def sort_key_decrement(self):
-        if 'sort_key_onhead' not in self:
-            self['sort_key_onhead'] = self.sort_key
-        dec = self['sort_key_onhead'] - self.sort_key
-        if self['sort_key_onhead'] == 0:
+        stat = self._stat
+        if stat.sort_key_onhead is None:
+            stat.sort_key_onhead = self.sort_key
+        dec = stat.sort_key_onhead - self.sort_key
+        if stat.sort_key_onhead == 0:
             return 0, 0
         else:
-            return (dec / self['sort_key_onhead']), self['sort_key_onhead']
+            return (dec / stat.sort_key_onhead), stat.sort_key_onhead
 
     @property
     def sort_key(self):
         p = self
-        if 'sort_key_time' in p and 'sort_key' in p:
-            if time.time() - p['sort_key_time'] < 1:
-                return p['sort_key']
         global_tp90 = round(ProxyStat.calc_tp90(), 1)
         if global_tp90 == 0:
             return 0
-        if p.down_speed > 0:
+        down_speed = p.down_speed
+        if down_speed > 0:
             # f1 成功率^3
             f1 = 1 - (p.fail_rate if p.tp90_len == 0 or p.proxy_count >= common.tp90_calc_count*0.9 else p.total_fail_rate)
             f1 *= f1 * f1
@@ -268,99 +482,81 @@ class ProxyStat(dict):
             # f2 = p.tp90 / global_tp90
             # f2 *= f2
             # f2 = 1 - f2
-            p['sort_key'] = round(p.down_speed/102400) * f1 * f2 * 10
+            return round(down_speed/102400) * f1 * f2 * 10
         else:
-            p['sort_key'] = 0
-        p['sort_key_time'] = time.time()
-        return p['sort_key']
+            return 0
 
     @property
     def resp_time(self):
-        if time.time() - self._resp_cache_time > 0.5:
-            self._resp_time = []
-            for t in ProxyStat.global_resp_time:
-                if not hasattr(t, '__call__'):
-                    continue
-                _t, _f, _n = t()
-                if _n.startswith(self._name()) and _t >= 0:
-                    self._resp_time.append(_t)
-            self._resp_cache_time = time.time()
-        return self._resp_time
+        """ the response times in global_resp_time """
+        return [_t for _, _t, _, _ in ProxyStat.global_resp_time.items_of(self._name()) if _t >= 0]
 
     @property
     def last_tp90(self):
-        if 'last_tp90' not in self:
-            self['last_tp90'] = 0
-        return self['last_tp90']
+        return self._stat.last_tp90
 
     @last_tp90.setter
     def last_tp90(self, c):
-        self['last_tp90'] = c
+        self._stat.last_tp90 = c
 
     # END of ProxyStat to dict properties convert
 
     @staticmethod
     def get_global_tp90_inc():
-        if (time.time() - ProxyStat.global_tp90_inc_time) < 0.5 and ProxyStat.global_last_tp90 > 0:
-            return '%s%.1f' % ('+' if ProxyStat.global_tp90_inc >= 0 else '', ProxyStat.global_tp90_inc)
-        ProxyStat.global_tp90_inc = ProxyStat.calc_tp90() - ProxyStat.global_last_tp90
-        ProxyStat.global_last_tp90 = ProxyStat.calc_tp90()
-        ProxyStat.global_tp90_inc_time = time.time()
+        """ the change of the global tp90 since the last call """
+        global_tp90 = ProxyStat.calc_tp90()
+        ProxyStat.global_tp90_inc = global_tp90 - ProxyStat.global_last_tp90
+        ProxyStat.global_last_tp90 = global_tp90
         return '%s%.1f' % ('+' if ProxyStat.global_tp90_inc >= 0 else '', ProxyStat.global_tp90_inc)
 
     @staticmethod
-    def calc_tp90(time_list=None, time_count=None):
-        is_global = False
-        if time_list is None:
-            if (time.time() - ProxyStat.global_tp90_cache_time) < 0.5 and ProxyStat.global_tp90_cache > 0:
-                return ProxyStat.global_tp90_cache
-            is_global = True
-            time_list = []
-            for t in ProxyStat.global_resp_time:
-                if not hasattr(t, '__call__'):
-                    continue
-                _t, _f, _n = t()
-                if _t >= 0:
-                    time_list.append(_t)
-            time_count = len(time_list)
-        c90 = int(time_count * 0.1)
-        count = 0
-        tp90 = 0.0
-        for t in sorted(time_list, reverse=True):
-            count += 1
-            if count > c90:
-                tp90 = float(t)
-                # logger.debug("count = %d, c90 = %d, tp90 = %.1f", count, c90, tp90)
-                break
-        if is_global:
-            if tp90 < 0.1 and ProxyStat.global_tp90_cache > 0:
-                ProxyStat.global_tp90_cache_time = time.time()
-                return ProxyStat.global_tp90_cache
-            ProxyStat.global_tp90_cache = tp90
-            ProxyStat.global_tp90_len = time_count
-            ProxyStat.global_resp_count = len(ProxyStat.global_resp_time)
-            ProxyStat.global_tp90_cache_time = time.time()
+    def init_global_resp_time(items=()):
+        """ new global_resp_time of the items(loaded from json), tp90_calc_count response times per proxy ip """
+        ProxyStat.global_resp_time = ResponseTimes(common.tp90_expired_time, common.tp90_calc_count, items)
+
+    @staticmethod
+    def calc_tp90():
+        tp90 = ProxyStat.global_percentile(90)
+        if tp90 < 0.1 and ProxyStat.global_tp90_cache > 0:
+            return ProxyStat.global_tp90_cache
+        latency = ProxyStat.global_resp_time.latency
+        ProxyStat.global_tp90_cache = tp90
+        ProxyStat.global_tp90_len = len(latency.histogram)
+        ProxyStat.global_resp_count = latency.count
         return tp90
 
+    @staticmethod
+    def global_percentile(p):
+        """ :param p: percent, 50/90/99 for tp50/tp90/tp99 """
+        ProxyStat.global_resp_time.expire()
+        return ProxyStat.global_resp_time.latency.histogram.percentile(p)
+
+    def percentile(self, p):
+        return self._latency_stat().histogram.percentile(p)
+
     @property
     def fail_rate(self):
-        if self.total_count > 10:
+        total_count = self.total_count
+        if total_count > 10:
             # total count > 10 and all failed
-            if self.total_count == self.total_fail:
+            if total_count == self.total_fail:
                 return 1.0
-        if self.proxy_count <= 10:
+        latency = self._latency_stat()
+        proxy_count, fail_count = latency.count, latency.fail_count
+        if proxy_count <= 10:
             # try count <= 10, fail_rate can't calculate by fail/count, may try more
-            if self.fail_count >= 5:
+            if fail_count >= 5:
                 # fail count >= 5, fail_rate too high
-                return self.fail_count/self.proxy_count
-        return self.fail_count / self.proxy_count if self.proxy_count > 10 else 0.0
+                return fail_count/proxy_count
+        return fail_count / proxy_count if proxy_count > 10 else 0.0
 
     @property
     def total_fail_rate(self):
-        if self.total_count <= 10:
-            if self.total_fail >= 5:
-                return self.total_fail/self.total_count
-        return self.total_fail / self.total_count if self.total_count > 10 else 0.0
+        total_count, total_fail = self.total_count, self.total_fail
+        if total_count <= 10:
+            if total_fail >= 5:
+                return total_fail/total_count
+        return total_fail / total_count if total_count > 10 else 0.0
 
     @property
     def tp90_increment(self):
@@ -370,15 +566,6 @@ class ProxyStat(dict):
         else:
             return (inc / self.last_tp90), self.last_tp90, inc
 
-    @property
-    def _tp90(self):
-        return self._tp90_cache
-
-    @_tp90.setter
-    def _tp90(self, _tp90):
-        self._tp90_cache = _tp90
-        self._tp90_cached_time = time.time()
-
     @property
     def error_time(self):
         return time.time() - self._error_time
@@ -389,15 +576,12 @@ class ProxyStat(dict):
         self._error_time = err_time
 
     def _tp90_cache_(self):
-        if (time.time() - self._tp90_cached_time) < 0.5 and self._tp90 > 0:
-            return
-        dict_time = self.resp_time
-        count = len(self.resp_time)
-        t = ProxyStat.calc_tp90(dict_time, count)
+        histogram = self._latency_stat().histogram
+        t = histogram.percentile(90)
         if t < 0.1 and self._tp90 > 0:
             return
         self._tp90 = t
-        self._tp90_len = count
+        self._tp90_len = len(histogram)
 
     @property
     def tp90_len(self):
@@ -432,6 +616,8 @@ class ProxyStat(dict):
             proxy_ip = connection.raddr
         logger.debug('proxy for %s %s use %.2f sec', target_host, loginfo, resp_time)
         self._update_stat_info(target_host, resp_time, self_ip=proxy_ip, proxy_fail=proxy_fail, proxy_timeout=proxy_timeout, proxy_name=proxy_name)
+        if self.proxy_monitor is not None:
+            self.proxy_monitor.on_proxy_stat_updated(self, resp_time, target_host, proxy_ip, proxy_fail, proxy_timeout, proxy_name)
 
     def get_proxy_stat(self, target_host, proxy_fail=False, proxy_timeout=False, resp_time=False):
         """ 如果代理响应超时或无响应，返回True """
@@ -448,23 +634,17 @@ class ProxyStat(dict):
             else:
                 logger.warning("'resolved_addr' not in %s and self_ip is None", self)
                 self_ip = '0.0.0.0'
-        self.setdefault('total_fail', {})
-        self.setdefault('total_count', {})
+        stat = self._stat
         if proxy_fail or proxy_timeout:
-            if self_ip in self['total_fail']:
-                self['total_fail'][self_ip] += 1
-            else:
-                self['total_fail'][self_ip] = 1
-        if self_ip in self['total_count']:
-            self['total_count'][self_ip] += 1
-        else:
-            self['total_count'][self_ip] = 1
+            stat.total_fail[self_ip] = stat.total_fail.get(self_ip, 0) + 1
+        stat.total_count[self_ip] = stat.total_count.get(self_ip, 0) + 1
 
         if not proxy_fail:
             t = resp_time
         else:
             t = -1
         ProxyStat.global_resp_time.append([t, proxy_fail or proxy_timeout, '%s/%s' % (self._name(), self_ip)])
+        self._stat_changed()
         count = self.proxy_count
         # end of self.rlock
 
@@ -494,6 +674,7 @@ class Proxy(ProxyStat):
 
         self.json_file_mod = 0
         self.last_json_check = 0
+        self.sock_pool = ProxySocketPool(self)
         if json_config:
             self.json_config = json_config
             self._json_config_full_path = common.lookup_conf_file(json_config)
@@ -579,12 +760,14 @@ class Proxy(ProxyStat):
                       count_fmt2 % format(self.proxy_count, ','),
                       ('f%.0f.%%' if fr2 > 9.95 else 'f%.1f%%') % fr2, ']' if index is None else ''
                       )
-            if 'down_speed_settime' in self and (time.time() - self['down_speed_settime']) < 24*3600:
-                output += ' S=%s' % str_datetime(timestamp=self['down_speed_settime'], fmt='%H:%M:%S,%f', end=12)
+            if self.down_speed_settime > 0 and (time.time() - self.down_speed_settime) < 24*3600:
+                output += ' S=%s' % str_datetime(timestamp=self.down_speed_settime, fmt='%H:%M:%S,%f', end=12)
             # if (time.time() - self.head_time) < 24*3600 or index == 0:
             #     output += ' H=%s' % str_datetime(timestamp=self.head_time, fmt='%H:%M:%S,%f', end=12)
             if self.down_speed > 0:
-                output += ' speed=%sB/S %s' % (common.fmt_human_bytes(self.down_speed), format(int(self.sort_key), ',') if 'sort_key' in self else '')
+                output += ' speed=%sB/S %s' % (common.fmt_human_bytes(self.down_speed), format(int(self.sort_key), ','))
+            if self.sock_pool.hits + self.sock_pool.misses > 0:
+                output += ' %s' % self.sock_pool.stat_info()
             if high_light:
                 output = '\x1b[1;31;48m%s\x1b[0m' % output
             if out:
@@ -649,10 +832,11 @@ class Proxy(ProxyStat):
                         # 删除speedup数据
                         self.proxy_monitor.remove_proxy_from_domain_speed(self, ip)
                         # 删除resp_time数据
-                        ProxyStat.global_resp_time.checkout('%s/%s' % (self.hostname, ip))
+                        ProxyStat.global_resp_time.checkout(self.hostname, ip)
                         # 重置统计数据
-                        self['total_count'].pop(ip, None)
-                        self['total_fail'].pop(ip, None)
+                        self._stat.total_count.pop(ip, None)
+                        self._stat.total_fail.pop(ip, None)
+                self._stat_changed()
                 logger.info('proxy(%s) ip changed, from %s/%s to %s/%s, ', self.short_hostname, _old_info, self.resolved_addr[0], self, addr[0])
         self['resolved_addr'] = addr
 
@@ -692,9 +876,15 @@ class Proxy(ProxyStat):
                 #     logger.debug('%s realtime_speed %d/%.1f: %sB/S', connection, _data_len, _mutable_data_count[3], common.fmt_human_bytes(connection['_realtime_speed_']))
         else:
             _log_speed = None
-        _, first_res_time = yield from common.forward_forever(connection, peer_conn, on_data_recv=_log_speed, on_idle=self.on_idle)
+        keepalive = connection.get_attr(common.KEY_HTTP_KEEPALIVE)
+        _, first_res_time = yield from common.forward_forever(connection, peer_conn, on_data_recv=_log_speed, on_idle=self.on_idle,
+                                                              stop_after=keepalive.stop_after if keepalive else None,
+                                                              keep_peer=keepalive.keep_peer if keepalive else None)
         if connection.response_timeout:
             self.update_proxy_stat(connection, time.time() - connection.create_time, loginfo="response timeout", proxy_timeout=True)
+        elif not first_res_time and keepalive is not None and keepalive.reusing:
+            # the server closed the idle connection while it was reused, not a fail of the proxy
+            logger.info("%s closed by the server when reused", connection)
         elif not first_res_time:
             self.update_proxy_stat(connection, time.time() - connection.create_time, loginfo="be closed with no response", proxy_fail=True)
         else:
@@ -716,6 +906,113 @@ class Proxy(ProxyStat):
         logger.info("forward-%s(%s) DONE", self.protocol, connection)
 
 
+class ProxySocketPool(object):
+    """ pre-connected idle sockets to the proxy server, sized from the recent request rate """
+
+    # seconds of the request rate counted
+    RATE_WINDOW = 60
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self._socks = []  # [(sock, ip, connect_used, pooled_time), ...]
+        self._connecting = 0
+        self._acquire_times = collections.deque()
+        self._connect_used = 0.1
+        self.hits = 0
+        self.misses = 0
+        self.saved_time = 0
+
+    def __len__(self):
+        return len(self._socks)
+
+    @property
+    def target_size(self):
+        if common.proxy_pool_size <= 0:
+            return 0
+        now = time.time()
+        while self._acquire_times and (now - self._acquire_times[0]) > self.RATE_WINDOW:
+            self._acquire_times.popleft()
+        if not self._acquire_times:
+            return 0
+        rate = len(self._acquire_times) / self.RATE_WINDOW
+        # sockets taken while refilling(Little's law), at least one
+        return min(common.proxy_pool_size, int(math.ceil(rate * self._connect_used)))
+
+    def acquire(self, ips):
+        """ :return: (sock, ip) of a live pooled socket connected to one of ips, (None, None) if not found """
+        if common.proxy_pool_size <= 0:
+            return None, None
+        self._acquire_times.append(time.time())
+        while self._socks:
+            sock, ip, connect_used, pooled_time = self._socks.pop()
+            if ip not in ips or (time.time() - pooled_time) > common.proxy_pool_idle_timeout or not _is_sock_alive(sock):
+                streams.close_sock_slient(sock)
+                continue
+            self.hits += 1
+            self.saved_time += connect_used
+            logger.log(5, '%s pooled socket to %s hit, saved %.3f sec', self._proxy.short_hostname, ip, connect_used)
+            return sock, ip
+        self.misses += 1
+        return None, None
+
+    def refill(self, ips, loop=None):
+        if not ips:
+            return
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        shortage = self.target_size - len(self._socks) - self._connecting
+        for i in range(0, shortage):
+            self._connecting += 1
+            asyncio.ensure_future(self._pre_connect(ips[i % len(ips)], loop), loop=loop)
+
+    @asyncio.coroutine
+    def _pre_connect(self, ip, loop):
+        start_time = time.time()
+        sock = None
+        try:
+            sock = socket.socket(socket.AF_INET6 if topendns.is_ipv6(ip) else socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            with common.Timeout(common.default_timeout, loop=loop):
+                yield from loop.sock_connect(sock, (ip, self._proxy.port))
+            connect_used = time.time() - start_time
+            self._connect_used = self._connect_used * 0.8 + connect_used * 0.2
+            self._socks.append((sock, ip, connect_used, time.time()))
+        except BaseException as ex:
+            streams.close_sock_slient(sock)
+            logger.debug('%s pre-connect to %s fail: %s(%s)', self._proxy.short_hostname, ip, common.clazz_fullname(ex), ex)
+        finally:
+            self._connecting -= 1
+
+    def sweep(self):
+        """ close the idle timeout or closed sockets """
+        alive = []
+        for item in self._socks:
+            if (time.time() - item[3]) > common.proxy_pool_idle_timeout or not _is_sock_alive(item[0]):
+                streams.close_sock_slient(item[0])
+            else:
+                alive.append(item)
+        self._socks = alive
+
+    def close(self):
+        for item in self._socks:
+            streams.close_sock_slient(item[0])
+        self._socks.clear()
+
+    def stat_info(self):
+        return 'pool=%d hit=%d/%d saved=%.1fs' % (len(self._socks), self.hits, self.hits + self.misses, self.saved_time)
+
+
+def _is_sock_alive(sock):
+    try:
+        # the idle socket should have nothing to read, b'' means closed by the peer
+        sock.recv(1, socket.MSG_PEEK)
+        return False
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+
+
 class DirectForward(Proxy):
 
     def __init__(self):
@@ -880,7 +1177,8 @@ class ShadowsocksProxy(Proxy):
         flag = 3
         try:
             conn_req = comps_connect_request(host, port)
-            connection.writer.write(conn_req)
+            # sent with the first payload, the server waits for it before connecting the target anyway
+            connection.writer.write_with_next(conn_req, common.proxy_head_delay)
             yield from connection.writer.drain()
             logger.debug('%s shadowsocks proxy connected, use %.3f sec', connection, time.time() - connection.create_time)
             flag = 4
@@ -908,6 +1206,10 @@ class ShadowsocksProxy(Proxy):
             logger.log(5, "new Encryptor for %s", conn)
         return encryptor
 
+    def offload(self, conn, data):
+        """ en/decrypt the large data in the crypto executor, after the encryptor of conn created on the event loop """
+        return 0 < common.crypto_offload_threshold <= len(data) and self.ENCRYPTOR in conn
+
     def do_encrypt(self, conn, data):
         encryptor = self.get_encryptor(conn)
         if encryptor:
@@ -936,6 +1238,13 @@ class ShadowsocksEncoder(streams.Encoder):
         logger.log(5, 'do_encrypt %s -> %s', data[:40], enc[:40])
         return enc
 
+    def offload(self, data, connection):
+        return self._shadws_proxy.offload(connection, data)
+
+    def coalesce(self, data, connection):
+        # every write costs a cipher call and a send
+        return len(data) < common.write_coalesce_bytes
+
 
 class ShadowsocksDecoder(streams.Decoder):
 
@@ -955,7 +1264,11 @@ class ShadowsocksDecoder(streams.Decoder):
         except Exception as ex:
             logger.exception("%s shadowsocks read fail: %s(%s)", connection, common.clazz_fullname(ex), ex)
             return None
-        dec = self._shadws_proxy.do_decrypt(connection, data)
+        if self._shadws_proxy.offload(connection, data):
+            # the reading of connection is sequential, so is the decryption
+            dec = yield from asyncio.get_event_loop().run_in_executor(common.get_crypto_executor(), self._shadws_proxy.do_decrypt, connection, data)
+        else:
+            dec = self._shadws_proxy.do_decrypt(connection, data)
         logger.log(5, 'do_decrypt %s -> %s', data[:40], dec[:40])
         return dec
 
@@ -968,6 +1281,9 @@ class HttpRequestRewriter:
             return enc
         return data
 
+    def is_transparent(self, connection):
+        return common.KEY_FIRST_HTTP_REQUEST not in connection
+
 
 class HttpProxy(Proxy):
 
@@ -1023,3 +1339,93 @@ def rewrite_http_request(request):
     buf.write(b'\r\n')
     buf.write(request.body)
     return buf.getvalue()
+
+
+def benchmark_crypto_offload(connections=4, total_mb=32, method='chacha20', chunk_size=131072):
+    """ the event loop latency(lateness of a 1ms timer) while the shadowsocks connections upload and download in bulk """
+    loop = asyncio.get_event_loop()
+    shadws = ShadowsocksProxy(None, '127.0.0.1', server_port=8388, password='benchmark', method=method)
+    raw = os.urandom(chunk_size)
+    encryptor = Cryptor(shadws.password, shadws.method)
+    encrypted = [encryptor.encrypt(raw) for _ in range(total_mb * 1024 * 1024 // chunk_size)]
+    total = len(encrypted) * chunk_size
+
+    @asyncio.coroutine
+    def server(reader, writer):
+        # send the encrypted data and discard the uploaded
+        @asyncio.coroutine
+        def discard():
+            while (yield from reader.read(1048576)):
+                pass
+        discarding = asyncio.ensure_future(discard(), loop=loop)
+        for chunk in encrypted:
+            writer.write(chunk)
+            yield from writer.drain()
+        yield from discarding
+        writer.close()
+
+    ss_server = loop.run_until_complete(asyncio.start_server(server, '127.0.0.1', 0, loop=loop))
+    ss_port = ss_server.sockets[0].getsockname()[1]
+
+    @asyncio.coroutine
+    def client(done):
+        @asyncio.coroutine
+        def handler(connection):
+            @asyncio.coroutine
+            def upload():
+                for _ in encrypted:
+                    connection.writer.write(raw)
+                    yield from connection.writer.drain()
+                connection.writer.write_eof()
+            uploading = asyncio.ensure_future(upload(), loop=loop)
+            received = 0
+            while True:
+                data = yield from connection.reader.read(read_timeout=None)
+                if not data:
+                    break
+                received += len(data)
+            yield from uploading
+            done.set_result(received)
+        yield from streams.start_connection(handler, '127.0.0.1', ss_port, loop=loop, encoder=shadws.encoder, decoder=shadws.decoder)
+        return (yield from done)
+
+    @asyncio.coroutine
+    def run():
+        lateness = []
+        ticking = [True]
+
+        def tick(expected):
+            now = loop.time()
+            lateness.append(now - expected)
+            if ticking[0]:
+                loop.call_at(now + 0.001, tick, now + 0.001)
+
+        start = time.time()
+        loop.call_soon(tick, loop.time())
+        received = yield from asyncio.gather(*[client(loop.create_future()) for _ in range(connections)], loop=loop)
+        used = time.time() - start
+        ticking[0] = False
+        lateness.sort()
+        return sum(received), used, lateness
+
+    threshold = common.crypto_offload_threshold
+    for offload_threshold in (0, threshold if threshold > 0 else 16384):
+        common.crypto_offload_threshold = offload_threshold
+        received, used, lateness = loop.run_until_complete(run())
+        if received != total * connections:
+            print('received %d bytes, expect %d' % (received, total * connections))
+        print('crypto_offload_threshold=%d: %d connections %s up and down in %.2f sec, %sB/S, '
+              'loop latency p50=%.2fms p99=%.2fms max=%.2fms'
+              % (offload_threshold, connections, common.fmt_human_bytes(total * connections), used,
+                 common.fmt_human_bytes(received * 2 / used), lateness[len(lateness) // 2] * 1000,
+                 lateness[int(len(lateness) * 0.99)] * 1000, lateness[-1] * 1000))
+    common.crypto_offload_threshold = threshold
+    ss_server.close()
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        # python -m tsproxy.proxy bench [connections] [total_mb per connection]
+        benchmark_crypto_offload(*[int(arg) for arg in sys.argv[2:4]])
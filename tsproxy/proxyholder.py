@@ -2,6 +2,7 @@ import asyncio
 import logging
 import logging.config
 import os
+import random
 import time
 from concurrent.futures import CancelledError
 from urllib.parse import urlparse
@@ -32,6 +33,11 @@ def sort_proxies(p):
     return 100 if p.pause else -p.sort_key
 
 
+def balance_cost(p):
+    """ the in-flight connections share the speed(sort_key) of the proxy, and wait its tp90 """
+    return (p.conn_count + 1) * max(p.tp90, 0.1) / max(p.sort_key, 1)
+
+
 def get_wan_ip():
     from tsproxy.topendns import is_ipv4
     try:
@@ -64,6 +70,8 @@ class ProxyHolder(object):
         # self.hundred_c = 0  # hundred count
         self.proxy_list = []
         self.proxy_dict = {}
+        # proxies ordered by sort_proxies, only the proxy of a stat change is re-ranked(with the global tp90 then)
+        self.ranking = common.RankedList(sort_proxies)
         # self.rlock = threading.RLock()
         self.proxy_check_queue = asyncio.Queue()
         self._executor = None
@@ -80,6 +88,8 @@ class ProxyHolder(object):
         self.domain_speed_map = {}
         self._available = True
         self._dump_all_func = None
+        # workers.WorkerBus of the --workers mode
+        self.worker_bus = None
 
     @property
     def dump_all_func(self):
@@ -99,6 +109,11 @@ class ProxyHolder(object):
             logger.warning('TSProxy status: %s', 'available' if ava else 'unavailable')
             self._available = ava
 
+    @property
+    def is_follower(self):
+        """ the follower worker leaves the health checks and speed tests to the leader """
+        return self.worker_bus is not None and self.worker_bus.follower
+
     @property
     def proxy_names(self):
         return self.proxy_dict.keys()
@@ -130,33 +145,31 @@ class ProxyHolder(object):
                 proxy = px_class(self, **p)
                 self.proxy_list.append(proxy)
                 self.proxy_dict[proxy.short_hostname] = proxy
+                self.ranking.add(proxy)
             except Exception as ex:
                 logger.exception("new %s failed: %s", px_classname, ex)
         self._proxy_count = len(self.proxy_list)
         if 'global_resp_time' in j:
-            ProxyStat.global_resp_time = common.FIFOList(common.tp90_expired_time, common.tp90_calc_count*self._proxy_count, *(j['global_resp_time']))
+            ProxyStat.init_global_resp_time(j['global_resp_time'])
         else:
-            ProxyStat.global_resp_time = common.FIFOList(common.tp90_expired_time, common.tp90_calc_count*self._proxy_count)
+            ProxyStat.init_global_resp_time()
         if 'global_tp90_inc' in j:
             ProxyStat.global_tp90_inc = j['global_tp90_inc']
         if 'global_last_tp90' in j:
             ProxyStat.global_last_tp90 = j['global_last_tp90']
-        if 'global_tp90_inc_time' in j:
-            ProxyStat.global_tp90_inc_time = j['global_tp90_inc_time']
 
     def dump_json(self, j):
         j.update({
-            'proxy_list': self.proxy_list,
+            'proxy_list': [p.to_json() for p in self.proxy_list],
             'auto_pause': [*self.auto_pause_list],
             'fix_top': self.fix_top,
             'wan_ip': self.wan_ip,
             'local_ip': self.local_ip,
             'last_speed_test_time': self.last_speed_test_time,
             'domain_speed_map': self.domain_speed_map,
-            'global_resp_time': ProxyStat.global_resp_time,
+            'global_resp_time': ProxyStat.global_resp_time.to_json(),
             'global_tp90_inc': ProxyStat.global_tp90_inc,
             'global_last_tp90': ProxyStat.global_last_tp90,
-            'global_tp90_inc_time': ProxyStat.global_tp90_inc_time,
         })
 
     def add_proxies(self, proxy_infos, insert=False):
@@ -165,8 +178,7 @@ class ProxyHolder(object):
                 self.add_proxy(p, insert=insert)
             except Exception as ex:
                 logger.exception("add proxy %s failed: %s", p, ex)
-        # ProxyStat.global_proxy_count = FIFOList(common.tp90_expired_time, common.tp90_calc_count*self._proxy_count, lambda k: k[0])
-        ProxyStat.global_resp_time = common.FIFOList(common.tp90_expired_time, common.tp90_calc_count*self._proxy_count)  # , lambda k: k[0])
+        ProxyStat.init_global_resp_time()
 
     def add_proxy(self, proxy_info, insert=False):
         p1 = proxy_info.find('/')
@@ -228,6 +240,7 @@ class ProxyHolder(object):
             proxy = Socks5Proxy(self, '127.0.0.1', p, short_hostname=short_hostname)
             self.proxy_list.append(proxy)
             self.proxy_dict[proxy.short_hostname] = proxy
+            self.ranking.add(proxy)
 
     def add_http_proxy(self, hostname, port, short_hostname=None, insert=False):
         if short_hostname is None:
@@ -238,6 +251,7 @@ class ProxyHolder(object):
         else:
             self.proxy_list.append(proxy)
         self.proxy_dict[proxy.short_hostname] = proxy
+        self.ranking.add(proxy)
         self._proxy_count += 1
 
     def add_socks5_proxy(self, hostname, port, short_hostname=None, insert=False):
@@ -249,6 +263,7 @@ class ProxyHolder(object):
         else:
             self.proxy_list.append(proxy)
         self.proxy_dict[proxy.short_hostname] = proxy
+        self.ranking.add(proxy)
         self._proxy_count += 1
 
     def add_shadowsocks_proxys(self, *hostnames):
@@ -282,6 +297,7 @@ class ProxyHolder(object):
         else:
             self.proxy_list.append(proxy)
         self.proxy_dict[proxy.short_hostname] = proxy
+        self.ranking.add(proxy)
         self._proxy_count += 1
 
     def _test_proxy(self, proxy_name=None, test_url='http://www.google.com.hk/', reason=''):
@@ -571,7 +587,9 @@ class ProxyHolder(object):
                     code = code1
                 if hosts is None:
                     self.last_speed_test_time = time.time()
-                self.proxy_list.sort(key=sort_proxies)
+                # re-rank all with the global tp90 after the speed test
+                self.ranking.rebuild()
+                self.proxy_list[:] = self.ranking
                 if hosts is None and (self.head_proxy.down_speed < 100 * 1024 or self.head_proxy.hostname not in may_the_heads) and retried < common.speed_retry_count:
                     retried += 1
                     logger.info("test_proxies_speed RE-RUN #%d for head[%s] speed=%sB/S",
@@ -651,8 +669,10 @@ class ProxyHolder(object):
 
     def remove_proxy(self, proxy):
         self.proxy_list.remove(proxy)
+        self.ranking.remove(proxy)
         self._proxy_count -= 1
         del self.proxy_dict[proxy.short_hostname]
+        proxy.sock_pool.close()
         # delete cached response time
         ProxyStat.global_resp_time.checkout(proxy.hostname)
         if proxy.hostname in self.auto_pause_list:
@@ -660,6 +680,8 @@ class ProxyHolder(object):
         self.remove_proxy_from_domain_speed(proxy)
 
     def check(self, proxy, reason):
+        if self.is_follower:
+            return
         if self.checking_proxy and proxy.short_hostname in self.checking_proxy and common.KEY_IP_CHANGED not in reason:
             return
         self.proxy_check_queue.put_nowait((proxy, reason))
@@ -692,6 +714,10 @@ class ProxyHolder(object):
 
             try:
                 if timeout:
+                    for p in self.proxy_list:
+                        p.sock_pool.sweep()
+                    if self.is_follower:
+                        continue
                     yield from self.test_proxies()
                     if self._proxy_check(timeout):
                         check_interval = common.proxys_check_timeout
@@ -821,6 +847,49 @@ class ProxyHolder(object):
 
         return False
 
+    def on_proxy_stat_changed(self, proxy):
+        if proxy in self.ranking:
+            self.ranking.update(proxy)
+
+    def on_proxy_stat_updated(self, proxy, resp_time, target_host, proxy_ip, proxy_fail, proxy_timeout, proxy_name):
+        if self.worker_bus is not None:
+            self.worker_bus.send_stat(proxy, resp_time, target_host, proxy_ip, proxy_fail, proxy_timeout, proxy_name)
+
+    def apply_worker_stat(self, samples):
+        """ the response time samples from the follower workers """
+        for short_hostname, resp_time, target_host, proxy_ip, proxy_fail, proxy_timeout, proxy_name in samples:
+            p = self.proxy_dict.get(short_hostname)
+            if p is not None:
+                p.update_proxy_stat(None, resp_time, target_host=target_host, proxy_ip=proxy_ip, loginfo='worker response',
+                                    proxy_fail=proxy_fail, proxy_timeout=proxy_timeout, proxy_name=proxy_name)
+
+    def worker_state(self):
+        """ the proxies order and stat broadcast by the leader worker """
+        return {
+            'op': 'state',
+            'proxies': [[p.short_hostname, p.stat_json()] for p in self.proxy_list],
+            'auto_pause': [*self.auto_pause_list],
+            'fix_top': self.fix_top,
+            'available': self.available,
+            'last_speed_test_time': self.last_speed_test_time,
+        }
+
+    def apply_worker_state(self, state):
+        ordered = []
+        for short_hostname, stat in state['proxies']:
+            p = self.proxy_dict.get(short_hostname)
+            if p is not None:
+                p.load_stat(stat)
+                ordered.append(p)
+        # the proxies unknown by the leader(added and not yet relayed) keep at the tail
+        ordered_ids = set(id(p) for p in ordered)
+        ordered.extend(p for p in self.proxy_list if id(p) not in ordered_ids)
+        self.proxy_list[:] = ordered
+        self.auto_pause_list = set(state['auto_pause'])
+        self.fix_top = state['fix_top']
+        self.available = state['available']
+        self.last_speed_test_time = state['last_speed_test_time']
+
     @property
     def psize(self):
         return self._proxy_count
@@ -872,7 +941,11 @@ class ProxyHolder(object):
             select_from = 1
             select_end = self._proxy_count
         head_proxy = self.head_proxy
-        for proxy in sorted(self.proxy_list[select_from:select_end], key=sort_proxies):
+        # the same candidates as proxy_list[select_from:select_end]
+        excluded = self.proxy_list[-1] if select_from == 0 else head_proxy
+        for proxy in self.ranking:
+            if proxy is excluded:
+                continue
             if head_proxy.sort_key > proxy.sort_key and not force_to_head:
                 logger.debug("try_select_head_proxy(): NOT move %s to HEAD cause sort_key[%.1f] > head.sort_key(%s)", proxy, proxy.sort_key, head_proxy.sort_key)
                 break
@@ -911,4 +984,113 @@ class ProxyHolder(object):
                            select_from, select_end, "by force" if force_to_head else '')
         return None if only_select else False
 
-
+    def balance_proxy(self):
+        """ the proxy of a new connection by common.balance_mode, in the head and the top healthy proxies """
+        head_proxy = self.head_proxy
+        if common.balance_mode <= 0 or self._proxy_count <= 1 or self.fix_top:
+            return head_proxy
+        candidates = [head_proxy]
+        for proxy in self.ranking:
+            if len(candidates) >= common.balance_top_k or proxy.pause:
+                # the paused are ranked at last
+                break
+            if proxy is head_proxy or proxy.sort_key <= 0 or proxy.fail_rate > common.fail_rate_threshold \
+                    or proxy.error_time < common.retry_interval_on_error * proxy.error_count:
+                continue
+            candidates.append(proxy)
+        if len(candidates) == 1:
+            return head_proxy
+        if common.balance_mode == 1:
+            p1, p2 = random.sample(candidates, 2)
+            return p1 if balance_cost(p1) <= balance_cost(p2) else p2
+        weights = [max(p.sort_key, 1) / (p.conn_count + 1) for p in candidates]
+        r = random.uniform(0, sum(weights))
+        for proxy, weight in zip(candidates, weights):
+            r -= weight
+            if r <= 0:
+                return proxy
+        return candidates[-1]
+
+
+def benchmark_selection(proxies=30, loops=10000):
+    """ cost of the head proxy selection loop: sort_proxies, try_select_head_proxy and the auto pause checks of _proxy_check """
+    import random
+
+    holder = ProxyHolder(0)
+    ProxyStat.init_global_resp_time()
+    for i in range(0, proxies):
+        holder.add_http_proxy('proxy%d.bench.test' % i, 8000 + i)
+    for i, proxy in enumerate(holder.proxy_list):
+        proxy_ip = '10.0.0.%d' % i
+        proxy.resolved_addr = ([proxy_ip], proxy.port)
+        proxy.down_speed = 102400 * (i + 1)
+        for n in range(0, common.tp90_calc_count):
+            proxy.update_proxy_stat(None, random.uniform(0.1, 3), target_host='bench.test', proxy_ip=proxy_ip,
+                                    proxy_name='bench', proxy_fail=(n % (i + 5) == 0))
+
+    start = time.time()
+    for _ in range(0, loops):
+        holder.try_select_head_proxy(only_select=True)
+        holder.ranking.first()
+        global_tp90 = ProxyStat.calc_tp90()
+        for proxy in holder.proxy_list[1:]:
+            if not proxy.pause:
+                proxy.tp90 >= global_tp90 * 3 and proxy.tp90_len > 10 or proxy.proxy_count > 10 and proxy.fail_rate >= 1
+            proxy.error_time < common.retry_interval_on_error * proxy.error_count
+    used = time.time() - start
+    print('%d proxies: %.1f us per selection loop' % (proxies, used / loops * 1000000))
+
+
+def simulate_balance(seconds=120, conn_rate=8, conn_bytes=1048576, speeds=(4, 3, 2.5, 2, 1)):
+    """
+    new connections to the simulated upstreams by each balance_mode, an upstream shares its speeds(MB/s)
+    to its in-flight connections equally
+    """
+    for mode in (0, 1, 2):
+        random.seed(1)
+        common.balance_mode = mode
+        holder = ProxyHolder(0)
+        ProxyStat.init_global_resp_time()
+        for i, speed in enumerate(speeds):
+            holder.add_http_proxy('upstream%d.sim.test' % i, 8000 + i)
+            proxy = holder.proxy_list[i]
+            proxy.resolved_addr = (['10.0.0.%d' % i], proxy.port)
+            proxy.down_speed = speed * 1048576
+            for n in range(0, common.tp90_calc_count):
+                proxy.update_proxy_stat(None, random.uniform(0.1, 0.5), target_host='sim.test', proxy_ip='10.0.0.%d' % i, proxy_name='sim')
+        bandwidth = {id(p): speed * 1048576 for p, speed in zip(holder.proxy_list, speeds)}
+        # [proxy, remaining bytes, start time]
+        transfers = []
+        done_bytes = 0
+        used_times = []
+        dt = 0.01
+        now = 0.0
+        while now < seconds:
+            now += dt
+            for _ in range(0, int(random.random() < conn_rate * dt)):
+                proxy = holder.balance_proxy()
+                proxy.conn_count += 1
+                transfers.append([proxy, conn_bytes, now])
+            for t in transfers:
+                proxy = t[0]
+                sent = min(t[1], bandwidth[id(proxy)] / proxy.conn_count * dt)
+                t[1] -= sent
+                done_bytes += sent
+            for t in [t for t in transfers if t[1] <= 0]:
+                t[0].conn_count -= 1
+                used_times.append(now - t[2])
+                transfers.remove(t)
+        print('balance_mode=%d: %.2f MB/s, %d done, %d in-flight, avg %.2f sec per connection' %
+              (mode, done_bytes / seconds / 1048576, len(used_times), len(transfers),
+               sum(used_times) / len(used_times) if used_times else 0))
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        # python -m tsproxy.proxyholder bench [proxies]
+        benchmark_selection(*[int(arg) for arg in sys.argv[2:3]])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'simulate':
+        # python -m tsproxy.proxyholder simulate [seconds]
+        simulate_balance(*[int(arg) for arg in sys.argv[2:3]])
@@ -15,7 +15,8 @@ from tsproxy.common import print_stack_trace, lookup_conf_file, load_tsproxy_con
 from tsproxy.connector import RouterableConnector, CheckConnector
 from tsproxy.listener import ManageableHttpListener, HttpListener
 from tsproxy.proxyholder import ProxyHolder
-from tsproxy import topendns
+from tsproxy.workers import LeaderBus, FollowerBus, bus_path
+from tsproxy import common, topendns
 
 logger = logging.getLogger(__name__)
 
@@ -48,6 +49,9 @@ def args_parse(args=None):
                         help="socks5 proxy listening port.\ndefault is 7070")
     parser.add_argument('--pid-file', dest='pid_file', default='.ss-proxy.pid',
                         help="file to store the process id.\ndefault filename is '.ss-proxy.pid'.")
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help="worker processes sharing the http port by SO_REUSEPORT, \n"
+                             "the worker#0 checks the proxies and shares the result to the others.\ndefault is 1.")
     parser.add_argument('--conf_path', dest='conf_path',
                         help="config files path, if not specified, default search config files from './' and 'conf/'.")
     parser.add_argument('--conf_file', dest='conf_file', default='tsproxy.conf',
@@ -93,6 +97,8 @@ async def update_conf(conf_file, logger_conf_file, update_interval=10, loop=None
                 mtime = os.stat(logger_conf_file).st_mtime
                 if mtime > logger_conf_mod:
                     logging.config.fileConfig(logger_conf_file, disable_existing_loggers=False)
+                    if common.async_logging:
+                        common.start_async_logging()
                     logger_conf_mod = mtime
                     logger.info('logger conf file %s reloaded', logger_conf_file)
             except BaseException as ex_log1:
@@ -113,7 +119,7 @@ async def update_apnic(inital_wait, loop=None):
             logging.exception('update_apnic fail: %s', ex)
 
 
-def startup(*proxies, http_port=8080, http_address='127.0.0.1', proxy_file='proxies.json', pid_file='.ss-proxy.pid', smart_mode=1, **kwargs):
+def startup(*proxies, http_port=8080, http_address='127.0.0.1', proxy_file='proxies.json', pid_file='.ss-proxy.pid', smart_mode=1, worker=0, workers=1, **kwargs):
     from tsproxy import conf_path
     global conf_path
     global conf_file_mod
@@ -148,6 +154,8 @@ def startup(*proxies, http_port=8080, http_address='127.0.0.1', proxy_file='prox
         logger.info('%s loaded', _conf_file)
     except BaseException as ex_conf:
         logging.exception('load_tsproxy_conf(%s) fail: %s', _conf_file, ex_conf)
+    if common.async_logging:
+        common.start_async_logging()
 
     proxy_file = lookup_conf_file(proxy_file)
     try:
@@ -160,6 +168,12 @@ def startup(*proxies, http_port=8080, http_address='127.0.0.1', proxy_file='prox
     asyncio.set_event_loop(uvloop.new_event_loop())
     loop = asyncio.get_event_loop()
     proxy_holder = ProxyHolder(http_port+1, loop=loop)
+    if workers > 1:
+        if worker == 0:
+            proxy_holder.worker_bus = LeaderBus(proxy_holder, bus_path(pid_file), loop=loop)
+        else:
+            proxy_holder.worker_bus = FollowerBus(proxy_holder, bus_path(pid_file), worker, loop=loop)
+            pid_file = '%s.%d' % (pid_file, worker)
     if not proxies:
         proxy_holder.load_json(j_in)
     else:
@@ -198,6 +212,9 @@ def startup(*proxies, http_port=8080, http_address='127.0.0.1', proxy_file='prox
     next_update_apnic = loop.run_until_complete(apnic_update_task)
 
     def dump_config():
+        if proxy_holder.is_follower:
+            # proxy_file is owned by the leader worker
+            return
         j_dump = {}
         http_proxy.dump_acl(j_dump)
         proxy_holder.dump_json(j_dump)
@@ -212,16 +229,21 @@ def startup(*proxies, http_port=8080, http_address='127.0.0.1', proxy_file='prox
                                         connector=RouterableConnector(proxy_holder, smart_mode, loop, **kwargs),
                                         proxy_holder=proxy_holder,
                                         dump_config=dump_config,
-                                        loop=loop)
+                                        loop=loop,
+                                        reuse_port=workers > 1)
+    # the proxies are checked by the leader worker only
     check_proxy = HttpListener(listen_addr=('127.0.0.1', http_port+1),
-                               connector=CheckConnector(proxy_holder, loop))
+                               connector=CheckConnector(proxy_holder, loop)) if not proxy_holder.is_follower else None
     # https_proxy = HttpsListener(listen_addr=('127.0.0.1', http_port - 1),
     #                             connector=SmartConnector(proxy_holder, smart_mode, loop))
 
     http_proxy.load_acl(j_in)
     server = loop.run_until_complete(http_proxy.start())
     # https_server = loop.run_until_complete(https_proxy.start())
-    check_server = loop.run_until_complete(check_proxy.start())
+    check_server = loop.run_until_complete(check_proxy.start()) if check_proxy is not None else None
+    if proxy_holder.worker_bus is not None:
+        proxy_holder.worker_bus.command_handler = lambda cmd_line, out: http_proxy.do_command(cmd_line, out, None, fanout=False)
+        loop.run_until_complete(proxy_holder.worker_bus.start())
 
     with open(pid_file, 'w') as f:
         f.write('%d' % os.getpid())
@@ -232,16 +254,20 @@ def startup(*proxies, http_port=8080, http_address='127.0.0.1', proxy_file='prox
             loop.create_task(update_apnic(next_update_apnic, loop=loop))
             loop.create_task(proxy_holder.monitor_loop(loop=loop))
 
-            logger.info('TSProxy v%s Startup' % __version__)
-            ts_print('TSProxy v%s Startup' % __version__)
+            logger.info('TSProxy v%s Startup%s' % (__version__, (' worker#%d' % worker) if workers > 1 else ''))
+            ts_print('TSProxy v%s Startup%s' % (__version__, (' worker#%d' % worker) if workers > 1 else ''))
             _startup = True
             loop.run_forever()
         server.close()
         # https_server.close()
-        check_server.close()
+        if check_server is not None:
+            check_server.close()
+        if proxy_holder.worker_bus is not None:
+            proxy_holder.worker_bus.close()
         loop.run_until_complete(server.wait_closed())
         # loop.run_until_complete(https_server.wait_closed())
-        loop.run_until_complete(check_server.wait_closed())
+        if check_server is not None:
+            loop.run_until_complete(check_server.wait_closed())
         loop.close()
         dump_config()
     finally:
@@ -249,12 +275,75 @@ def startup(*proxies, http_port=8080, http_address='127.0.0.1', proxy_file='prox
         logger.info('TSProxy Closed')
 
 
+def _fork_worker(hostnames, kwargs, worker, workers):
+    pid = os.fork()
+    if pid == 0:
+        os.setsid()
+        startup(*hostnames, worker=worker, workers=workers, **kwargs)
+        os._exit(0)
+    ts_print('MONITOR WORKER#%d PROCESS %d... ' % (worker, pid), flush=True)
+    return pid
+
+
+def _wait_leader_startup(leader_pid, pid_file, timeout=120):
+    """ the leader writes the pid file after the apnic file updated and the worker bus listened """
+    import time
+    wait_until = time.time() + timeout
+    while time.time() < wait_until:
+        try:
+            with open(pid_file, 'r') as f:
+                if f.read().strip() == '%d' % leader_pid:
+                    return True
+        except FileNotFoundError:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+def supervise_workers(hostnames, kwargs, workers, max_restarts=100):
+    import time
+    pid_file = kwargs['pid_file']
+    leader_pid = _fork_worker(hostnames, kwargs, 0, workers)
+    _wait_leader_startup(leader_pid, pid_file)
+    worker_pids = {leader_pid: 0}
+    for worker in range(1, workers):
+        worker_pids[_fork_worker(hostnames, kwargs, worker, workers)] = worker
+    restarts = 0
+    shutdown = False
+    while worker_pids:
+        pid, rc = os.wait()
+        worker = worker_pids.pop(pid, None)
+        if worker is None:
+            continue
+        ts_print('WORKER#%d PROCESS %d QUIT WITH %d ... ' % (worker, pid, rc), flush=True)
+        if shutdown:
+            continue
+        if (rc == 0 and not os.path.exists(pid_file)) or restarts >= max_restarts:
+            # the leader closed gracefully, close the others
+            ts_print('QUIT MONITOR', flush=True)
+            shutdown = True
+            for pid in worker_pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        else:
+            restarts += 1
+            ts_print('#%d RESTART WORKER#%d PROCESS...' % (restarts, worker), flush=True)
+            time.sleep(1)
+            worker_pids[_fork_worker(hostnames, kwargs, worker, workers)] = worker
+
+
 def main():
     import time
     kwargs, hostnames = args_parse()
+    workers = kwargs.pop('workers')
     pid = os.fork()
     if pid == 0:
         os.setsid()
+        if workers > 1:
+            supervise_workers(hostnames, kwargs, workers)
+            return
         for i in range(0, 100):
             pid = os.fork()
             if pid == 0:
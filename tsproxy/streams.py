@@ -2,6 +2,7 @@ import asyncio
 import logging
 import socket
 import time
+from collections import deque
 from concurrent.futures import CancelledError
 
 from tsproxy import common, topendns
@@ -9,7 +10,8 @@ from tsproxy import common, topendns
 logger = logging.getLogger(__name__)
 
 
-async def start_listener(handler, host=None, port=None, *, loop=None, encoder=None, decoder=None, acl_ips=None, ssl=None, **kwargs):
+async def start_listener(handler, host=None, port=None, *, loop=None, encoder=None, decoder=None, acl_ips=None, ssl=None, reuse_port=None, **kwargs):
+    """ :param reuse_port: share the port with the other worker processes by SO_REUSEPORT """
     if loop is None:
         loop = asyncio.get_event_loop()
 
@@ -17,10 +19,11 @@ async def start_listener(handler, host=None, port=None, *, loop=None, encoder=No
         _protocol = StreamProtocol(handler, loop=loop, encoder=encoder, decoder=decoder, acl_ips=acl_ips, **kwargs)
         return _protocol
 
-    return await loop.create_server(factory, host, port, backlog=1024, ssl=ssl)
+    return await loop.create_server(factory, host, port, backlog=1024, ssl=ssl, reuse_port=reuse_port)
 
 
-def start_connection(handler, ip, port, host=None, *, loop=None, encoder=None, decoder=None, connect_timeout=common.default_timeout, **kwargs):
+def start_connection(handler, ip, port, host=None, *, loop=None, encoder=None, decoder=None, connect_timeout=common.default_timeout, sock=None, **kwargs):
+    """ :param sock: the connected socket(from ProxySocketPool), skip the connecting if given """
     if loop is None:
         loop = asyncio.get_event_loop()
     if host is None:
@@ -29,17 +32,21 @@ def start_connection(handler, ip, port, host=None, *, loop=None, encoder=None, d
     create_time = time.time()
 
     try:
-        if topendns.is_ipv6(ip):
-            sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        if sock is not None:
+            logger.debug('connected (%s/%s:%d) by pooled socket', host, ip, port)
         else:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.setblocking(False)
-        logger.debug('connecting (%s/%s:%d) ...', host, ip, port)
-        with common.Timeout(connect_timeout):
-            yield from loop.sock_connect(sock, (ip, port))
-        logger.debug('connected (%s/%s:%d) used %.3f seconds', host, ip, port, (time.time() - create_time))
+            if topendns.is_ipv6(ip):
+                sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setblocking(False)
+            logger.debug('connecting (%s/%s:%d) ...', host, ip, port)
+            with common.Timeout(connect_timeout):
+                yield from loop.sock_connect(sock, (ip, port))
+            logger.debug('connected (%s/%s:%d) used %.3f seconds', host, ip, port, (time.time() - create_time))
     except BaseException as ex:
+        close_sock_slient(sock)
         if isinstance(ex, ConnectionError) \
                 or isinstance(ex, asyncio.TimeoutError) or isinstance(ex, TimeoutError):
             topendns.del_cache(host)
@@ -59,7 +66,7 @@ def start_connection(handler, ip, port, host=None, *, loop=None, encoder=None, d
     return protocol.connection
 
 
-def _close_sock_slient(sock):
+def close_sock_slient(sock):
     try:
         sock.close()
     except BaseException:
@@ -77,6 +84,8 @@ class StreamProtocol(asyncio.StreamReaderProtocol):
         self._encoder = encoder
         self._acl_ips = acl_ips
         self._close_waiter = None
+        self._resume_writing_callbacks = []
+        self._connection_lost_callbacks = []
         self.init_exception = None
 
     def connection_made(self, transport):
@@ -96,17 +105,18 @@ class StreamProtocol(asyncio.StreamReaderProtocol):
                 _server = _socket.getsockname()
             except Exception as ex1:
                 logger.warning("handle socket %s %s: %s", _socket, common.clazz_fullname(ex1), ex1)
-                # _close_sock_slient(_socket)
+                # close_sock_slient(_socket)
                 return
             laddr = _client[0]
             raddr = _server[0]
             if laddr != '127.0.0.1' and laddr != raddr and not topendns.is_subnet(laddr, self._acl_ips):
                 raise Exception("%s NOT in ACLs" % laddr)
                 # logger.warning("%s NOT in ACLs" % laddr)
-                # _close_sock_slient(_socket)
+                # close_sock_slient(_socket)
                 # self.eof_received()
                 # return
 
+        transport.set_write_buffer_limits(high=common.write_high_watermark, low=common.write_low_watermark)
         self._stream_reader.set_transport(transport)
         self._over_ssl = transport.get_extra_info('sslcontext') is not None
         self._stream_writer = StreamWriter(transport, self,
@@ -145,6 +155,13 @@ class StreamProtocol(asyncio.StreamReaderProtocol):
             StreamProtocol._connection_counter -= 1
             logger.debug('connection_lost#%d: %s lived %.2f seconds', StreamProtocol._connection_counter, self._connection, self._connection.life_time)
         super().connection_lost(exc)
+        # release the paused sources, they will find this connection is closing
+        callbacks, self._resume_writing_callbacks = self._resume_writing_callbacks, []
+        for callback in callbacks:
+            callback()
+        callbacks, self._connection_lost_callbacks = self._connection_lost_callbacks, []
+        for callback in callbacks:
+            callback()
         waiter = self._close_waiter
         if waiter is None:
             return
@@ -157,7 +174,7 @@ class StreamProtocol(asyncio.StreamReaderProtocol):
             waiter.set_exception(exc)
 
     def data_received(self, data):
-        _log_data('%s received' % self.connection, data)
+        _log_data(self.connection, 'received', data)
         super().data_received(data)
 
     def eof_received(self):
@@ -173,6 +190,19 @@ class StreamProtocol(asyncio.StreamReaderProtocol):
     def resume_writing(self):
         super().resume_writing()
         logger.debug('resume_writing: %s', self.connection)
+        callbacks, self._resume_writing_callbacks = self._resume_writing_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_resume_writing_callback(self, callback):
+        self._resume_writing_callbacks.append(callback)
+
+    def add_connection_lost_callback(self, callback):
+        """ call the callback once on connection_lost, immediately if the connection is lost already """
+        if self._connection_lost:
+            callback()
+        else:
+            self._connection_lost_callbacks.append(callback)
 
     @property
     def connection(self):
@@ -278,9 +308,28 @@ class StreamConnection(dict):
         if self._closing:
             return
         self._closing = True
+        self._reader.stop_relay()
         if not self._reader.at_eof():
             self._reader.feed_eof_by_close()
 
+    def relay_to(self, peer_conn, on_data=None):
+        """
+        write the data received to peer_conn at the protocol level if it needs no transformation,
+        so that it skips the reader buffer and the forwarding coroutine
+        :return: True if relaying
+        """
+        if self._reader.is_relaying:
+            return True
+        if not common.fast_relay or len(self._reader) > 0 \
+                or not self._reader.is_transparent or not peer_conn.writer.is_transparent:
+            return False
+        self._reader.start_relay(peer_conn.writer, on_data)
+        logger.debug('%s relay to %s', self, peer_conn)
+        return True
+
+    def add_close_callback(self, callback):
+        self._writer._protocol.add_connection_lost_callback(callback)
+
     @asyncio.coroutine
     def aclose(self):
         self.close()
@@ -300,6 +349,9 @@ class StreamReader(asyncio.StreamReader):
         self._connection = None
         self._recv_bytes = 0
         self._active_time = time.time()
+        self._relay_writer = None
+        self._relay_on_data = None
+        self._flow_paused = False
 
     def __len__(self):
         return len(self._buffer)
@@ -308,8 +360,32 @@ class StreamReader(asyncio.StreamReader):
     def recv_bytes(self):
         return self._recv_bytes
 
+    @property
+    def is_transparent(self):
+        """ the data read is just the bytes received """
+        return self._decoder is None or self._decoder.is_transparent(self._connection)
+
+    @property
+    def is_relaying(self):
+        return self._relay_writer is not None
+
+    def start_relay(self, writer, on_data=None):
+        self._relay_writer = writer
+        self._relay_on_data = on_data
+
+    def stop_relay(self):
+        self._relay_writer = None
+        self._relay_on_data = None
+
     def feed_data(self, data):
-        if not self._eof:
+        if self._relay_writer is not None and not self._eof and not self._buffer \
+                and not self._relay_writer.is_closing:
+            self._recv_bytes += len(data)
+            self._active_time = time.time()
+            if self._relay_on_data:
+                self._relay_on_data(data)
+            self._relay_writer.relay_write(data, self)
+        elif not self._eof:
             super().feed_data(data)
             self._recv_bytes += len(data)
             self._active_time = time.time()
@@ -323,6 +399,10 @@ class StreamReader(asyncio.StreamReader):
         else:
             _size = size
         try:
+            if len(self._buffer) >= (_size if exactly else 1):
+                # enough data in buffer, needn't wait(and the timeout)
+                r = yield from (super().readexactly(_size) if exactly else super().read(_size))
+                return r
             with common.Timeout(read_timeout, loop=self._loop):
                 if exactly:
                     r = yield from super().readexactly(_size)
@@ -335,7 +415,7 @@ class StreamReader(asyncio.StreamReader):
         #     logger.debug("%s read_bytes(%s %d %s) %s: %s", self._connection, size, read_timeout, exactly, ex1.__class__.__name__, ex1)
         #     return None
         except ConnectionError as ex1:
-            logger.debug("%s read_bytes(%s %d %s) %s: %s", self._connection, size, read_timeout, exactly, common.clazz_fullname(ex1), ex1)
+            logger.debug("%s read_bytes(%s %s %s) %s: %s", self._connection, size, read_timeout, exactly, common.clazz_fullname(ex1), ex1)
             return None
 
     def read(self, n=None, read_timeout=common.default_timeout) -> bytes:
@@ -345,15 +425,55 @@ class StreamReader(asyncio.StreamReader):
             r = yield from self.read_bytes(size=n, read_timeout=read_timeout)
         return r
 
+    def unread(self, data):
+        """ put the data back to the head of the buffer, it is read first then """
+        if data:
+            self._buffer[0:0] = data
+
+    def wakeup(self, exc):
+        """ wake up the pending read by exc, the reader itself is still readable """
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_exception(exc)
+
     def feed_eof_by_close(self):
         logger.debug('%s feed_eof_by_close with buffer(%d)', self._connection, len(self._buffer))
         super().feed_eof()
 
+    @property
+    def flow_paused(self):
+        return self._flow_paused
+
     def pause_reading(self):
-        self._transport.pause_reading()
+        """
+        hold the transport reading until resume_reading, the flow control of the peer writer,
+        independent of the pausing by the reader buffer limit(self._paused)
+        """
+        if self._flow_paused:
+            return
+        self._flow_paused = True
+        if not self._paused:
+            self._transport.pause_reading()
 
     def resume_reading(self):
-        self._transport.resume_reading()
+        if not self._flow_paused:
+            return
+        self._flow_paused = False
+        if not self._paused:
+            self._transport.resume_reading()
+        else:
+            self._maybe_resume_transport()
+
+    def _maybe_resume_transport(self):
+        # the reader buffer is consumed, but the peer may still be over the high watermark
+        if not self._flow_paused:
+            super()._maybe_resume_transport()
+
+    def _wait_for_data(self, func_name):
+        if self._flow_paused and self._paused:
+            # hand the pausing over to the flow control, waiting the data must not resume the transport
+            self._paused = False
+        return super()._wait_for_data(func_name)
 
 
 class StreamWriter(asyncio.StreamWriter):
@@ -364,29 +484,171 @@ class StreamWriter(asyncio.StreamWriter):
         self._connection = None
         self._written_bytes = 0
         self._active_time = time.time()
+        # the data waiting for the encoding in the executor(Encoder.offload), to keep the order
+        self._offload_queue = deque()
+        self._encoding = None
+        self._encoded_callbacks = []
+        # the small writes coalesced into one encoding and transport write(Encoder.coalesce)
+        self._coalesce_buf = []
+        self._coalesce_len = 0
+        self._coalesce_handle = None
+        self._coalesce_held = False
 
     def write(self, data):
         if self._encoder:
-            data = self._encoder(data, self._connection)
+            if self._coalesce_buf or self._encoder.coalesce(data, self._connection):
+                self._coalesce(data)
+            else:
+                self._encode(data)
+        else:
+            self._write(data)
+
+    def write_with_next(self, data, timeout):
+        """ hold the data to write it with the next write, or in timeout seconds(the proxy head, ...) """
+        if not self._encoder or not self._encoder.coalesce(data, self._connection):
+            self.write(data)
+            return
+        self.flush()
+        self._coalesce_buf.append(data)
+        self._coalesce_len += len(data)
+        self._coalesce_held = True
+        self._coalesce_handle = self._loop.call_later(timeout, self.flush)
+
+    def _coalesce(self, data):
+        if isinstance(data, memoryview):
+            # copy the view, its buffer may be changed after the write
+            data = bytes(data)
+        self._coalesce_buf.append(data)
+        self._coalesce_len += len(data)
+        if self._coalesce_held or self._coalesce_len >= common.write_coalesce_bytes:
+            self.flush()
+        elif self._coalesce_handle is None:
+            if common.write_coalesce_delay > 0:
+                self._coalesce_handle = self._loop.call_later(common.write_coalesce_delay, self.flush)
+            else:
+                self._coalesce_handle = self._loop.call_soon(self.flush)
+
+    def flush(self):
+        """ encode and write the coalesced data at once """
+        if self._coalesce_handle is not None:
+            self._coalesce_handle.cancel()
+            self._coalesce_handle = None
+        self._coalesce_held = False
+        if not self._coalesce_buf:
+            return
+        buf, self._coalesce_buf, self._coalesce_len = self._coalesce_buf, [], 0
+        if not self._transport.is_closing():
+            self._encode(buf[0] if len(buf) == 1 else b''.join(buf))
+
+    def _encode(self, data):
+        if self._encoding is not None or self._encoder.offload(data, self._connection):
+            self._offload_queue.append(data)
+            if self._encoding is None:
+                self._encode_next()
+        else:
+            self._write(self._encoder(data, self._connection))
+
+    def _write(self, data):
         super().write(data)
-        _log_data('%s written' % self._connection, data)
+        _log_data(self._connection, 'written', data)
         self._written_bytes += len(data)
         self._active_time = time.time()
 
+    def _encode_next(self):
+        """ encode and write the queued data in order, one chunk in the executor at a time """
+        queue = self._offload_queue
+        while queue:
+            data = queue.popleft()
+            if self._encoder.offload(data, self._connection):
+                self._encoding = self._loop.run_in_executor(common.get_crypto_executor(), self._encoder, data, self._connection)
+                self._encoding.add_done_callback(self._on_encoded)
+                return
+            self._write(self._encoder(data, self._connection))
+        self._encoding = None
+        callbacks, self._encoded_callbacks = self._encoded_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def _on_encoded(self, future):
+        try:
+            data = future.result()
+        except Exception as ex:
+            logger.warning('%s encoding in executor fail: %s(%s)', self._connection, common.clazz_fullname(ex), ex)
+            self._offload_queue.clear()
+            self._transport.close()
+        else:
+            if self._transport.is_closing():
+                self._offload_queue.clear()
+            else:
+                self._write(data)
+        self._encode_next()
+
+    def close(self):
+        self.flush()
+        if self._encoding is not None:
+            # close after the queued data written
+            self._encoded_callbacks.append(super().close)
+            return
+        super().close()
+
+    def write_eof(self):
+        self.flush()
+        if self._encoding is not None:
+            self._encoded_callbacks.append(super().write_eof)
+            return
+        return super().write_eof()
+
+    @asyncio.coroutine
+    def drain(self):
+        if self._encoding is not None:
+            waiter = self._loop.create_future()
+            self._encoded_callbacks.append(lambda: waiter.done() or waiter.set_result(None))
+            yield from waiter
+        yield from super().drain()
+
+    def relay_write(self, data, source_reader):
+        """ write the data from source_reader without the encoder, pause the source if the write buffer is full """
+        self._transport.write(data)
+        self._written_bytes += len(data)
+        self._active_time = time.time()
+        self._hold_source(source_reader)
+
+    def forward_write(self, data, source_reader):
+        """ write the data read from source_reader, instead of the drain after every write """
+        self.write(data)
+        self._hold_source(source_reader)
+
+    def _hold_source(self, source_reader):
+        # the write buffer is over the high watermark, pause the source until it is below the low watermark
+        if self._protocol._paused and not source_reader.flow_paused:
+            source_reader.pause_reading()
+            self._protocol.add_resume_writing_callback(source_reader.resume_reading)
+        # or the data is encoding in the executor, pause the source until the queue is written
+        elif self._encoding is not None and not source_reader.flow_paused:
+            source_reader.pause_reading()
+            self._encoded_callbacks.append(source_reader.resume_reading)
+
     @property
     def written_bytes(self):
         return self._written_bytes
 
+    @property
+    def is_transparent(self):
+        """ the data written is just the bytes sent """
+        return self._encoder is None or self._encoder.is_transparent(self._connection)
+
     @property
     def is_closing(self):
         return self._transport.is_closing()
 
 
-def _log_data(log_info, data, loglevel=5, max_len=200):
+def _log_data(connection, action, data, loglevel=5, max_len=200):
+    if not logger.isEnabledFor(loglevel):
+        return
     if len(data) > max_len:
-        logger.log(loglevel, "%s [%s...%s %d]", log_info, data[:max_len-20], data[len(data)-20:], len(data))
+        logger.log(loglevel, "%s %s [%s...%s %d]", connection, action, data[:max_len-20], data[len(data)-20:], len(data))
     else:
-        logger.log(loglevel, "%s [%s]", log_info, data)
+        logger.log(loglevel, "%s %s [%s]", connection, action, data)
 
 
 class Encoder:
@@ -394,8 +656,102 @@ class Encoder:
     def __call__(self, data, connection):
         raise NotImplementedError()
 
+    def offload(self, data, connection):
+        """ True if encoding the data in common.get_crypto_executor() instead of the event loop """
+        return False
+
+    def coalesce(self, data, connection):
+        """ True if the small data is coalesced with the writes following it(StreamWriter.flush) """
+        return False
+
+    def is_transparent(self, connection):
+        """ True if the data of connection will be written as it is from now on """
+        return False
+
 
 class Decoder:
 
     def __call__(self, connection, read_timeout):
         raise NotImplementedError()
+
+    def is_transparent(self, connection):
+        """ True if the data of connection will be read as it is received from now on """
+        return False
+
+
+def benchmark_relay(total_mb=200, chunk_size=65536):
+    """ throughput of client -> relay -> echo server -> relay -> client, with and without the fast relay """
+    loop = asyncio.get_event_loop()
+
+    @asyncio.coroutine
+    def echo(reader, writer):
+        while True:
+            data = yield from reader.read(chunk_size)
+            if not data:
+                break
+            writer.write(data)
+            yield from writer.drain()
+        writer.close()
+
+    echo_server = loop.run_until_complete(asyncio.start_server(echo, '127.0.0.1', 0, loop=loop))
+    echo_port = echo_server.sockets[0].getsockname()[1]
+
+    @asyncio.coroutine
+    def relay_handler(connection):
+        peer_ready = asyncio.Event(loop=loop)
+
+        @asyncio.coroutine
+        def peer_handler(peer_conn):
+            yield from peer_ready.wait()
+            yield from common.forward_forever(peer_conn, connection, is_responsed=True)
+            connection.close()
+
+        peer_conn = yield from start_connection(peer_handler, '127.0.0.1', echo_port, loop=loop)
+        peer_ready.set()
+        yield from common.forward_forever(connection, peer_conn, is_responsed=True)
+        peer_conn.close()
+
+    relay_server = loop.run_until_complete(start_listener(relay_handler, '127.0.0.1', 0, loop=loop))
+    relay_port = relay_server.sockets[0].getsockname()[1]
+
+    @asyncio.coroutine
+    def run():
+        reader, writer = yield from asyncio.open_connection('127.0.0.1', relay_port, loop=loop)
+        total = total_mb * 1024 * 1024
+        chunk = b'x' * chunk_size
+
+        @asyncio.coroutine
+        def send():
+            sent = 0
+            while sent < total:
+                writer.write(chunk)
+                sent += chunk_size
+                yield from writer.drain()
+
+        start = time.time()
+        sender = asyncio.ensure_future(send(), loop=loop)
+        received = 0
+        while received < total:
+            data = yield from reader.read(1024 * 1024)
+            if not data:
+                break
+            received += len(data)
+        used = time.time() - start
+        yield from sender
+        writer.close()
+        return received, used
+
+    for fast_relay in (False, True):
+        common.fast_relay = fast_relay
+        received, used = loop.run_until_complete(run())
+        print('fast_relay=%s: %s relayed in %.2f sec, %sB/S' % (fast_relay, common.fmt_human_bytes(received), used, common.fmt_human_bytes(received / used)))
+    relay_server.close()
+    echo_server.close()
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        # python -m tsproxy.streams bench [total_mb]
+        benchmark_relay(*[int(arg) for arg in sys.argv[2:3]])
@@ -1,21 +1,24 @@
+import asyncio
 import logging
 import os
 import re
 import socket
 import time
 import copy
+from array import array
+from bisect import bisect_right
 
-from dns.exception import Timeout
+from dns.exception import DNSException, Timeout
 from dns.resolver import NXDOMAIN
 from dns.resolver import NoAnswer
 from dns.resolver import Resolver
 
-from tsproxy.common import FIFOCache, MyThreadPoolExecutor, lookup_conf_file
-from tsproxy import common
+from tsproxy.common import LRUCache, lookup_conf_file
+from tsproxy.dnsclient import DnsClient
+from tsproxy import common, metrics
 
 logger = logging.getLogger(__name__)
 
-cn_ip_list = []
 cn_ip_file_mod = 0
 cn_ip_update = 0
 
@@ -32,8 +35,11 @@ resolver.nameservers.append('208.67.222.222')
 resolver.lifetime = 2
 resolver.port = 443
 
-cn_addr_cache = {}
-dns_cache = FIFOCache()
+# the same nameservers as resolver, used by async_dns_query on the event loop
+dns_client = DnsClient(resolver.nameservers, port=resolver.port, timeout=resolver.lifetime)
+
+cn_addr_cache = metrics.register_cache(LRUCache(cache_timeout=None, name='cn_addr_cache'))
+dns_cache = metrics.register_cache(LRUCache(cache_timeout=1800, name='dns_cache'))
 
 ip_regex = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
 
@@ -87,6 +93,55 @@ local_ip_list = (
 
 local_ip_mask_list = None
 
+
+class IpRangeIndex(object):
+    """ sorted and merged [start, end] ip ranges, lookup by bisect in O(log n) """
+
+    def __init__(self, typecode=None):
+        # ipv4 fits in array('Q'), ipv6(128 bits) has to use list of int
+        self.starts = array(typecode) if typecode else []
+        self.ends = array(typecode) if typecode else []
+        self.countries = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    @staticmethod
+    def build(ranges, typecode=None):
+        """
+        :param ranges: [(starting_ip, ending_ip, country), ...]
+        :param typecode: array typecode, None for list
+        :return: IpRangeIndex
+        """
+        index = IpRangeIndex(typecode)
+        last_end = -2
+        for start, end, country in sorted(ranges):
+            if start <= last_end + 1 and country == index.countries[-1]:
+                # adjacent or overlapped with the same country, merge it
+                if end > last_end:
+                    index.ends[-1] = last_end = end
+                continue
+            if start <= last_end:
+                # overlapped with another country, the former wins
+                if end <= last_end:
+                    continue
+                start = last_end + 1
+            index.starts.append(start)
+            index.ends.append(end)
+            index.countries.append(country)
+            last_end = end
+        return index
+
+    def lookup(self, ipn):
+        i = bisect_right(self.starts, ipn) - 1
+        if i >= 0 and ipn <= self.ends[i]:
+            return self.countries[i]
+        return None
+
+
+cn_ipv4_index = IpRangeIndex('Q')
+cn_ipv6_index = IpRangeIndex()
+
 _cn_domain_list = {
     'localhost',
     '.cn',
@@ -124,7 +179,8 @@ if 'WINDIR' in os.environ:
 
 # rlock = threading.RLock()
 
-dns_executor = MyThreadPoolExecutor(max_workers=os.cpu_count(), pool_name='DnsWorker', order_by_func=True)
+# (qname, local_dns) => future of the lookup in flight
+_dns_lookups = {}
 
 
 async def update_apnic_latest(raise_on_fail=False, loop=None):
@@ -282,31 +338,108 @@ def is_local(addr):
 
 
 def del_cache(addr):
-    if addr in dns_cache:
-        del dns_cache[addr]
-    if addr in cn_addr_cache:
-        del cn_addr_cache[addr]
+    dns_cache.pop(addr)
+    cn_addr_cache.pop(addr)
 
 
+@asyncio.coroutine
 def async_dns_query(qname, raise_on_fail=False, local_dns=False, ex_func=False, loop=None):
-    import asyncio
-
     if loop is None:
         loop = asyncio.get_event_loop()
     update_hosts()
-    if ex_func:
-        func = dns_query_ex
+    if is_ipv4(qname) or is_ipv6(qname):
+        ips = [qname]
     else:
-        func = dns_query
-    ip = func(qname, in_cache=True)
-    if not ip:
-        ip = yield from loop.run_in_executor(dns_executor, func, qname, raise_on_fail, local_dns)
+        cached = dns_cache.get_stale(qname)
+        if cached is not None:
+            ips, expire_in, hits = cached
+            if expire_in is not None and expire_in <= 0:
+                # answer the stale one right now and refresh it in background
+                logger.log(5, 'dns lookup %s => %s stale %.1f sec, refreshing', qname, ips, -expire_in)
+                _dns_lookup(qname, local_dns=local_dns, loop=loop)
+            elif expire_in is not None and expire_in <= common.dns_prefetch_time and hits >= common.dns_prefetch_hits:
+                # hot name, refresh it before expired
+                logger.log(5, 'dns lookup %s => %s expire in %.1f sec, prefetching', qname, ips, expire_in)
+                _dns_lookup(qname, local_dns=local_dns, loop=loop)
+        elif qname in _hosts:
+            ips = [_hosts[qname]]
+        else:
+            try:
+                # shield it, cancel of one waiter should not cancel the lookup of others
+                ips = yield from asyncio.shield(_dns_lookup(qname, local_dns=local_dns, loop=loop), loop=loop)
+            except asyncio.CancelledError:
+                raise
+            except BaseException:
+                if raise_on_fail:
+                    raise
+                return None
+    return ips if ex_func else _round_robin(ips)
+
+
+def _dns_lookup(qname, local_dns=False, loop=None):
+    key = (qname, local_dns)
+    lookup = _dns_lookups.get(key)
+    if lookup is None:
+        # only one lookup in flight for the same name, all the waiters share its result
+        lookup = asyncio.ensure_future(_async_dns_lookup(qname, local_dns=local_dns, loop=loop), loop=loop)
+        _dns_lookups[key] = lookup
+        lookup.add_done_callback(lambda f: _dns_lookup_done(key, f))
+    return lookup
+
+
+def _dns_lookup_done(key, future):
+    _dns_lookups.pop(key, None)
+    if not future.cancelled():
+        # retrieve it, avoid "exception was never retrieved" if all the waiters gone
+        future.exception()
+
+
+@asyncio.coroutine
+def _async_dns_lookup(qname, local_dns=False, loop=None):
+    ex = None
+    query_start = time.time()
+    logger.log(logging.DEBUG, 'dns lookup %s ...', qname)
+    if not local_dns_query and not local_dns:
+        try:
+            ipv4, ttl = yield from dns_client.query(qname, loop=loop)
+            used = time.time() - query_start
+            metrics.dns_time.observe(used, 'opendns')
+            _cache_dns(qname, ipv4, ttl)
+            logger.log(logging.DEBUG if used < 1 else logging.INFO, 'opendns lookup %s => %s used %.2f sec', qname, ipv4, used)
+            return ipv4
+        except (NoAnswer, NXDOMAIN, DNSException, asyncio.TimeoutError, OSError) as noa:
+            ex = noa
+            metrics.dns_failures.inc('opendns')
+        logger.log(logging.INFO, 'opendns lookup %s failed, try local lookup (used %.2f sec)', qname, (time.time() - query_start))
+    local_start = time.time()
+    try:
+        # fallback to the system resolver
+        ipv4 = (yield from loop.run_in_executor(None, socket.gethostbyname_ex, qname))[2]
+        metrics.dns_time.observe(time.time() - local_start, 'local')
+        _cache_dns(qname, ipv4)
+        if ex is not None:
+            logger.info('local lookup result: %s => %s for (%s:%s)', qname, ipv4, common.clazz_fullname(ex), ex)
+        else:
+            used = time.time() - query_start
+            logger.log(logging.DEBUG if used < 1 else logging.INFO, 'local lookup %s => %s used %.2f sec', qname, ipv4,
+                       used)
+        return ipv4
+    except asyncio.CancelledError:
+        raise
+    except BaseException as ex:
+        metrics.dns_failures.inc('local')
+        logger.info('%s => DNS lookup FAIL(%s:%s)', qname, common.clazz_fullname(ex), ex)
+        raise
 
-    return ip
 
+def _cache_dns(qname, ips, ttl=None):
+    """ :param ttl: ttl of the dns record, None for the default timeout of dns_cache """
+    if ttl is not None:
+        ttl = min(max(ttl, common.dns_min_ttl), common.dns_max_ttl)
+    dns_cache.set(qname, copy.deepcopy(ips), timeout=ttl, stale_timeout=common.dns_stale_ttl)
 
-def dns_query(qname, raise_on_fail=False, local_dns=False, in_cache=False, force_remote=False, **kwargs):
-    ips = dns_query_ex(qname, raise_on_fail=raise_on_fail, local_dns=local_dns, in_cache=in_cache, force_remote=force_remote, **kwargs)
+
+def _round_robin(ips):
     if ips is not None and isinstance(ips, list):
         if len(ips) > 1:
             ip = ips.pop(0)
@@ -316,6 +449,11 @@ def dns_query(qname, raise_on_fail=False, local_dns=False, in_cache=False, force
     return ips
 
 
+def dns_query(qname, raise_on_fail=False, local_dns=False, in_cache=False, force_remote=False, **kwargs):
+    ips = dns_query_ex(qname, raise_on_fail=raise_on_fail, local_dns=local_dns, in_cache=in_cache, force_remote=force_remote, **kwargs)
+    return _round_robin(ips)
+
+
 def dns_query_ex(qname, raise_on_fail=False, local_dns=False, in_cache=False, force_remote=False, **kwargs):
     global dns_cache
     global resolver
@@ -324,8 +462,10 @@ def dns_query_ex(qname, raise_on_fail=False, local_dns=False, in_cache=False, fo
         return [qname]
     if is_ipv6(qname):
         return [qname]
-    if not force_remote and qname in dns_cache:
-        return dns_cache[qname]
+    if not force_remote:
+        ips = dns_cache.get(qname)
+        if ips is not None:
+            return ips
     # update_hosts()
     if not force_remote and qname in _hosts:
         return [_hosts[qname]]
@@ -346,7 +486,7 @@ def dns_query_ex(qname, raise_on_fail=False, local_dns=False, in_cache=False, fo
                 else:
                     ipv4.append(a.to_text())
             if ipv4 is not None:
-                dns_cache[qname] = copy.deepcopy(ipv4)
+                _cache_dns(qname, ipv4, answers.rrset.ttl)
                 logger.log(logging.DEBUG if used < 1 else logging.INFO, 'opendns lookup %s => %s used %.2f sec', qname, ipv4, used)
                 return ipv4
         except (NoAnswer, NXDOMAIN, Timeout) as noa:
@@ -354,7 +494,7 @@ def dns_query_ex(qname, raise_on_fail=False, local_dns=False, in_cache=False, fo
         logger.log(logging.INFO, 'opendns lookup %s failed, try local lookup (used %.2f sec)', qname, (time.time() - query_start))
     try:
         ipv4 = socket.gethostbyname_ex(qname)[2]
-        dns_cache[qname] = copy.deepcopy(ipv4)
+        _cache_dns(qname, ipv4)
         if ex is not None:
             logger.info('local lookup result: %s => %s for (%s:%s)', qname, ipv4, common.clazz_fullname(ex), ex)
         else:
@@ -402,11 +542,10 @@ def subnet_to_ipmask(ipv4):
 
 
 def is_cn_ip(atype, addr, return_country=False):
-    global cn_ip_list
     global cn_addr_cache
     load_cn_list()
-    if addr in cn_addr_cache:
-        cn = cn_addr_cache[addr]
+    cn = cn_addr_cache.get(addr)
+    if cn is not None:
         logger.log(5, '%s => %s', addr, cn)
         return cn.upper() == 'CN' if not return_country else cn
     ip = dns_query(addr) if atype == 0x03 else addr
@@ -422,27 +561,53 @@ def is_cn_ip(atype, addr, return_country=False):
         return False if not return_country else 'FOREIGN'
     if is_local(ip):
         return True if not return_country else 'CN'
-    ipn = int.from_bytes(socket.inet_pton(socket.AF_INET6 if atype == 0x04 else socket.AF_INET, ip), byteorder='big')
-    for ip, mask, country in cn_ip_list:
-        if ip == (ipn & mask):
-            if country.upper() == 'CN':
-                logger.log(logging.DEBUG, '%s[%s] => %s', addr, ip, country)
-                cn_addr_cache[addr] = country
-                return True if not return_country else country
-            else:
-                logger.log(logging.DEBUG, '%s[%s] => %s', addr, ip, country)
-                cn_addr_cache[addr] = country
-                return False if not return_country else country
-    logger.log(logging.DEBUG, '%s[%s] => FOREIGN', addr, ip)
-    cn_addr_cache[addr] = 'FOREIGN'
-    return False if not return_country else 'FOREIGN'
+    if atype == 0x04:
+        ipn = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), byteorder='big')
+        country = cn_ipv6_index.lookup(ipn)
+    else:
+        ipn = int.from_bytes(socket.inet_pton(socket.AF_INET, ip), byteorder='big')
+        country = cn_ipv4_index.lookup(ipn)
+    if country is None:
+        country = 'FOREIGN'
+    logger.log(logging.DEBUG, '%s[%s] => %s', addr, ip, country)
+    cn_addr_cache[addr] = country
+    if return_country:
+        return country
+    return country.upper() == 'CN'
+
+
+def parse_apnic_ranges(data, only_cn=True):
+    """
+    :param data: content of delegated-apnic-latest
+    :return: ipv4 ranges and ipv6 ranges, [(starting_ip, ending_ip, country), ...]
+    """
+    if only_cn:
+        regex = re.compile(r'apnic\|cn\|ipv[46]\|[0-9a-f\.:]+\|[0-9]+\|[0-9]+\|a.*', re.IGNORECASE)
+    else:
+        regex = re.compile(r'apnic\|..\|ipv[46]\|[0-9a-f\.:]+\|[0-9]+\|[0-9]+\|a.*', re.IGNORECASE)
+    ipv4_ranges = []
+    ipv6_ranges = []
+    for item in regex.findall(data):
+        unit_items = item.split('|')
+        country = unit_items[1]
+        value = int(unit_items[4])
+        if unit_items[2] == 'ipv6':
+            # value of ipv6 record is the prefix length
+            starting_ip = int.from_bytes(socket.inet_pton(socket.AF_INET6, unit_items[3]), byteorder='big')
+            ipv6_ranges.append((starting_ip, starting_ip + 2 ** (128 - value) - 1, country))
+        else:
+            # value of ipv4 record is the count of hosts
+            starting_ip = int.from_bytes(socket.inet_aton(unit_items[3]), byteorder='big')
+            ipv4_ranges.append((starting_ip, starting_ip + value - 1, country))
+    return ipv4_ranges, ipv6_ranges
 
 
 def load_cn_list(only_cn=True):
     """http://ftp.apnic.net/apnic/stats/apnic/delegated-apnic-latest"""
 
     global cn_ip_file_mod
-    global cn_ip_list
+    global cn_ipv4_index
+    global cn_ipv6_index
     global cn_ip_update
     global apnic_file
 
@@ -461,27 +626,16 @@ def load_cn_list(only_cn=True):
         with open(apnic_file, 'r') as f:
             data = f.read()
 
-        if only_cn:
-            regex = re.compile(r'apnic\|cn\|ipv[46]\|[0-9a-f\.:]+\|[0-9]+\|[0-9]+\|a.*', re.IGNORECASE)
-        else:
-            regex = re.compile(r'apnic\|..\|ipv[46]\|[0-9a-f\.:]+\|[0-9]+\|[0-9]+\|a.*', re.IGNORECASE)
-        cndata = regex.findall(data)
-
-        cn_ip_list.clear()
-        for item in cndata:
-            unit_items = item.split('|')
-            country = unit_items[1]
-            num_ip = int(unit_items[4])
-            if unit_items[2] == 'ipv6':
-                starting_ip = int.from_bytes(socket.inet_pton(socket.AF_INET6, unit_items[3]), byteorder='big')
-                imask = 0xffffffffffffffffffffffffffffffff ^ (num_ip - 1)
-            else:
-                starting_ip = int.from_bytes(socket.inet_aton(unit_items[3]), byteorder='big')
-                imask = 0xffffffff ^ (num_ip-1)
-            cn_ip_list.append((starting_ip, imask, country))
+        ipv4_ranges, ipv6_ranges = parse_apnic_ranges(data, only_cn)
+        # build new index then replace the old one, lookup never sees a half loaded index
+        cn_ipv4_index = IpRangeIndex.build(ipv4_ranges, 'Q')
+        cn_ipv6_index = IpRangeIndex.build(ipv6_ranges)
+        # the countries cached are looked up in the old index
+        cn_addr_cache.clear()
 
         cn_ip_file_mod = mtime
-        logger.info('%s loaded', apnic_file)
+        logger.info('%s loaded, ipv4 ranges: %d/%d, ipv6 ranges: %d/%d', apnic_file,
+                    len(cn_ipv4_index), len(ipv4_ranges), len(cn_ipv6_index), len(ipv6_ranges))
     except FileNotFoundError:
         cn_ip_update = time.time() + 60
         logger.error('file not found: %s', apnic_file)
@@ -490,11 +644,51 @@ def load_cn_list(only_cn=True):
         logging.exception('load_cn_list(only_cn=%s) fail: %s', only_cn, ex_apnic)
 
 
+def benchmark_cn_ip(apnic=None, count=20000):
+    """ compare the bisect index with the old linear scan over (starting_ip, imask, country) """
+    import random
+
+    if apnic is None:
+        apnic = lookup_conf_file(APNIC_LATEST)
+    with open(apnic, 'r') as f:
+        data = f.read()
+    ipv4_ranges, _ = parse_apnic_ranges(data, only_cn=False)
+    index = IpRangeIndex.build(ipv4_ranges, 'Q')
+    scan_list = []
+    for start, end, country in ipv4_ranges:
+        scan_list.append((start, 0xffffffff ^ (end - start), country))
+
+    def linear_lookup(_ipn):
+        for _ip, _mask, _country in scan_list:
+            if _ip == (_ipn & _mask):
+                return _country
+        return None
+
+    samples = [random.randint(0x01000000, 0xdfffffff) for _ in range(0, count)]
+    linear_count = max(1, int(count / 100))
+    start_time = time.time()
+    for ipn in samples[:linear_count]:
+        linear_lookup(ipn)
+    linear_used = (time.time() - start_time) / linear_count
+    start_time = time.time()
+    for ipn in samples:
+        index.lookup(ipn)
+    index_used = (time.time() - start_time) / count
+    print('%s: %d ipv4 records, %d merged ranges' % (apnic, len(ipv4_ranges), len(index)))
+    print('linear scan: %.2f us/lookup' % (linear_used * 1000000))
+    print('bisect index: %.2f us/lookup (x%.0f)' % (index_used * 1000000, linear_used / index_used if index_used > 0 else 0))
+
+
 if __name__ == '__main__':
     import signal
     import sys
     from tsproxy.common import print_stack_trace
 
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        # python -m tsproxy.topendns bench [apnic-file]
+        benchmark_cn_ip(*sys.argv[2:3])
+        sys.exit(0)
+
     print('%s %x' % subnet_to_ipmask('192.168.0.*'))
     print('%s %x' % subnet_to_ipmask('192.168.0.0/17'))
 
@@ -0,0 +1,213 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import CancelledError
+from io import StringIO
+
+from tsproxy import common
+
+logger = logging.getLogger(__name__)
+
+# max bytes of a message line, the state grows with the proxies and their stat
+MESSAGE_LIMIT = 16 * 1024 * 1024
+
+
+def bus_path(pid_file):
+    """ the unix socket of the workers, beside the pid file of the leader """
+    return '%s.sock' % pid_file
+
+
+class WorkerBus(object):
+    """
+    newline delimited json messages over a unix socket between the leader worker(#0) and the followers:
+      stat    - follower -> leader, the response time samples of the proxies
+      state   - leader -> followers, the proxies order and stat, broadcast every worker_sync_interval seconds
+      domain_speed - leader -> followers, the domain speed map, sent on connect and after the speed tests
+      command - the mutating management command, executed by every worker
+    the leader does the health checks and speed tests, so all workers agree on the head proxy
+    """
+
+    def __init__(self, proxy_holder, path, worker=0, loop=None):
+        self._loop = loop if loop else asyncio.get_event_loop()
+        self.proxy_holder = proxy_holder
+        self.path = path
+        self.worker = worker
+        self.command_handler = None
+        self._tasks = []
+
+    @property
+    def follower(self):
+        return self.worker > 0
+
+    async def start(self):
+        raise NotImplementedError()
+
+    def close(self):
+        for t in self._tasks:
+            t.cancel()
+
+    def send_stat(self, proxy, resp_time, target_host, proxy_ip, proxy_fail, proxy_timeout, proxy_name):
+        pass
+
+    def send_command(self, cmd_line):
+        raise NotImplementedError()
+
+    @staticmethod
+    def _write(writer, msg):
+        if writer is not None and not writer.transport.is_closing():
+            writer.write(json.dumps(msg, separators=(',', ':')).encode() + b'\n')
+
+    async def _read_messages(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                await self.on_message(json.loads(line.decode()), writer)
+            except CancelledError:
+                raise
+            except Exception as ex:
+                logger.exception('worker#%d handle message fail: %s(%s)', self.worker, common.clazz_fullname(ex), ex)
+
+    async def on_message(self, msg, writer):
+        raise NotImplementedError()
+
+    async def run_command(self, cmd_line):
+        if self.command_handler is None:
+            return
+        out = StringIO()
+        code = await asyncio.ensure_future(self.command_handler(cmd_line, out), loop=self._loop)
+        logger.info('worker#%d command "%s" done with %s', self.worker, cmd_line, code)
+
+
+class LeaderBus(WorkerBus):
+
+    def __init__(self, proxy_holder, path, loop=None):
+        super().__init__(proxy_holder, path, worker=0, loop=loop)
+        self._followers = set()
+        self._server = None
+        self._speed_test_time = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._server = await asyncio.start_unix_server(self._on_follower, path=self.path, loop=self._loop, limit=MESSAGE_LIMIT)
+        self._tasks.append(self._loop.create_task(self._broadcast_loop()))
+        logger.info('worker bus listen at %s', self.path)
+
+    def close(self):
+        super().close()
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    async def _on_follower(self, reader, writer):
+        self._followers.add(writer)
+        # the state at once, the domain speed included
+        self._write(writer, self.proxy_holder.worker_state())
+        self._write(writer, self._domain_speed_message())
+        try:
+            await self._read_messages(reader, writer)
+        except (CancelledError, ConnectionError):
+            pass
+        except (ValueError, asyncio.LimitOverrunError) as ex:
+            # the message over MESSAGE_LIMIT, the follower will reconnect
+            logger.warning('read the follower worker fail: %s(%s)', common.clazz_fullname(ex), ex)
+        finally:
+            self._followers.discard(writer)
+            writer.close()
+
+    async def on_message(self, msg, writer):
+        op = msg['op']
+        if op == 'stat':
+            self.proxy_holder.apply_worker_stat(msg['samples'])
+        elif op == 'command':
+            self._relay(msg, exclude=writer)
+            await self.run_command(msg['cmd'])
+        else:
+            logger.warning('unknown message of the worker bus: %s', msg)
+
+    def _relay(self, msg, exclude=None):
+        for writer in list(self._followers):
+            if writer is not exclude:
+                self._write(writer, msg)
+
+    def send_command(self, cmd_line):
+        self._relay({'op': 'command', 'cmd': cmd_line})
+
+    def _domain_speed_message(self):
+        return {'op': 'domain_speed', 'domain_speed_map': self.proxy_holder.domain_speed_map}
+
+    async def _broadcast_loop(self):
+        while True:
+            await asyncio.sleep(common.worker_sync_interval, loop=self._loop)
+            if not self._followers:
+                continue
+            try:
+                speed_test_time = self.proxy_holder.last_speed_test_time
+                self._relay(self.proxy_holder.worker_state())
+                if speed_test_time != self._speed_test_time:
+                    self._relay(self._domain_speed_message())
+                    self._speed_test_time = speed_test_time
+            except Exception as ex:
+                logger.exception('broadcast the workers state fail: %s(%s)', common.clazz_fullname(ex), ex)
+
+
+class FollowerBus(WorkerBus):
+
+    def __init__(self, proxy_holder, path, worker, loop=None):
+        super().__init__(proxy_holder, path, worker=worker, loop=loop)
+        self._writer = None
+        self._samples = []
+
+    async def start(self):
+        self._tasks.append(self._loop.create_task(self._connect_loop()))
+
+    async def _connect_loop(self):
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path, loop=self._loop, limit=MESSAGE_LIMIT)
+                logger.info('worker#%d connected to the leader worker', self.worker)
+                await self._read_messages(reader, self._writer)
+                logger.warning('worker#%d disconnected from the leader worker', self.worker)
+            except CancelledError:
+                break
+            except (ConnectionError, FileNotFoundError) as ex:
+                logger.debug('worker#%d connect to the leader fail: %s(%s)', self.worker, common.clazz_fullname(ex), ex)
+            except (ValueError, asyncio.LimitOverrunError) as ex:
+                # the message over MESSAGE_LIMIT, reconnect for the next state
+                logger.warning('worker#%d read the leader fail: %s(%s)', self.worker, common.clazz_fullname(ex), ex)
+            finally:
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+            # the leader is restarting, work on the local state until it back
+            await asyncio.sleep(1, loop=self._loop)
+
+    async def on_message(self, msg, writer):
+        op = msg['op']
+        if op == 'state':
+            self.proxy_holder.apply_worker_state(msg)
+        elif op == 'domain_speed':
+            self.proxy_holder.domain_speed_map = msg['domain_speed_map']
+        elif op == 'command':
+            await self.run_command(msg['cmd'])
+        else:
+            logger.warning('unknown message of the worker bus: %s', msg)
+
+    def send_stat(self, proxy, resp_time, target_host, proxy_ip, proxy_fail, proxy_timeout, proxy_name):
+        if self._writer is None:
+            return
+        if not self._samples:
+            self._loop.call_later(0.1, self._flush_samples)
+        self._samples.append((proxy.short_hostname, resp_time, target_host, proxy_ip, proxy_fail, proxy_timeout, proxy_name))
+
+    def _flush_samples(self):
+        samples, self._samples = self._samples, []
+        self._write(self._writer, {'op': 'stat', 'samples': samples})
+
+    def send_command(self, cmd_line):
+        self._write(self._writer, {'op': 'command', 'cmd': cmd_line})